@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+
+def write_batch_requests(requests, input_path):
+    """Write (custom_id, body) pairs of chat completion requests to a batch input JSONL file."""
+    with open(input_path, "w") as f:
+        for custom_id, body in requests:
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }
+            f.write(json.dumps(line) + "\n")
+
+
+def hash_request(body):
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_batch_responses(output_path):
+    """Read a batch output JSONL file into a dict mapping custom_id to the completion body.
+
+    Requests that failed in the batch are left out, so that the caller falls back to a
+    regular API call for them.
+    """
+    responses = dict()
+    with open(output_path) as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            item = json.loads(line)
+            response = item.get("response")
+            if item.get("error") is None and response and response["status_code"] == 200:
+                responses[item["custom_id"]] = response["body"]
+            else:
+                print("Batch request failed:", item["custom_id"], item.get("error"))
+    return responses
+
+
+class BatchBackend:
+    """
+    Interface of a batch backend: a JSONL file of requests is submitted and, once the
+    batch is finished, the JSONL file of responses is written to output_path.
+    """
+
+    def submit(self, input_path):
+        """Submit the batch input file and return the batch id."""
+        raise NotImplementedError
+
+    def retrieve(self, batch_id, output_path):
+        """Write the batch output to output_path and return True, or return False if not finished."""
+        raise NotImplementedError
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, client, completion_window="24h"):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    def retrieve(self, batch_id, output_path):
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ["failed", "expired", "cancelled"]:
+            raise Exception(f"Batch {batch_id} ended with status {batch.status}")
+        if batch.status != "completed":
+            return False
+
+        with open(output_path, "w") as f:
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is not None:
+                    f.write(self.client.files.content(file_id).text)
+        return True
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    File-based stand-in for a batch API. Each batch is a directory under batch_dir holding
+    input.jsonl; the batch is finished once output.jsonl exists next to it. If a client is
+    given, missing outputs are produced by sending the requests one by one through it
+    (e.g. to a local OpenAI-compatible server), otherwise output.jsonl has to be written
+    by someone else.
+    """
+
+    def __init__(self, batch_dir, client=None):
+        self.batch_dir = batch_dir
+        self.client = client
+
+    def submit(self, input_path):
+        batch_id = "batch_" + uuid.uuid4().hex
+        os.makedirs(os.path.join(self.batch_dir, batch_id))
+        shutil.copy(input_path, os.path.join(self.batch_dir, batch_id, "input.jsonl"))
+        return batch_id
+
+    def retrieve(self, batch_id, output_path):
+        local_output_path = os.path.join(self.batch_dir, batch_id, "output.jsonl")
+        if not os.path.exists(local_output_path):
+            if self.client is None:
+                return False
+            self.process(batch_id)
+        shutil.copy(local_output_path, output_path)
+        return True
+
+    def process(self, batch_id):
+        input_path = os.path.join(self.batch_dir, batch_id, "input.jsonl")
+        output_path = os.path.join(self.batch_dir, batch_id, "output.jsonl")
+        with open(input_path) as f_in, open(output_path + ".tmp", "w") as f_out:
+            for line in f_in:
+                item = json.loads(line)
+                output = {"id": "batch_req_" + uuid.uuid4().hex, "custom_id": item["custom_id"]}
+                try:
+                    response = self.client.chat.completions.create(**item["body"])
+                    output["response"] = {"status_code": 200, "body": response.to_dict()}
+                    output["error"] = None
+                except Exception as e:
+                    output["response"] = None
+                    output["error"] = {"message": str(e)}
+                f_out.write(json.dumps(output) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+
+def run_batch(backend, requests, work_dir, poll_interval=60):
+    """
+    Submit the requests through the backend, wait for the batch to finish and return a dict
+    mapping custom_id to the completion body.
+
+    The batch id and a hash of every request are recorded in work_dir, so an interrupted run
+    resumes waiting for the same batch instead of submitting it again, and a run whose
+    requests are all in the batch (e.g. the remaining jobs of an earlier run) reuses its
+    responses. A batch built from other requests (another dataset, prompt, memory or model)
+    is discarded and a new one is submitted.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    input_path = os.path.join(work_dir, "batch_input.jsonl")
+    output_path = os.path.join(work_dir, "batch_output.jsonl")
+    state_path = os.path.join(work_dir, "batch_state.json")
+    request_hashes = {custom_id: hash_request(body) for custom_id, body in requests}
+
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        recorded_hashes = state.get("request_hashes") or {}
+        if any(recorded_hashes.get(custom_id) != value for custom_id, value in request_hashes.items()):
+            print(f"Batch {state['batch_id']} in {work_dir} was built from other requests, submitting a new one")
+            state = None
+            for path in [output_path, state_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    if state is not None and os.path.exists(output_path):
+        responses = read_batch_responses(output_path)
+        return {custom_id: responses[custom_id] for custom_id in request_hashes if custom_id in responses}
+
+    if state is not None:
+        batch_id = state["batch_id"]
+        print("Resuming batch", batch_id)
+    else:
+        write_batch_requests(requests, input_path)
+        batch_id = backend.submit(input_path)
+        with open(state_path, "w") as f:
+            json.dump({"batch_id": batch_id, "num_request": len(requests), "request_hashes": request_hashes}, f)
+        print(f"Submitted batch {batch_id} with {len(requests)} requests")
+
+    while not backend.retrieve(batch_id, output_path + ".tmp"):
+        time.sleep(poll_interval)
+    os.replace(output_path + ".tmp", output_path)
+
+    responses = read_batch_responses(output_path)
+    return {custom_id: responses[custom_id] for custom_id in request_hashes if custom_id in responses}
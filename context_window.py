@@ -0,0 +1,96 @@
+def get_field(message, key):
+    # messages are dicts, except assistant messages returned by the client
+    if isinstance(message, dict):
+        return message.get(key)
+    return getattr(message, key, None)
+
+
+class ContextWindowManager:
+    """
+    Keeps the messages sent to the LLM under a token budget by replacing the oldest tool
+    outputs with short stubs.
+
+    Only the content of tool messages (and of the user messages that carry their images) is
+    replaced; no message is removed, so every assistant tool call keeps its tool reply as the
+    API requires. The system prompt, the first user prompt and the tool outputs of the latest
+    round, which the model has not seen yet, are never replaced. Token counts are estimated
+    with about 4 characters per token and a fixed cost per image.
+    """
+
+    def __init__(self, token_budget=60000, image_tokens=1000, preview_chars=300):
+        self.token_budget = token_budget
+        self.image_tokens = image_tokens
+        self.preview_chars = preview_chars
+        # tool_call_ids whose outputs were replaced in the last compacted messages
+        self.evicted_tool_call_ids = set()
+
+    def estimate_num_tokens(self, message):
+        num_tokens = 4
+        content = get_field(message, "content")
+        if isinstance(content, str):
+            num_tokens += len(content) // 4
+        elif isinstance(content, list):
+            for item in content:
+                if item["type"] == "text":
+                    num_tokens += len(item["text"]) // 4
+                else:
+                    num_tokens += self.image_tokens
+        for tool_call in get_field(message, "tool_calls") or []:
+            function = get_field(tool_call, "function")
+            num_tokens += len(str(get_field(function, "arguments"))) // 4 + 10
+        return num_tokens
+
+    def get_tool_names(self, messages):
+        tool_names = dict()
+        for message in messages:
+            for tool_call in get_field(message, "tool_calls") or []:
+                tool_names[get_field(tool_call, "id")] = get_field(
+                    get_field(tool_call, "function"), "name"
+                )
+        return tool_names
+
+    def make_stub(self, message, tool_name):
+        content = message["content"]
+        if message["role"] == "tool":
+            preview = content[: self.preview_chars]
+            if len(content) > self.preview_chars:
+                preview = preview + "..."
+            content = f"[The output of this earlier {tool_name} call was shortened to save context, call the tool again if you need it in full. Beginning of the output: {preview}]"
+        else:  # user message with the images of a tool reply
+            content = f"[The images returned by this earlier {tool_name} call were removed to save context, call the tool again if you need them.]"
+        return dict(message, content=content)
+
+    def compact(self, messages):
+        """Return a copy of messages whose estimated size fits into the token budget where possible."""
+        num_tokens = [self.estimate_num_tokens(message) for message in messages]
+        total_num_tokens = sum(num_tokens)
+        self.evicted_tool_call_ids = set()
+        if total_num_tokens <= self.token_budget:
+            return messages
+
+        assistant_indices = [
+            index for index, message in enumerate(messages) if get_field(message, "role") == "assistant"
+        ]
+        if len(assistant_indices) == 0:
+            return messages
+        # tool outputs after the last assistant message have not been seen by the model yet
+        first_index, last_index = assistant_indices[0], assistant_indices[-1]
+
+        tool_names = self.get_tool_names(messages)
+        compacted = list(messages)
+        for index in range(first_index, last_index):
+            message = messages[index]
+            if not isinstance(message, dict) or message.get("tool_call_id") is None:
+                continue
+            stub = self.make_stub(message, tool_names.get(message["tool_call_id"], "tool"))
+            stub_num_tokens = self.estimate_num_tokens(stub)
+            if stub_num_tokens >= num_tokens[index]:
+                continue
+
+            compacted[index] = stub
+            total_num_tokens -= num_tokens[index] - stub_num_tokens
+            self.evicted_tool_call_ids.add(message["tool_call_id"])
+            if total_num_tokens <= self.token_budget:
+                break
+
+        return compacted
@@ -0,0 +1,409 @@
+import argparse
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import doc_reader
+
+parser = argparse.ArgumentParser(description="Build or query the index over all processed documents")
+subparsers = parser.add_subparsers(dest="command", required=True)
+build_parser = subparsers.add_parser("build", help="Index the processed documents")
+build_parser.add_argument(
+    "--preprocessed-data-dir",
+    type=str,
+    default="./preprocess/processed_output/",
+    help="Preprocessed data directory",
+)
+build_parser.add_argument(
+    "--index-dir",
+    type=str,
+    default="./corpus_index/",
+    help="Directory of the index, replaced when the build is finished",
+)
+build_parser.add_argument(
+    "--num-shards",
+    type=int,
+    default=64,
+    help="Number of shards the terms are spread over",
+)
+build_parser.add_argument(
+    "--num-workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of documents parsed in parallel",
+)
+search_parser = subparsers.add_parser("search", help="Search the index")
+search_parser.add_argument("query", type=str, help="Words to search for")
+search_parser.add_argument("--index-dir", type=str, default="./corpus_index/", help="Directory of the index")
+search_parser.add_argument("--max-docs", type=int, default=10, help="Number of documents returned")
+search_parser.add_argument("--max-sections", type=int, default=3, help="Number of sections per document")
+
+INDEX_VERSION = 1
+# doc number, section number, page number and term frequency of each posting
+POSTING_SIZE = 4
+# doc number and term frequency of each document posting
+DOC_POSTING_SIZE = 2
+
+stopwords = set(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in stopwords]
+
+
+def get_shard(term, num_shards):
+    return zlib.crc32(term.encode("utf-8")) % num_shards
+
+
+def extract_postings(data_path):
+    """
+    Read one processed document and count its terms per section and page.
+
+    Returns the section list [[section_id, heading, start_page_num], ...] and a dict mapping
+    each term to {(section_num, page_num): count}. Headings, paragraphs, tables and image
+    texts are indexed, the same elements that DocReader.search looks at.
+    """
+    reader = doc_reader.DocReader(data_path)
+    sections, postings = [], dict()
+
+    def add_text(text, section_num, page_num):
+        for term in tokenize(text or ""):
+            counts = postings.setdefault(term, dict())
+            counts[(section_num, page_num)] = counts.get((section_num, page_num), 0) + 1
+
+    # text before the first section belongs to section number 0, the document itself
+    sections.append(["", "", 1])
+    section_num = 0
+    for element in reader.root.iter():
+        if element.tag == "Section":
+            heading = element[0].text if len(element) > 0 and element[0].tag == "Heading" else ""
+            page_num = int(element.get("start_page_num") or 1)
+            section_num = len(sections)
+            sections.append([element.get("section_id"), heading or "", page_num])
+            add_text(heading, section_num, page_num)
+        elif element.tag in ["Paragraph", "CSV_Table"]:
+            add_text(element.text, section_num, int(element.get("page_num") or 0))
+        elif element.tag == "Image":
+            for child in element:
+                add_text(child.text, section_num, int(element.get("page_num") or 0))
+    return sections, postings
+
+
+def index_document(job):
+    doc_num, doc_id, data_path = job
+    try:
+        sections, postings = extract_postings(data_path)
+    except Exception as e:
+        return doc_num, doc_id, None, f"{type(e).__name__}: {str(e)}"
+    return doc_num, doc_id, (sections, postings), None
+
+
+def build_index(preprocessed_data_dir, index_dir, num_shards=64, num_workers=None):
+    """
+    Index all documents of preprocessed_data_dir into index_dir.
+
+    The terms are spread over num_shards shards by hash. Each shard has a lexicon
+    (shard_NNN.json, term -> [offset, num_postings, doc_offset, num_docs]), a postings file
+    (shard_NNN.bin) with the uint32 doc, section, page and count of each posting, sorted by
+    document, and a document postings file (shard_NNN.docs.bin) with the uint32 doc and
+    count per document, used to rank documents before their sections are looked up. The
+    index is written next to index_dir and swapped in when complete.
+    """
+    start_time = time.time()
+    doc_ids = sorted(
+        entry.name
+        for entry in os.scandir(preprocessed_data_dir)
+        if entry.is_dir()
+        and (
+            os.path.exists(os.path.join(entry.path, "data.col"))
+            or os.path.exists(os.path.join(entry.path, "data.pkl"))
+        )
+    )
+    jobs = [
+        (doc_num, doc_id, os.path.join(preprocessed_data_dir, doc_id))
+        for doc_num, doc_id in enumerate(doc_ids)
+    ]
+
+    tmp_dir = index_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    failed = []
+    shards = [dict() for _ in range(num_shards)]
+    # one JSON line per document, found by its byte offset so queries parse only their results
+    doc_offsets = array("Q")
+    with ProcessPoolExecutor(max_workers=max(1, num_workers or 1)) as executor, open(
+        os.path.join(tmp_dir, "docs.jsonl"), "wb"
+    ) as f_docs:
+        # results arrive in document order, so the postings of each term stay sorted
+        for doc_num, doc_id, result, error in executor.map(index_document, jobs, chunksize=4):
+            doc_offsets.append(f_docs.tell())
+            if error is not None:
+                print("Failed to index", doc_id, error)
+                failed.append(doc_id)
+                f_docs.write(json.dumps({"doc_id": doc_id, "sections": []}).encode("utf-8") + b"\n")
+                continue
+            sections, postings = result
+            f_docs.write(json.dumps({"doc_id": doc_id, "sections": sections}).encode("utf-8") + b"\n")
+            for term, counts in postings.items():
+                values = shards[get_shard(term, num_shards)].setdefault(term, array("I"))
+                for (section_num, page_num), count in sorted(counts.items()):
+                    values.extend([doc_num, section_num, page_num, count])
+        doc_offsets.append(f_docs.tell())
+    if sys.byteorder == "big":
+        doc_offsets.byteswap()
+    with open(os.path.join(tmp_dir, "docs.offsets"), "wb") as f:
+        f.write(doc_offsets.tobytes())
+
+    num_postings = 0
+    for shard_num, shard in enumerate(shards):
+        lexicon, offset, doc_offset = dict(), 0, 0
+        with open(os.path.join(tmp_dir, "shard_%03d.bin" % shard_num), "wb") as f, open(
+            os.path.join(tmp_dir, "shard_%03d.docs.bin" % shard_num), "wb"
+        ) as f_docs:
+            for term in sorted(shard):
+                values = shard[term]
+                doc_values = array("I")
+                for index in range(0, len(values), POSTING_SIZE):
+                    if len(doc_values) > 0 and doc_values[-2] == values[index]:
+                        doc_values[-1] += values[index + 3]
+                    else:
+                        doc_values.extend([values[index], values[index + 3]])
+                count = len(values) // POSTING_SIZE
+                num_docs = len(doc_values) // DOC_POSTING_SIZE
+                if sys.byteorder == "big":
+                    values.byteswap()
+                    doc_values.byteswap()
+                f.write(values.tobytes())
+                f_docs.write(doc_values.tobytes())
+                lexicon[term] = [offset, count, doc_offset, num_docs]
+                offset += count
+                doc_offset += num_docs
+                num_postings += count
+        with open(os.path.join(tmp_dir, "shard_%03d.json" % shard_num), "w") as f:
+            json.dump(lexicon, f)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": INDEX_VERSION,
+                "num_shards": num_shards,
+                "num_docs": len(jobs),
+                "num_postings": num_postings,
+            },
+            f,
+        )
+
+    # queries running against the old index keep their mapped files until they reopen
+    old_dir = index_dir.rstrip("/") + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(index_dir):
+        os.rename(index_dir, old_dir)
+    os.rename(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(
+        f"Indexed {len(jobs) - len(failed)} documents, {num_postings} postings, "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    return failed
+
+
+class CorpusIndex:
+    """
+    Searches the index written by build_index.
+
+    Shard lexicons are loaded and postings files memory-mapped when a query first needs
+    them, so a query reads only the shards of its terms, and only the sections of the
+    returned documents are parsed from the memory-mapped document list. Instances are safe
+    to share between threads.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != INDEX_VERSION:
+            raise ValueError(f"Unsupported corpus index version {self.meta['version']} in {index_dir}")
+        with open(os.path.join(index_dir, "docs.jsonl"), "rb") as f:
+            self.docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(os.path.join(index_dir, "docs.offsets"), "rb") as f:
+            self.doc_offsets = array("Q")
+            self.doc_offsets.frombytes(f.read())
+        if sys.byteorder == "big":
+            self.doc_offsets.byteswap()
+        self.num_shards = self.meta["num_shards"]
+        self.shards = dict()
+        self.lock = threading.Lock()
+
+    def map_file(self, path):
+        with open(path, "rb") as f:
+            if sys.byteorder == "big":
+                # the index is little-endian, big-endian machines read a swapped copy
+                values = array("I")
+                values.frombytes(f.read())
+                values.byteswap()
+                return values
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"").cast("I")
+            # the mapping stays valid after the file is closed
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast("I")
+
+    def load_shard(self, shard_num):
+        with self.lock:
+            if shard_num not in self.shards:
+                path = os.path.join(self.index_dir, "shard_%03d" % shard_num)
+                with open(path + ".json") as f:
+                    lexicon = json.load(f)
+                self.shards[shard_num] = (
+                    lexicon,
+                    self.map_file(path + ".bin"),
+                    self.map_file(path + ".docs.bin"),
+                )
+            return self.shards[shard_num]
+
+    def get_term(self, term):
+        """Return the section postings and the document postings of term, or None."""
+        lexicon, values, doc_values = self.load_shard(get_shard(term, self.num_shards))
+        if term not in lexicon:
+            return None
+        offset, count, doc_offset, num_docs = lexicon[term]
+        return (
+            values[offset * POSTING_SIZE : (offset + count) * POSTING_SIZE],
+            doc_values[doc_offset * DOC_POSTING_SIZE : (doc_offset + num_docs) * DOC_POSTING_SIZE],
+        )
+
+    def get_doc(self, doc_num):
+        start, end = self.doc_offsets[doc_num], self.doc_offsets[doc_num + 1]
+        return json.loads(self.docs[start:end])
+
+    @staticmethod
+    def find_doc(values, doc_num):
+        # binary search for the first posting of doc_num, postings are sorted by document
+        low, high = 0, len(values) // POSTING_SIZE
+        while low < high:
+            middle = (low + high) // 2
+            if values[middle * POSTING_SIZE] < doc_num:
+                low = middle + 1
+            else:
+                high = middle
+        return low * POSTING_SIZE
+
+    def search(self, query, max_docs=10, max_sections=3, max_pages=5):
+        """
+        Return the documents matching the words of query, best first.
+
+        Documents are ranked by the number of query words they contain and then by their
+        tf-idf score, using only the document postings. The section postings are then read
+        for the returned documents alone, to list their best sections with the pages where
+        the words were found.
+        """
+        num_docs = max(1, self.meta["num_docs"])
+        terms = dict()
+        for term in dict.fromkeys(tokenize(query)):
+            postings = self.get_term(term)
+            if postings is not None:
+                terms[term] = postings
+
+        # doc_num -> [number of terms, score]
+        docs = dict()
+        for term, (_, doc_values) in terms.items():
+            idf = math.log(1 + num_docs / (len(doc_values) // DOC_POSTING_SIZE))
+            for index in range(0, len(doc_values), DOC_POSTING_SIZE):
+                entry = docs.get(doc_values[index])
+                if entry is None:
+                    entry = docs[doc_values[index]] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += idf * (1 + math.log(doc_values[index + 1]))
+        top_docs = heapq.nlargest(max_docs, docs.items(), key=lambda item: (item[1][0], item[1][1]))
+
+        output = []
+        for doc_num, (num_terms, score) in top_docs:
+            # (section_num) -> [terms, score, pages]
+            sections = dict()
+            for term, (values, doc_values) in terms.items():
+                idf = math.log(1 + num_docs / (len(doc_values) // DOC_POSTING_SIZE))
+                index = self.find_doc(values, doc_num)
+                while index < len(values) and values[index] == doc_num:
+                    entry = sections.get(values[index + 1])
+                    if entry is None:
+                        entry = sections[values[index + 1]] = [set(), 0.0, dict()]
+                    entry[0].add(term)
+                    entry[1] += idf * (1 + math.log(values[index + 3]))
+                    entry[2][values[index + 2]] = entry[2].get(values[index + 2], 0) + values[index + 3]
+                    index += POSTING_SIZE
+
+            doc = self.get_doc(doc_num)
+            section_results = []
+            best_sections = heapq.nlargest(
+                max_sections, sections.items(), key=lambda item: (len(item[1][0]), item[1][1])
+            )
+            for section_num, (section_terms, section_score, pages) in best_sections:
+                section_id, heading, start_page_num = doc["sections"][section_num]
+                top_pages = sorted(pages, key=lambda page: pages[page], reverse=True)[:max_pages]
+                section_results.append(
+                    {
+                        "section_id": section_id,
+                        "heading": heading,
+                        "start_page_num": start_page_num,
+                        "pages": sorted(top_pages),
+                        "terms": sorted(section_terms),
+                        "score": section_score,
+                    }
+                )
+            output.append(
+                {
+                    "doc_id": doc["doc_id"],
+                    "num_terms": num_terms,
+                    "score": score,
+                    "sections": section_results,
+                }
+            )
+        return output
+
+
+_corpus_indexes = dict()
+_corpus_indexes_lock = threading.Lock()
+
+
+def get_corpus_index(index_dir):
+    """Return the process-wide CorpusIndex of index_dir."""
+    key = os.path.abspath(index_dir)
+    with _corpus_indexes_lock:
+        if key not in _corpus_indexes:
+            _corpus_indexes[key] = CorpusIndex(index_dir)
+        return _corpus_indexes[key]
+
+
+def corpus_search(index_dir, query, max_docs=10, max_sections=3):
+    return get_corpus_index(index_dir).search(query, max_docs=max_docs, max_sections=max_sections)
+
+
+def main(args):
+    if args.command == "build":
+        build_index(
+            args.preprocessed_data_dir,
+            args.index_dir,
+            num_shards=args.num_shards,
+            num_workers=args.num_workers,
+        )
+    else:
+        start_time = time.time()
+        results = corpus_search(args.index_dir, args.query, args.max_docs, args.max_sections)
+        print(json.dumps(results, indent=2))
+        print(f"{len(results)} documents in {(time.time() - start_time) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
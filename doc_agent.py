@@ -1,15 +1,93 @@
+import hashlib
 import json
+import os
+import random
 import re
+import threading
 import time
 import traceback
 import xml.dom.minidom
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI
+import openai
+from openai.types.chat import ChatCompletion
 
+from context_window import ContextWindowManager, get_field
+from llm_client import get_client_pool
 from prompts import (actor_prompt_template, available_tools,
-                     reflection_prompt_template, reviewer_prompt,
-                     system_prompt)
+                     collapsed_outline_note, corpus_search_tool_description,
+                     follow_up_question_template, reflection_prompt_template,
+                     reviewer_prompt, system_prompt)
+from table_store import TableQueryError
+
+
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor(max_workers=4):
+    # bounded worker pool shared by all agents in the process
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="prefetch"
+            )
+        return _prefetch_executor
+
+
+def is_retryable_error(e):
+    # rate limits, timeouts, dropped connections and server errors are transient, errors of
+    # the request itself (bad request, authentication, permission) are not
+    if isinstance(e, openai.RateLimitError):
+        return getattr(e, "code", None) != "insufficient_quota"
+    return isinstance(
+        e, (openai.APIConnectionError, openai.InternalServerError, openai.ConflictError)
+    )
+
+
+def get_retry_delay(e, attempt, retry_delay, max_delay=60):
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), max_delay)
+        except (TypeError, ValueError):
+            pass
+    # exponential backoff with jitter
+    return min(retry_delay * 2**attempt, max_delay) * random.uniform(0.5, 1.5)
+
+
+def get_api_messages(messages_full):
+    # saved completions are replaced by their assistant message to send them to the LLM again
+    messages = []
+    for item in messages_full:
+        if "model" in item:  # from assistant
+            messages.append(item["choices"][0]["message"])
+        else:  # others
+            messages.append(item)
+    return messages
+
+
+def get_request_messages(messages):
+    # the is_error marker of failed tool replies is kept in the saved messages, not sent
+    return [
+        {key: value for key, value in message.items() if key != "is_error"}
+        if isinstance(message, dict) and "is_error" in message
+        else message
+        for message in messages
+    ]
+
+
+def get_tool_call_key(name, tool_input):
+    # identical requests up to argument order, type and (for search) case of the keyword
+    if not isinstance(tool_input, dict):
+        return None
+    normalized = {key: str(value).strip() for key, value in tool_input.items()}
+    if name == "search" and "keyword" in normalized:
+        normalized["keyword"] = normalized["keyword"].lower()
+    return name + json.dumps(normalized, sort_keys=True)
 
 
 def clean_xml_string(xml_str):
@@ -17,6 +95,71 @@ def clean_xml_string(xml_str):
     return cleaned
 
 
+def get_reply_size(reply):
+    return sum(len(json.dumps(message["content"])) for message in reply)
+
+
+class DocumentCache:
+    """
+    Rendered outlines and tool replies of one document, shared by the agents answering
+    questions about it, possibly from several threads.
+
+    The tools only read the document, so a reply computed for one question is valid for the
+    others. Error replies are not kept, and replies are evicted in least-recently-used order
+    once their size exceeds max_size_mb (page images make up most of it).
+    """
+
+    def __init__(self, max_size_mb=64):
+        self.max_size = max_size_mb * 1024 * 1024
+        self.outlines = dict()
+        # get_tool_call_key -> (tool reply messages, size)
+        self.replies = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.num_hits, self.num_misses = 0, 0
+
+    def get_outline(self, outline_depth, render):
+        with self.lock:
+            if outline_depth in self.outlines:
+                return self.outlines[outline_depth]
+        outline = render()
+        with self.lock:
+            return self.outlines.setdefault(outline_depth, outline)
+
+    def get_reply(self, key, tool_call_id):
+        """Return a copy of the cached reply for key, answering tool_call_id, or None."""
+        with self.lock:
+            if key not in self.replies:
+                self.num_misses += 1
+                return None
+            self.replies.move_to_end(key)
+            self.num_hits += 1
+            reply, _ = self.replies[key]
+        return [dict(message, tool_call_id=tool_call_id) for message in reply]
+
+    def put_reply(self, key, reply):
+        size = get_reply_size(reply)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.replies:
+                return
+            self.replies[key] = (reply, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.replies.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "replies": len(self.replies),
+                "size_mb": self.size / 1024 / 1024,
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+            }
+
+
 class DocAgent:
     def __init__(
         self,
@@ -26,17 +169,72 @@ class DocAgent:
         max_tokens=8192,
         api_key=None,
         tool_call_wait_time=10,
+        client=None,
+        progress_callback=None,
+        prefetch_top_k=3,
+        max_prefetch_cache=32,
+        context_budget=None,
+        max_retries=5,
+        retry_delay=2,
+        checkpoint_path=None,
+        outline_depth=None,
+        dedupe_tool_calls=True,
+        corpus_index=None,
+        document_cache=None,
+        model_router=None,
     ):
         self.doc_reader = doc_reader
         self.model_id = model_id
         self.temperature = temperature
         self.max_tokens = max_tokens
-        self.client = OpenAI(api_key=api_key)
+        # all agents share the connections and keys of the process-wide client pool
+        self.client = client if client is not None else get_client_pool(api_keys=api_key)
         self.tool_call_wait_time = tool_call_wait_time
+        self.progress_callback = progress_callback
+        # speculative prefetch of sections and page images, keyed by ("section", section_id)
+        # or ("page_image", page_num)
+        self.prefetch_top_k = prefetch_top_k
+        self.max_prefetch_cache = max_prefetch_cache
+        self.prefetch_futures = OrderedDict()
+        self.prefetch_lock = threading.Lock()
+        # token budget of the messages sent per completion, None to always send everything
+        self.context_window = None
+        if context_budget is not None:
+            self.context_window = ContextWindowManager(token_budget=context_budget)
+        # retries of transient API errors per completion
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # jsonl file with the rounds of each agent loop, appended after every completed round
+        self.checkpoint_path = checkpoint_path
+        # checkpoint_key -> number of messages after the initial ones already in the file
+        self.checkpoint_offsets = dict()
+        # number of section levels shown in the initial outline, None for the full outline
+        self.outline_depth = outline_depth
+        # answer a repeated tool call of a conversation with a pointer to the earlier output
+        self.dedupe_tool_calls = dedupe_tool_calls
+        # corpus_index.CorpusIndex over the document collection, enables the corpus_search tool
+        self.corpus_index = corpus_index
+        # DocumentCache shared with the agents of other questions about the same document
+        self.document_cache = document_cache
+        # model_routing.ModelRouter choosing the model per phase, model_id for all phases if None
+        self.model_router = model_router
+        # checkpoint_key -> model, rounds and outcome of the last run_agent call of that phase
+        self.run_stats = dict()
+        # names of the tools of the current run_agent call, listed when an unknown tool is called
+        self.tool_names = [tool["function"]["name"] for tool in self.get_tools(available_tools)]
+
+    def report_progress(self, event):
+        if self.progress_callback is not None:
+            self.progress_callback(event)
 
     def get_outline(self):
+        if self.document_cache is not None:
+            return self.document_cache.get_outline(self.outline_depth, self.render_outline)
+        return self.render_outline()
+
+    def render_outline(self):
 
-        outline = self.doc_reader.get_outline_root()
+        outline = self.doc_reader.get_outline_root(max_depth=self.outline_depth)
 
         xml_string = ET.tostring(outline, encoding="unicode", method="xml")
         xml_string = clean_xml_string(xml_string)
@@ -48,17 +246,71 @@ class DocAgent:
         )
         return xml_string
 
-    def run_actor(self, question, memory, tools=available_tools):
+    def get_actor_messages(self, question, memory, instructions=""):
         xml_string = self.get_outline()
         initial_prompt = actor_prompt_template.format(
             document_outline=xml_string, question=question, memory=memory
         )
+        if self.outline_depth is not None:
+            initial_prompt = initial_prompt + collapsed_outline_note
+        initial_prompt = initial_prompt + instructions
 
         initial_messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": initial_prompt},
         ]
-        final_response, messages = self.run_agent(initial_messages, tools=tools)
+        return initial_messages
+
+    def get_actor_request(self, question, memory, tools=available_tools, instructions=""):
+        # body of the first actor completion request, e.g. for submission through a batch API
+        return {
+            "model": self.get_model("actor"),
+            "messages": self.get_actor_messages(question, memory, instructions),
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "tools": self.get_tools(tools),
+            "tool_choice": "auto",
+        }
+
+    def get_model(self, phase, escalated=False):
+        if self.model_router is None:
+            return self.model_id
+        return self.model_router.get_model(phase, escalated)
+
+    def get_tools(self, tools):
+        if self.corpus_index is not None and corpus_search_tool_description not in tools:
+            return tools + [corpus_search_tool_description]
+        return tools
+
+    def run_actor(
+        self,
+        question,
+        memory,
+        tools=available_tools,
+        first_response=None,
+        instructions="",
+        previous_messages=None,
+        escalated=False,
+    ):
+        if previous_messages is not None:
+            # continue the actor conversation of an earlier question about the same document
+            initial_messages = get_api_messages(previous_messages)
+            initial_messages.append(
+                {
+                    "role": "user",
+                    "content": follow_up_question_template.format(question=question, memory=memory)
+                    + instructions,
+                }
+            )
+        else:
+            initial_messages = self.get_actor_messages(question, memory, instructions)
+        final_response, messages = self.run_agent(
+            initial_messages,
+            tools=tools,
+            first_response=first_response,
+            checkpoint_key="actor_escalated" if escalated else "actor",
+            model_id=self.get_model("actor", escalated),
+        )
         return final_response, messages
 
     def run_reviewer(
@@ -67,22 +319,21 @@ class DocAgent:
         initial_prompt=reviewer_prompt,
         tools=available_tools,
         extract_regex=r"<final_result>(.*)</final_result>",
+        max_round=10,
+        escalated=False,
     ):
 
-        messages = []
-
-        for item in initial_messages:
-            # remove id, token_usage
-            if "model" in item:  # from assistant
-                messages.append(item["choices"][0]["message"])
-
-            else:  # others
-                messages.append(item)
-
+        # remove id, token_usage
+        messages = get_api_messages(initial_messages)
         messages.append({"role": "user", "content": initial_prompt})
 
         final_response, messages = self.run_agent(
-            messages, tools=tools, extract_regex=extract_regex
+            messages,
+            tools=tools,
+            extract_regex=extract_regex,
+            max_round=max_round,
+            checkpoint_key="reviewer_escalated" if escalated else "reviewer",
+            model_id=self.get_model("reviewer", escalated),
         )
         return final_response, messages
 
@@ -92,24 +343,21 @@ class DocAgent:
         memory,
         tools=available_tools,
         extract_regex=r"<updated_guideline>(.*)</updated_guideline>",
+        prompt_template=reflection_prompt_template,
     ):
 
-        initial_prompt = reflection_prompt_template.format(memory=memory)
-
-        messages = []
-
-        for item in initial_messages:
-            # remove id, token_usage
-            if "model" in item:  # from assistant
-                messages.append(item["choices"][0]["message"])
-
-            else:  # others
-                messages.append(item)
+        initial_prompt = prompt_template.format(memory=memory)
 
+        # remove id, token_usage
+        messages = get_api_messages(initial_messages)
         messages.append({"role": "user", "content": initial_prompt})
 
         memory_new, messages_memory = self.run_agent(
-            messages, tools=tools, extract_regex=extract_regex
+            messages,
+            tools=tools,
+            extract_regex=extract_regex,
+            checkpoint_key="reflection",
+            model_id=self.get_model("reflection"),
         )
         return memory_new, messages_memory
 
@@ -120,98 +368,432 @@ class DocAgent:
         extract_regex=r"<final_result>(.*)</final_result>",
         max_num_tool=10,
         max_round=10,
+        first_response=None,
+        checkpoint_key=None,
+        model_id=None,
     ):
+        """
+        Call the LLM and its tools in a loop until it answers without calling tools.
+
+        With a checkpoint_path, the new messages are appended after every completed round under
+        checkpoint_key, and a later call with the same key and initial messages continues from
+        the last saved round, or returns the saved answer, instead of calling the LLM again.
+        Errors of the LLM API that remain after the retries in create_completion are raised,
+        the saved rounds are kept for the next attempt.
+        """
 
         messages = initial_messages
         messages_full = messages.copy()
+        # messages is extended in place, the checkpoint holds the messages after the initial ones
+        num_initial = len(initial_messages)
+        num_round = 0
+        tools = self.get_tools(tools)
+        self.tool_names = [tool["function"]["name"] for tool in tools]
+        model_id = model_id or self.model_id
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model_id,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                tools=tools,
-                tool_choice="auto",
+        fingerprint = self.get_checkpoint_fingerprint(initial_messages)
+        checkpoint = self.load_checkpoint(checkpoint_key, fingerprint)
+        if checkpoint is not None:
+            messages_full = messages_full + checkpoint["messages"]
+        if checkpoint is not None and checkpoint["final_response"] is not None:
+            last_message = get_api_messages(messages_full[-1:])[0]
+            self.record_run_stats(
+                checkpoint_key, model_id, checkpoint["num_round"], max_round,
+                get_field(last_message, "content"), extract_regex,
             )
+            return checkpoint["final_response"], messages_full
 
-            # limit the number of tools called in one turn
-            if (
-                response.choices[0].message.tool_calls
-                and len(response.choices[0].message.tool_calls) > max_num_tool
-            ):
-                response.choices[0].message.tool_calls = response.choices[
-                    0
-                ].message.tool_calls[:max_num_tool]
+        if checkpoint is not None:
+            messages = get_api_messages(messages_full)
+            response = ChatCompletion.model_validate(messages_full[-1])
+            num_round = checkpoint["num_round"]
+            print(f"Resume {checkpoint_key} loop from round {num_round}")
+            self.report_progress(
+                {"event": "resume", "phase": checkpoint_key, "round": num_round}
+            )
+        else:
+            if first_response is not None:
+                # the first completion was already obtained, e.g. from a batch API
+                if isinstance(first_response, dict):
+                    first_response = ChatCompletion.model_validate(first_response)
+                response = first_response
+            else:
+                response = self.create_completion(messages, tools, "auto", model_id)
+            self.limit_tool_calls(response, max_num_tool)
 
             messages_full.append(response.to_dict())
             messages.append(response.choices[0].message)
+            self.save_checkpoint(checkpoint_key, fingerprint, messages_full[num_initial:], num_round)
+            self.report_progress(
+                {"event": "response", "round": 0, "tool_calls": self.get_tool_names(response)}
+            )
 
-            # tools are callled
-            num_round = 0
-            while response.choices[0].message.tool_calls:
-                # Wait to reduce rate limit errors
-                time.sleep(self.tool_call_wait_time)
-
-                # LLM can call multiple functions in one turn
-                tool_response_tool, tool_response_user = [], []
-                for tool_call in response.choices[0].message.tool_calls:
-                    tool_response = self.get_reply_for_tool(
-                        {
-                            "type": "tool_use",
-                            "id": tool_call.id,
-                            "name": tool_call.function.name,
-                            "input": json.loads(tool_call.function.arguments),
-                        }
-                    )
-                    if len(tool_response) > 1:  # tool reply with image
-                        tool_response_tool.append(tool_response[0])
-                        tool_response_user.extend(tool_response[1:])
-                    else:
-                        tool_response_tool.extend(tool_response)
-                # tool calls must follow by tool response
-                messages.extend(tool_response_tool + tool_response_user)
-                messages_full.extend(tool_response_tool + tool_response_user)
-
-                if num_round >= max_round:
-                    tool_choice = "none"
-                    print("Exceed max_round, stop calling tools")
+        # tools are callled
+        while response.choices[0].message.tool_calls:
+            # Wait to reduce rate limit errors
+            time.sleep(self.tool_call_wait_time)
+
+            # LLM can call multiple functions in one turn
+            tool_response_tool, tool_response_user = [], []
+            tool_memo = self.get_tool_memo(messages)
+            for tool_call in response.choices[0].message.tool_calls:
+                tool_response, is_error = self.run_tool(tool_call, tool_memo)
+                if is_error:
+                    # keeps the call out of the tool memo of later rounds and loops
+                    tool_response[0]["is_error"] = True
+                if len(tool_response) > 1:  # tool reply with image
+                    tool_response_tool.append(tool_response[0])
+                    tool_response_user.extend(tool_response[1:])
                 else:
-                    tool_choice = "auto"
-                response = self.client.chat.completions.create(
-                    model=self.model_id,
+                    tool_response_tool.extend(tool_response)
+            # tool calls must follow by tool response
+            messages.extend(tool_response_tool + tool_response_user)
+            messages_full.extend(tool_response_tool + tool_response_user)
+
+            if num_round >= max_round:
+                tool_choice = "none"
+                print("Exceed max_round, stop calling tools")
+            else:
+                tool_choice = "auto"
+            response = self.create_completion(messages, tools, tool_choice, model_id)
+            self.limit_tool_calls(response, max_num_tool)
+
+            messages_full.append(response.to_dict())
+            messages.append(response.choices[0].message)
+            num_round += 1
+            self.save_checkpoint(checkpoint_key, fingerprint, messages_full[num_initial:], num_round)
+            self.report_progress(
+                {
+                    "event": "response",
+                    "round": num_round,
+                    "tool_calls": self.get_tool_names(response),
+                }
+            )
+
+        match_result = re.search(
+            extract_regex, response.choices[0].message.content or "", re.DOTALL
+        )
+        if match_result is not None:
+            final_response = match_result.group(1)
+        else:
+            final_response = response.choices[0].message.content or ""
+        final_response = final_response.strip()
+        self.record_run_stats(
+            checkpoint_key, model_id, num_round, max_round,
+            response.choices[0].message.content, extract_regex,
+        )
+
+        self.save_checkpoint(
+            checkpoint_key, fingerprint, messages_full[num_initial:], num_round, final_response
+        )
+        return final_response, messages_full
+
+    def record_run_stats(self, checkpoint_key, model_id, num_round, max_round, content, extract_regex):
+        # the last round after max_round is answered without tools, see run_agent
+        self.run_stats[checkpoint_key] = {
+            "model": model_id,
+            "num_round": num_round,
+            "hit_max_round": num_round > max_round,
+            "extracted": re.search(extract_regex, content or "", re.DOTALL) is not None,
+        }
+
+    @staticmethod
+    def limit_tool_calls(response, max_num_tool):
+        # limit the number of tools called in one turn
+        if (
+            response.choices[0].message.tool_calls
+            and len(response.choices[0].message.tool_calls) > max_num_tool
+        ):
+            response.choices[0].message.tool_calls = response.choices[
+                0
+            ].message.tool_calls[:max_num_tool]
+
+    def get_tool_memo(self, messages):
+        """
+        Map the tool calls answered so far in the conversation to the id of their reply.
+
+        The memo is rebuilt from the messages, so the reviewer and reflection loops also find
+        the calls of the actor. Error replies (marked is_error), replies pointing to an earlier
+        call and replies that were sent as stubs in the last request (see ContextWindowManager)
+        are left out, those calls run again.
+        """
+        if not self.dedupe_tool_calls:
+            return None
+        evicted = set()
+        if self.context_window is not None:
+            evicted = self.context_window.evicted_tool_call_ids
+        call_keys, tool_memo = dict(), dict()
+        for message in messages:
+            role = get_field(message, "role")
+            if role == "assistant":
+                for tool_call in get_field(message, "tool_calls") or []:
+                    function = get_field(tool_call, "function")
+                    try:
+                        tool_input = json.loads(get_field(function, "arguments"))
+                    except (TypeError, json.JSONDecodeError):
+                        continue
+                    key = get_tool_call_key(get_field(function, "name"), tool_input)
+                    if key is not None:
+                        call_keys[get_field(tool_call, "id")] = key
+            elif role == "tool":
+                tool_call_id = message.get("tool_call_id")
+                content = message.get("content")
+                if (
+                    tool_call_id in call_keys
+                    and tool_call_id not in evicted
+                    and isinstance(content, str)
+                    and not message.get("is_error")
+                    and " is the same as the earlier call " not in content
+                ):
+                    tool_memo.setdefault(call_keys[tool_call_id], tool_call_id)
+        return tool_memo
+
+    def run_tool(self, tool_call, tool_memo=None):
+        """
+        Return the reply messages of a tool call and whether it failed. Errors of a single
+        tool call are returned to the LLM instead of ending the loop, and their replies are
+        neither memoized nor shared through the document cache.
+        """
+        try:
+            tool_input = json.loads(tool_call.function.arguments)
+        except json.JSONDecodeError as e:
+            result_text = f"The arguments of {tool_call.function.name} are not valid JSON ({str(e)}): {tool_call.function.arguments}. Please try again."
+            return self.package_content(result_text, tool_use_id=tool_call.id), True
+
+        key = get_tool_call_key(tool_call.function.name, tool_input)
+        if tool_memo is not None and key in tool_memo:
+            result_text = f"This {tool_call.function.name} call is the same as the earlier call {tool_memo[key]}, its output is unchanged and can be found in the reply to that call above."
+            self.report_progress(
+                {"event": "tool_dedup", "tool": tool_call.function.name, "earlier_call": tool_memo[key]}
+            )
+            return self.package_content(result_text, tool_use_id=tool_call.id), False
+
+        if self.document_cache is not None and key is not None:
+            tool_response = self.document_cache.get_reply(key, tool_call.id)
+            if tool_response is not None:
+                self.report_progress({"event": "tool_cache_hit", "tool": tool_call.function.name})
+                if tool_memo is not None:
+                    tool_memo.setdefault(key, tool_call.id)
+                return tool_response, False
+
+        try:
+            tool_response, is_error = self.get_reply_for_tool(
+                {
+                    "type": "tool_use",
+                    "id": tool_call.id,
+                    "name": tool_call.function.name,
+                    "input": tool_input,
+                }
+            )
+        except Exception as e:
+            print(traceback.format_exc())
+            result_text = f"Error in running {tool_call.function.name} with arguments {tool_call.function.arguments}: {type(e).__name__}: {str(e)}. Please try again."
+            return self.package_content(result_text, tool_use_id=tool_call.id), True
+        # a repeated call in the same turn refers to this reply
+        if key is not None and not is_error:
+            if tool_memo is not None:
+                tool_memo.setdefault(key, tool_call.id)
+            if self.document_cache is not None:
+                self.document_cache.put_reply(key, tool_response)
+        return tool_response, is_error
+
+    def create_completion(self, messages, tools, tool_choice, model_id=None):
+        if self.context_window is not None:
+            # send older tool outputs as stubs once the conversation exceeds the budget
+            messages = self.context_window.compact(messages)
+        messages = get_request_messages(messages)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.client.chat.completions.create(
+                    model=model_id or self.model_id,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
                     tools=tools,
                     tool_choice=tool_choice,
                 )
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                delay = get_retry_delay(e, attempt, self.retry_delay)
+                print(
+                    f"{type(e).__name__}: {str(e)}, retry in {delay:.1f}s ({attempt + 1}/{self.max_retries})"
+                )
+                self.report_progress(
+                    {"event": "retry", "error": type(e).__name__, "attempt": attempt + 1}
+                )
+                time.sleep(delay)
 
-                # limit the number of tools called in one turn
-                if (
-                    response.choices[0].message.tool_calls
-                    and len(response.choices[0].message.tool_calls) > max_num_tool
-                ):
-                    response.choices[0].message.tool_calls = response.choices[
-                        0
-                    ].message.tool_calls[:max_num_tool]
-                messages_full.append(response.to_dict())
-                messages.append(response.choices[0].message)
-                num_round += 1
-
-            match_result = re.search(
-                extract_regex, response.choices[0].message.content, re.DOTALL
-            )
-            if match_result is not None:
-                final_response = match_result.group(1)
-            else:
-                final_response = response.choices[0].message.content
+    def get_checkpoint_fingerprint(self, initial_messages):
+        if self.checkpoint_path is None:
+            return None
+        data = json.dumps(initial_messages, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
-            return final_response.strip(), messages_full
+    def read_checkpoints(self):
+        """
+        Return checkpoint_key -> saved state, rebuilt from the lines of the checkpoint file.
 
-        except Exception as e:
-            print(traceback.format_exc())
-            return str(e), messages_full
+        Each line holds the messages of a loop after its initial messages from offset on, so
+        a round only appends its new messages; a line with offset 0 starts the loop over.
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return {}
+        checkpoints = dict()
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # a crash while appending leaves a truncated last line
+                    print(f"Ignore unreadable line of checkpoint {self.checkpoint_path}")
+                    break
+                checkpoint = checkpoints.get(item["key"])
+                messages = checkpoint["messages"][: item["offset"]] if checkpoint is not None else []
+                checkpoints[item["key"]] = {
+                    "fingerprint": item["fingerprint"],
+                    "num_round": item["num_round"],
+                    "final_response": item["final_response"],
+                    "messages": messages + item["messages"],
+                }
+        return checkpoints
+
+    def load_checkpoint(self, checkpoint_key, fingerprint):
+        """Return the saved state of the loop, if it was started with the same initial messages."""
+        if self.checkpoint_path is None or checkpoint_key is None:
+            return None
+        self.checkpoint_offsets[checkpoint_key] = 0
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        # also drops a line truncated by a crash, which the next rounds would be appended to
+        self.compact_checkpoints()
+        checkpoint = self.read_checkpoints().get(checkpoint_key)
+        if checkpoint is None:
+            return None
+        if checkpoint["fingerprint"] != fingerprint:
+            # e.g. the prompt memory changed, the saved rounds answer a different prompt
+            print(f"Discard checkpoint of {checkpoint_key} loop, its initial messages differ")
+            return None
+        self.checkpoint_offsets[checkpoint_key] = len(checkpoint["messages"])
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint_key, fingerprint, messages, num_round, final_response=None):
+        """Append the messages of the loop after its initial ones that are not in the file yet."""
+        if self.checkpoint_path is None or checkpoint_key is None:
+            return
+        offset = self.checkpoint_offsets.get(checkpoint_key, 0)
+        item = {
+            "key": checkpoint_key,
+            "fingerprint": fingerprint,
+            "offset": offset,
+            "num_round": num_round,
+            "final_response": final_response,
+            "messages": messages[offset:],
+        }
+        with open(self.checkpoint_path, "a") as f:
+            f.write(json.dumps(item) + "\n")
+        self.checkpoint_offsets[checkpoint_key] = len(messages)
+        if final_response is not None:
+            self.compact_checkpoints()
+
+    def compact_checkpoints(self):
+        # one line per finished or unfinished loop, written to a temporary file first so that
+        # a crash never leaves a truncated checkpoint
+        lines = [
+            json.dumps({"key": key, "offset": 0, **checkpoint})
+            for key, checkpoint in self.read_checkpoints().items()
+        ]
+        with open(self.checkpoint_path + ".tmp", "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def render_section(self, section_id):
+        section_root = self.doc_reader.get_section_content(section_id, truncate_tables=True)
+
+        xml_string = ET.tostring(section_root, encoding="unicode", method="xml")
+        xml_string = clean_xml_string(xml_string)
+        dom = xml.dom.minidom.parseString(xml_string)
+        xml_string = dom.toprettyxml(indent="  ", newl="\n").split("\n", 1)[1]
+        return xml_string
+
+    def get_prefetched(self, key, function, *args):
+        # serve from the prefetch cache if the content was predicted, otherwise compute it now
+        with self.prefetch_lock:
+            future = self.prefetch_futures.get(key)
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()
+            except Exception:
+                pass  # retry below and surface the error from the regular path
+        return function(*args)
+
+    def prefetch(self, keys):
+        """
+        Render sections and encode page images in the background while the LLM is called.
+
+        keys are ordered by likelihood of being requested next. Pending tasks from earlier
+        predictions that are not predicted again are cancelled, and only the most recent
+        max_prefetch_cache results are kept.
+        """
+        if self.prefetch_top_k <= 0:
+            return
+        keys = list(dict.fromkeys(keys))
+        with self.prefetch_lock:
+            for key, future in list(self.prefetch_futures.items()):
+                if key not in keys and future.cancel():
+                    del self.prefetch_futures[key]
+
+            for key in keys:
+                if key in self.prefetch_futures:
+                    self.prefetch_futures[key] = self.prefetch_futures.pop(key)
+                    continue
+                if key[0] == "section":
+                    function = self.render_section
+                else:
+                    function = self.doc_reader.get_page_image
+                self.prefetch_futures[key] = get_prefetch_executor().submit(
+                    function, key[1]
+                )
+
+            while len(self.prefetch_futures) > self.max_prefetch_cache:
+                key = next(iter(self.prefetch_futures))
+                self.prefetch_futures.pop(key).cancel()
+
+    def prefetch_for_search(self, search_root):
+        # sections and pages of the top search hits are usually requested next
+        section_ids, page_nums = [], []
+        for item in search_root:
+            section_id = item.get("section_id")
+            if section_id in self.doc_reader.section_dict and section_id not in section_ids:
+                section_ids.append(section_id)
+            page_num = int(float(item.get("page_num")))
+            if 1 <= page_num <= self.doc_reader.num_page and page_num not in page_nums:
+                page_nums.append(page_num)
+        keys = [("section", section_id) for section_id in section_ids[: self.prefetch_top_k]]
+        keys += [("page_image", page_num) for page_num in page_nums[: self.prefetch_top_k]]
+        self.prefetch(keys)
+
+    def prefetch_for_section(self, section_id):
+        # after reading a section, the agent often checks its pages visually
+        section = self.doc_reader.section_dict[section_id]
+        start_page_num = int(float(section.get("start_page_num")))
+        end_page_num = int(float(section.get("end_page_num", start_page_num)))
+        end_page_num = min(
+            end_page_num, self.doc_reader.num_page, start_page_num + self.prefetch_top_k - 1
+        )
+        self.prefetch(
+            [("page_image", page_num) for page_num in range(start_page_num, end_page_num + 1)]
+        )
+
+    @staticmethod
+    def get_tool_names(response):
+        tool_calls = response.choices[0].message.tool_calls or []
+        return [tool_call.function.name for tool_call in tool_calls]
 
     def package_content(self, item, tool_use_id=None, image_content=None):
         if image_content is not None:  # tool reply with text and image
@@ -240,6 +822,7 @@ class DocAgent:
             return [{"role": "tool", "content": content, "tool_call_id": tool_use_id}]
 
     def get_reply_for_tool(self, item, max_search_results=24, max_page_images=20):
+        # returns the reply messages and whether the call failed, e.g. on an unknown section_id
 
         if item["type"] == "tool_use":
             tool_use_id = item["id"]
@@ -266,25 +849,22 @@ class DocAgent:
                         1
                     ]
                     result_text = result_text + xml_string
+                    self.prefetch_for_search(search_root)
 
-                return self.package_content(result_text, tool_use_id=tool_use_id)
+                return self.package_content(result_text, tool_use_id=tool_use_id), False
 
             elif item["name"] == "get_section_content":
+                is_error = False
                 section_id = str(item["input"]["section_id"])
                 if section_id not in self.doc_reader.section_dict.keys():
                     result_text = f"The section_id {section_id} is not presented in the document, here is the full list of available section_id: {list(self.doc_reader.section_dict.keys())}. Please try again."
+                    is_error = True
 
                 else:
-                    section_root = self.doc_reader.get_section_content(section_id)
-
-                    xml_string = ET.tostring(
-                        section_root, encoding="unicode", method="xml"
+                    xml_string = self.get_prefetched(
+                        ("section", section_id), self.render_section, section_id
                     )
-                    xml_string = clean_xml_string(xml_string)
-                    dom = xml.dom.minidom.parseString(xml_string)
-                    xml_string = dom.toprettyxml(indent="  ", newl="\n").split("\n", 1)[
-                        1
-                    ]
+                    self.prefetch_for_section(section_id)
                     if len(xml_string) > 30000:
                         xml_string = (
                             xml_string[:30000]
@@ -300,7 +880,99 @@ class DocAgent:
                             + xml_string
                         )
 
-                return self.package_content(result_text, tool_use_id=tool_use_id)
+                return self.package_content(result_text, tool_use_id=tool_use_id), is_error
+
+            elif item["name"] == "expand_outline":
+                is_error = False
+                section_id = str(item["input"]["section_id"])
+                depth = max(1, int(item["input"].get("depth", 1)))
+                if section_id not in self.doc_reader.section_dict.keys():
+                    result_text = f"The section_id {section_id} is not presented in the document, here is the full list of available section_id: {list(self.doc_reader.section_dict.keys())}. Please try again."
+                    is_error = True
+
+                else:
+                    section_outline = self.doc_reader.get_section_outline(section_id, depth)
+                    xml_string = ET.tostring(section_outline, encoding="unicode", method="xml")
+                    xml_string = clean_xml_string(xml_string)
+                    dom = xml.dom.minidom.parseString(xml_string)
+                    xml_string = (
+                        dom.toprettyxml(indent="  ", newl="\n")
+                        .split("\n", 1)[1]
+                        .replace("&quot;", "")
+                    )
+                    if len(xml_string) > 30000:
+                        xml_string = (
+                            xml_string[:30000]
+                            + "\n...The outline is too long. Try a smaller depth or expand the sub sections."
+                        )
+                    result_text = f"Here is the outline of Section {section_id}:\n" + xml_string
+
+                return self.package_content(result_text, tool_use_id=tool_use_id), is_error
+
+            elif item["name"] == "query_table":
+                is_error = False
+                table_id = str(item["input"]["table_id"])
+                columns = item["input"].get("columns") or None
+                if isinstance(columns, str):
+                    columns = [column.strip() for column in columns.split(",")]
+                row_filter = item["input"].get("row_filter") or None
+                limit = min(max(1, int(item["input"].get("limit") or 20)), 100)
+                table = self.doc_reader.table_dict.get(table_id)
+                if table is None:
+                    result_text = f"The table_id {table_id} is not presented in the document, here is the full list of available table_id: {list(self.doc_reader.table_dict.keys())}. Please try again."
+                    is_error = True
+
+                else:
+                    try:
+                        csv_text, num_matches = table.query(columns, row_filter, limit)
+                        result_text = f"Table {table_id} has {table.num_rows} rows and the columns {table.columns}. "
+                        if num_matches > limit:
+                            result_text += f"{num_matches} rows match, the first {limit} are listed below:\n"
+                        else:
+                            result_text += f"{num_matches} rows match, listed below:\n"
+                        result_text += csv_text
+                    except TableQueryError as e:
+                        result_text = f"{e}. Please try again."
+                        is_error = True
+
+                return self.package_content(result_text, tool_use_id=tool_use_id), is_error
+
+            elif item["name"] == "corpus_search" and self.corpus_index is not None:
+                query = str(item["input"]["query"])
+                results = self.corpus_index.search(query, max_docs=max_search_results // 2)
+                if len(results) == 0:
+                    result_text = f"We didn't find any document that contains the words of {query}"
+
+                else:
+                    current_doc_id = os.path.basename(os.path.normpath(self.doc_reader.data_path))
+                    search_root = ET.Element("Corpus_Search_Result")
+                    for result in results:
+                        document = ET.SubElement(
+                            search_root,
+                            "Document",
+                            doc_id=result["doc_id"],
+                            matched_words=str(result["num_terms"]),
+                        )
+                        for section in result["sections"]:
+                            # the reading tools only open the current document, other documents
+                            # get no section ids, which would name sections of the current one
+                            attributes = {"pages": ",".join(str(page) for page in section["pages"])}
+                            if result["doc_id"] == current_doc_id:
+                                attributes["section_id"] = section["section_id"]
+                            section_item = ET.SubElement(document, "Section", **attributes)
+                            section_item.text = section["heading"]
+                    xml_string = ET.tostring(search_root, encoding="unicode", method="xml")
+                    xml_string = clean_xml_string(xml_string)
+                    dom = xml.dom.minidom.parseString(xml_string)
+                    xml_string = dom.toprettyxml(indent="  ", newl="\n").split("\n", 1)[1]
+                    result_text = (
+                        f"We found {len(results)} documents that contain words of {query}, best first "
+                        f"(the current document is {current_doc_id}). The other documents cannot be "
+                        f"opened, the section and page numbers of the other tools refer to the current "
+                        f"document only:\n" + xml_string
+                    )
+
+                return self.package_content(result_text, tool_use_id=tool_use_id), False
 
             elif item["name"] == "get_page_images":
                 start_page_num = int(item["input"]["start_page_num"])
@@ -330,7 +1002,7 @@ class DocAgent:
                     return self.package_content(
                         result_text + "Please try again",
                         tool_use_id=tool_use_id,
-                    )
+                    ), True
 
                 else:
                     image_content = []
@@ -339,8 +1011,10 @@ class DocAgent:
                         start_page_num,
                         min(end_page_num + 1, start_page_num + max_page_images + 1),
                     ):
-                        media_type, base64_image, error = (
-                            self.doc_reader.get_page_image(page_num)
+                        media_type, base64_image, error = self.get_prefetched(
+                            ("page_image", page_num),
+                            self.doc_reader.get_page_image,
+                            page_num,
                         )
                         if error is not None:
                             raise Exception(
@@ -355,14 +1029,14 @@ class DocAgent:
                         result_text,
                         tool_use_id=tool_use_id,
                         image_content=image_content,
-                    )
+                    ), False
 
             elif item["name"] == "get_image":
                 image_id = str(item["input"]["image_id"])
                 if image_id not in self.doc_reader.image_path_dict:
                     result_text = f"The image_id {image_id} is not presented in the document, here is the full list of available image_id: {list(self.doc_reader.image_path_dict.keys())}. Please try again"
 
-                    return self.package_content(result_text, tool_use_id=tool_use_id)
+                    return self.package_content(result_text, tool_use_id=tool_use_id), True
 
                 else:
                     media_type, base64_image, error = self.doc_reader.get_image(
@@ -378,14 +1052,14 @@ class DocAgent:
                         result_text,
                         tool_use_id=tool_use_id,
                         image_content=[[media_type, base64_image]],
-                    )
+                    ), False
 
             elif item["name"] == "get_table_image":
                 table_id = str(item["input"]["table_id"])
                 if table_id not in self.doc_reader.table_image_path_dict:
                     result_text = f"The table {table_id} doesn't have a corresponding image, here is the full list of table_id that companies an image: {list(self.doc_reader.table_image_path_dict.keys())}. Please try again."
 
-                    return self.package_content(result_text, tool_use_id=tool_use_id)
+                    return self.package_content(result_text, tool_use_id=tool_use_id), True
 
                 else:
                     media_type, base64_image, error = self.doc_reader.get_table_image(
@@ -401,8 +1075,32 @@ class DocAgent:
                         result_text,
                         tool_use_id=tool_use_id,
                         image_content=[[media_type, base64_image]],
-                    )
+                    ), False
+
+            elif item["name"] == "get_region_image":
+                page_num = int(item["input"]["page_num"])
+                bbox = str(item["input"]["bbox"])
+                if page_num < 1 or page_num > self.doc_reader.num_page:
+                    result_text = f"The page_num must be between 1 and max_page_num {str(self.doc_reader.num_page)}. Please try again."
+
+                    return self.package_content(result_text, tool_use_id=tool_use_id), True
+
+                media_type, base64_image, error = self.doc_reader.get_region_image(
+                    page_num, bbox
+                )
+                if error is not None:
+                    result_text = f"Error in extracting the region {bbox} of page {str(page_num)}: {str(error)}. Please try again."
+
+                    return self.package_content(result_text, tool_use_id=tool_use_id), True
+
+                result_text = f"Here is the image of the region {bbox} of page {str(page_num)}"
+
+                return self.package_content(
+                    result_text,
+                    tool_use_id=tool_use_id,
+                    image_content=[[media_type, base64_image]],
+                ), False
 
             else:
-                result_text = f"Tool {item["name"]} is not valid, here is the list of available tools: [search, get_section_data, get_page_images, get_image]. Please try again."
-                return self.package_content(result_text, tool_use_id=tool_use_id)
+                result_text = f"Tool {item['name']} is not valid, here is the list of available tools: [{', '.join(self.tool_names)}]. Please try again."
+                return self.package_content(result_text, tool_use_id=tool_use_id), True
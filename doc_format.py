@@ -0,0 +1,38 @@
+# helpers shared by the preprocessing (preprocess/2_process_extracted_data.py) and DocReader
+from array import array
+
+# columnar document format, written by ColumnarWriter and read by doc_reader.load_columnar
+COLUMNAR_MAGIC = b"DOCCOL"
+COLUMNAR_VERSION = 1
+# bytes per value of the array typecodes of the numeric columns
+COLUMN_ITEM_SIZES = {"B": 1, "i": 4, "I": 4, "f": 4}
+
+
+def make_column(typecode, values=()):
+    """Return an array for a numeric column, checking that its item size matches the format."""
+    column = array(typecode, values)
+    if column.itemsize != COLUMN_ITEM_SIZES[typecode]:
+        raise ValueError(
+            f"Array typecode {typecode} has {column.itemsize} bytes on this platform, "
+            f"the columnar format needs {COLUMN_ITEM_SIZES[typecode]}"
+        )
+    return column
+
+
+def is_bounds(bounds):
+    # missing bounds are None, or NaN once stored in a DataFrame
+    return isinstance(bounds, (list, tuple)) and len(bounds) == 4
+
+
+def merge_bounds(bounds, other_bounds):
+    """Return the box [x0, y0, x1, y1] enclosing both boxes, either of which may be missing."""
+    if not is_bounds(bounds):
+        return other_bounds if is_bounds(other_bounds) else None
+    if not is_bounds(other_bounds):
+        return bounds
+    return [
+        min(bounds[0], other_bounds[0]),
+        min(bounds[1], other_bounds[1]),
+        max(bounds[2], other_bounds[2]),
+        max(bounds[3], other_bounds[3]),
+    ]
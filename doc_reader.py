@@ -1,13 +1,25 @@
 import base64
 import copy
 import glob
+import io
+import json
+import math
 import os
+import re
+import struct
+import sys
+import threading
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from typing import Optional, Tuple
 
-import pandas as pd
 from PIL import Image
 
+from doc_format import (COLUMNAR_MAGIC, COLUMNAR_VERSION, is_bounds, make_column,
+                        merge_bounds)
+from table_store import Table
+
+
 
 def process_image(image_path: str) -> Tuple[str, str, Optional[str]]:
 
@@ -39,8 +51,11 @@ def process_image(image_path: str) -> Tuple[str, str, Optional[str]]:
             # save the image as compressed jpg
             compress_image_path = image_path[:-4] + "_compressed.jpg"
             if not os.path.exists(compress_image_path):
+                # write to a temporary file first so that concurrent readers never see a partial image
+                tmp_path = f"{compress_image_path}.{os.getpid()}.{threading.get_ident()}.tmp"
                 img = Image.open(image_path)
-                img.save(compress_image_path)
+                img.save(tmp_path, format="JPEG")
+                os.replace(tmp_path, compress_image_path)
 
             image_path = compress_image_path
             media_type = "image/jpeg"
@@ -58,6 +73,162 @@ def process_image(image_path: str) -> Tuple[str, str, Optional[str]]:
         return "", "", f"Error processing image: {str(e)}"
 
 
+def load_columnar(file_path):
+    """
+    Load the rows of a document from the columnar format without pandas.
+
+    Returns a list of dicts with the keys style, page, table_id, para_text, bounds and
+    attributes, see ColumnarWriter in preprocess/2_process_extracted_data.py for the layout.
+    """
+    with open(file_path, "rb") as f:
+        data = memoryview(f.read())
+
+    if bytes(data[: len(COLUMNAR_MAGIC)]) != COLUMNAR_MAGIC:
+        raise ValueError(f"{file_path} is not a columnar document file")
+    offset = len(COLUMNAR_MAGIC)
+    (version,) = struct.unpack_from("<H", data, offset)
+    if version != COLUMNAR_VERSION:
+        raise ValueError(f"Unsupported columnar format version {version} in {file_path}")
+    offset += 2
+
+    rows = []
+    while offset < len(data):
+        (header_length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(bytes(data[offset : offset + header_length]))
+        offset += header_length
+
+        columns = dict()
+        for name, column_type, num_bytes in header["columns"]:
+            payload = data[offset : offset + num_bytes]
+            offset += num_bytes
+            if column_type == "json":
+                columns[name] = json.loads(bytes(payload))
+            elif column_type == "utf8":
+                columns[name] = bytes(payload)
+            else:
+                values = make_column(column_type)
+                values.frombytes(payload)
+                if sys.byteorder == "big":
+                    values.byteswap()
+                columns[name] = values
+
+        styles, text_table = header["styles"], columns["text"]
+        text_offsets, bounds = columns["text_offsets"], columns["bounds"]
+        for index in range(header["num_rows"]):
+            text_kind = columns["text_kind"][index]
+            if text_kind == 1:
+                para_text = text_table[text_offsets[index] : text_offsets[index + 1]].decode(
+                    "utf-8"
+                )
+            elif text_kind == 2:
+                para_text = columns["assets"][columns["asset_index"][index]]
+            else:
+                para_text = None
+
+            row_bounds = list(bounds[4 * index : 4 * index + 4])
+            table_id = columns["table_id"][index]
+            rows.append(
+                {
+                    "style": styles[columns["style"][index]],
+                    "page": columns["page"][index],
+                    "table_id": table_id if table_id >= 0 else None,
+                    "para_text": para_text,
+                    "bounds": None if math.isnan(row_bounds[0]) else row_bounds,
+                    "attributes": columns["attributes"].get(str(index)),
+                }
+            )
+    return rows
+
+
+def load_data(data_path):
+    if os.path.exists(data_path + "/data.col"):
+        return load_columnar(data_path + "/data.col")
+
+    # documents preprocessed before the columnar format are stored as a pickled DataFrame
+    import pandas as pd
+
+    return pd.read_pickle(data_path + "/data.pkl").to_dict("records")
+
+
+def set_bbox(element, bounds):
+    if is_bounds(bounds):
+        element.set("bbox", ",".join("%.1f" % value for value in bounds))
+
+
+def find_boilerplate(data, page_sizes, margin=0.12, min_page_ratio=0.25, min_pages=3):
+    """
+    Return the indices of the rows that are running headers, footers or page numbers.
+
+    A text row is boilerplate if it lies in the top or bottom margin band of its page and the
+    same text, with digits ignored (page numbers, dates), is found in the same band on at
+    least min_page_ratio of the pages (and at least min_pages pages). Text repeated in the
+    body of the pages, such as the source line under charts, is kept.
+    """
+    occurrences = dict()
+    curr_page_num = 1
+    for index, row in enumerate(data):
+        if row["style"] == "Page_Start":
+            curr_page_num = row["table_id"]
+            continue
+        if row["style"] not in ["Normal", "Body Text", "List Paragraph", "Footnote"]:
+            continue
+        bounds = row.get("bounds")
+        if not is_bounds(bounds) or not isinstance(row["para_text"], str):
+            continue
+        page_height = page_sizes.get(str(curr_page_num), [612, 792])[1]
+        if bounds[1] >= page_height * (1 - margin):
+            band = "top"
+        elif bounds[3] <= page_height * margin:
+            band = "bottom"
+        else:
+            continue
+        text = re.sub(r"\d+", "#", " ".join(row["para_text"].split()).lower())
+        occurrences.setdefault((band, text), []).append((curr_page_num, index))
+
+    num_pages = len(set(row["table_id"] for row in data if row["style"] == "Page_Start"))
+    threshold = max(min_pages, min_page_ratio * num_pages)
+    boilerplate = set()
+    for rows in occurrences.values():
+        if len(set(page_num for page_num, _ in rows)) >= threshold:
+            boilerplate.update(index for _, index in rows)
+    return boilerplate
+
+
+def collapse_outline(parent, max_depth, depth=0):
+    # sections deeper than max_depth levels are summarized by the section at that level
+    for child in parent:
+        if child.tag != "Section":
+            continue
+        if depth + 1 < max_depth:
+            collapse_outline(child, max_depth, depth + 1)
+        else:
+            collapse_section(child)
+
+
+def collapse_section(section):
+    counts = {}
+    for node in section.iter():
+        if node is not section and node.tag in ["Section", "Paragraph", "CSV_Table", "Image"]:
+            counts[node.tag] = counts.get(node.tag, 0) + 1
+    if len(counts) == 0:
+        return
+
+    for child in list(section):
+        if child.tag != "Heading":
+            section.remove(child)
+    # the page span is already given by start_page_num and end_page_num
+    section.set("collapsed", "true")
+    for tag, name in [
+        ("Section", "num_subsections"),
+        ("Paragraph", "num_paragraphs"),
+        ("CSV_Table", "num_tables"),
+        ("Image", "num_images"),
+    ]:
+        if tag in counts:
+            section.set(name, str(counts[tag]))
+
+
 class DocReader:
     """
     A class to read and process document data, converting it into an XML structure.
@@ -65,8 +236,9 @@ class DocReader:
     -----------
     data_path : str
         The path to the directory containing the document data.
-    data : pandas.DataFrame
-        The data read from the pickle file.
+    data : list of dict
+        The rows of the document, read from the columnar file (or a legacy pickle file),
+        without the page headers and footers unless remove_boilerplate is False.
     root : xml.etree.ElementTree.Element
         The root element of the XML structure.
     image_count : int
@@ -81,29 +253,55 @@ class DocReader:
         Dictionary mapping image IDs to their file paths.
     table_image_path_dict : dict
         Dictionary mapping table IDs to their image file paths.
+    table_dict : dict
+        Dictionary mapping table IDs to their parsed rows and columns, see table_store.Table.
+    num_boilerplate_rows : int
+        The number of page header, footer and page number rows removed, see find_boilerplate.
+    max_table_rows : int
+        Tables with more rows are truncated in outlines, section contents and search results.
     num_page : int
         The number of pages in the document.
+    page_sizes : dict
+        Dictionary mapping page numbers to the page width and height in PDF points.
+    memory_size : int
+        Estimated memory footprint of the parsed document in bytes.
     Methods:
     --------
-    __init__(data_path):
+    __init__(data_path, max_section_depth=10, max_table_rows=20, remove_boilerplate=True):
         Initializes the DocReader with the given data path and processes the document data.
-    get_outline_root():
-        Returns a deep copy of the root element with the tag changed to "Outline" and paragraphs modified.
-    get_section_content(section_id):
-        Returns the XML element corresponding to the given section ID.
+    get_outline_root(max_depth=None):
+        Returns a deep copy of the root element with the tag changed to "Outline" and paragraphs modified,
+        optionally with sections below max_depth levels collapsed.
+    get_section_outline(section_id, depth):
+        Returns the outline of one section, with its subsections below depth levels collapsed.
+    get_section_content(section_id, truncate_tables=False):
+        Returns the XML element corresponding to the given section ID, optionally a copy with
+        long tables truncated.
     get_image(image_id):
         Returns the processed image for the given image ID.
     get_page_image(page_num):
         Returns the processed image for the given page number.
     get_table_image(table_id):
         Returns the processed image for the given table ID.
+    get_region_image(page_num, bbox):
+        Returns the processed image of the region of a page given by the bbox attribute of an element.
     search(key_word):
         Searches for the given keyword in the document and returns an XML element with the search results.
     """
 
-    def __init__(self, data_path, max_section_depth=10):
+    def __init__(self, data_path, max_section_depth=10, max_table_rows=20, remove_boilerplate=True):
         self.data_path = data_path
-        self.data = pd.read_pickle(self.data_path + "/data.pkl")
+        self.data = load_data(self.data_path)
+        self.page_sizes = dict()
+        if os.path.exists(self.data_path + "/page_sizes.json"):
+            with open(self.data_path + "/page_sizes.json") as f:
+                self.page_sizes = json.load(f)
+        self.num_boilerplate_rows = 0
+        if remove_boilerplate:
+            # running headers and footers would be merged into the paragraphs of every page
+            boilerplate = find_boilerplate(self.data, self.page_sizes)
+            self.data = [row for index, row in enumerate(self.data) if index not in boilerplate]
+            self.num_boilerplate_rows = len(boilerplate)
 
         prev_heading_num = 0
         self.root = ET.Element("Document")
@@ -114,13 +312,15 @@ class DocReader:
         self.section_dict = dict()
         self.image_path_dict = dict()
         self.table_image_path_dict = dict()
+        self.table_dict = dict()
         prev_section_id = ""  # root id
         self.num_page = len(glob.glob(self.data_path + "/page_images/*.png"))
         self.max_section_depth = max_section_depth
+        self.max_table_rows = max_table_rows
 
         index = 0
         curr_page_num = 1
-        if not self.data.iloc[0]["style"].startswith(
+        if not self.data[0]["style"].startswith(
             "Heading"
         ):  # if first element is not heading
             curr_section_id = "1"
@@ -138,7 +338,7 @@ class DocReader:
             prev_node = curr_node
 
         while index < len(self.data):
-            row = self.data.iloc[index]
+            row = self.data[index]
 
             if row["style"].startswith("Heading"):
                 curr_heading_num = int(row["style"].split()[1])
@@ -190,16 +390,19 @@ class DocReader:
                     else:
                         # view as paragraph to avoid too deep section
                         content = row["para_text"]
-                        while index + 1 < len(self.data) and self.data.iloc[index + 1][
+                        bounds = row.get("bounds")
+                        while index + 1 < len(self.data) and self.data[index + 1][
                             "style"
                         ] in ["Normal", "Body Text", "List Paragraph", "Footnote"]:
                             index += 1
-                            content = content + " " + self.data.iloc[index]["para_text"]
+                            content = content + " " + self.data[index]["para_text"]
+                            bounds = merge_bounds(bounds, self.data[index].get("bounds"))
 
                         para = ET.SubElement(
                             prev_node, "Paragraph", page_num=str(curr_page_num)
                         )
                         para.text = content
+                        set_bbox(para, bounds)
 
                         self.para_count += 1
                         index += 1
@@ -211,17 +414,20 @@ class DocReader:
             elif row["style"] in ["Normal", "Body Text", "List Paragraph", "Footnote"]:
                 curr_style = row["style"]
                 content = row["para_text"]
+                bounds = row.get("bounds")
                 while (
                     index + 1 < len(self.data)
-                    and self.data.iloc[index + 1]["style"] == curr_style
+                    and self.data[index + 1]["style"] == curr_style
                 ):
                     index += 1
-                    content = content + " " + self.data.iloc[index]["para_text"]
+                    content = content + " " + self.data[index]["para_text"]
+                    bounds = merge_bounds(bounds, self.data[index].get("bounds"))
 
                 para = ET.SubElement(
                     prev_node, "Paragraph", page_num=str(curr_page_num)
                 )
                 para.text = content
+                set_bbox(para, bounds)
 
                 self.para_count += 1
 
@@ -233,6 +439,7 @@ class DocReader:
                     image_id=str(self.image_count),
                     page_num=str(curr_page_num),
                 )
+                set_bbox(image, row.get("bounds"))
                 self.image_path_dict[str(self.image_count)] = os.path.basename(
                     item["path"]
                 )
@@ -244,7 +451,7 @@ class DocReader:
                 self.image_count += 1
 
             elif row["style"] == "Caption":
-                prev_row = self.data.iloc[index - 1]
+                prev_row = self.data[index - 1]
                 if prev_row["style"] == "Image":
                     caption = ET.SubElement(image, "Caption")
                 else:
@@ -263,8 +470,10 @@ class DocReader:
                     table_id=str(self.table_count),
                     page_num=str(curr_page_num),
                 )
+                set_bbox(table, row.get("bounds"))
 
                 table.text = row["para_text"]["content"]
+                self.table_dict[str(self.table_count)] = Table(str(self.table_count), table.text)
                 if "image_path" in row["para_text"]:
                     self.table_image_path_dict[str(self.table_count)] = row[
                         "para_text"
@@ -279,6 +488,7 @@ class DocReader:
 
                 para = ET.SubElement(prev_node, "Title", page_num=str(curr_page_num))
                 para.text = content
+                set_bbox(para, row.get("bounds"))
 
             else:
                 print("Uncovered style:", row["style"])
@@ -288,11 +498,47 @@ class DocReader:
             if stack[i][0].tag == "Section":
                 stack[i][0].set("end_page_num", str(curr_page_num))
 
+        # outlines of single sections for expand_outline, built on first use. The cache keeps
+        # at most as many elements as the document tree, in least-recently-used order
+        self.outline_sections = None
+        self.outline_cache = OrderedDict()
+        self.outline_cache_size = 0
+        self.max_outline_cache_size = sum(1 for _ in self.root.iter())
+        self.outline_lock = threading.Lock()
+
+        self.memory_size = self.estimate_memory_size()
+
+    def estimate_memory_size(self):
+        # rough size in bytes of the parsed document, used for cache budgeting
+        size = sys.getsizeof(self.data) + 250 * len(self.data)
+        tree_size = 0
+        for node in self.root.iter():
+            tree_size += 400  # element object, attribute dict and child list
+            if node.text is not None:
+                tree_size += sys.getsizeof(node.text)
+        # the tree, its outline copy for expand_outline and the outline cache bounded to its size
+        size += 3 * tree_size
+        for table in self.table_dict.values():
+            # the cells are strings of their own, next to the CSV text
+            size += sum(sys.getsizeof(values) + 60 * len(values) for values in table.values)
+        return size
+
+    def preview_table(self, element, keyword=None):
+        """Truncate the text of a copied CSV_Table element to a preview, see Table.preview."""
+        table = self.table_dict.get(element.get("table_id"))
+        if table is None:
+            return
+        text = table.preview(self.max_table_rows, keyword)
+        if text is not None:
+            element.set("num_rows", str(table.num_rows))
+            element.text = text
+
     def get_outline_root(
-        self, skip_para_after_page=100, disable_caption_after_page=False
+        self, skip_para_after_page=100, disable_caption_after_page=False, max_depth=None
     ):
         def iterator(parent):
             for child in reversed(parent):
+                child.attrib.pop("bbox", None)  # only needed to crop regions, not in the outline
                 if len(child) >= 1 and child.tag == "Section":
                     iterator(child)
                 if child.tag == "Paragraph":
@@ -308,6 +554,8 @@ class DocReader:
                         int(float(child.get("page_num"))) > skip_para_after_page
                     ):  # avoid too long outline
                         child.text = None
+                    else:
+                        self.preview_table(child)
                 if child.tag == "Image" and disable_caption_after_page:
                     if int(float(child.get("page_num"))) > disable_caption_after_page:
                         for sub_child in child:
@@ -321,11 +569,45 @@ class DocReader:
         root = copy.deepcopy(self.root)
         root.tag = "Outline"
         iterator(root)
+        if max_depth is not None:
+            collapse_outline(root, max_depth)
 
         return root
 
-    def get_section_content(self, section_id):
-        return self.section_dict[section_id]
+    def get_section_outline(self, section_id, depth=1):
+        """Return the outline of the section, cached per section_id and depth. Do not modify it."""
+        key = (section_id, depth)
+        with self.outline_lock:
+            if key in self.outline_cache:
+                self.outline_cache.move_to_end(key)
+                return self.outline_cache[key][0]
+            if self.outline_sections is None:
+                outline_root = self.get_outline_root()
+                self.outline_sections = {
+                    section.get("section_id"): section
+                    for section in outline_root.iter("Section")
+                }
+            section = copy.deepcopy(self.outline_sections[section_id])
+            collapse_outline(section, depth)
+            size = sum(1 for _ in section.iter())
+            self.outline_cache[key] = (section, size)
+            self.outline_cache_size += size
+            while self.outline_cache_size > self.max_outline_cache_size and len(self.outline_cache) > 1:
+                _, (_, evicted_size) = self.outline_cache.popitem(last=False)
+                self.outline_cache_size -= evicted_size
+            return section
+
+    def get_section_content(self, section_id, truncate_tables=False):
+        section = self.section_dict[section_id]
+        if not truncate_tables or not any(
+            self.table_dict[table.get("table_id")].num_rows > self.max_table_rows
+            for table in section.iter("CSV_Table")
+        ):
+            return section
+        section = copy.deepcopy(section)
+        for table in section.iter("CSV_Table"):
+            self.preview_table(table)
+        return section
 
     def get_image(self, image_id):
 
@@ -343,6 +625,46 @@ class DocReader:
         image_path = self.data_path + "/" + self.table_image_path_dict[table_id]
         return process_image(image_path)
 
+    def get_region_image(self, page_num, bbox, padding=6):
+        """
+        Crop a region of a page image. bbox is the "x0,y0,x1,y1" attribute of an element,
+        in PDF points with the origin at the bottom-left of the page.
+        """
+        try:
+            x0, y0, x1, y1 = [float(value) for value in str(bbox).split(",")]
+        except ValueError:
+            return "", "", f"Invalid bbox {bbox}, expected x0,y0,x1,y1"
+
+        index_string = "%04d" % (int(page_num) - 1)
+        image_path = self.data_path + "/page_images/page_" + index_string + ".png"
+        if not os.path.exists(image_path):
+            return "", "", "File not found"
+
+        try:
+            with Image.open(image_path) as image:
+                if str(page_num) in self.page_sizes:
+                    page_width, page_height = self.page_sizes[str(page_num)]
+                    scale = image.width / page_width
+                else:  # assume the default resolution of 144 dpi for the page images
+                    scale = 2.0
+                    page_height = image.height / scale
+
+                left = max(0, int((min(x0, x1) - padding) * scale))
+                right = min(image.width, int((max(x0, x1) + padding) * scale))
+                top = max(0, int((page_height - max(y0, y1) - padding) * scale))
+                bottom = min(image.height, int((page_height - min(y0, y1) + padding) * scale))
+                if right <= left or bottom <= top:
+                    return "", "", f"The bbox {bbox} is outside of page {page_num}"
+
+                region = image.crop((left, top, right, bottom))
+                output = io.BytesIO()
+                region.save(output, format="PNG")
+            base64_image = base64.b64encode(output.getvalue()).decode("utf-8")
+            return "image/png", base64_image, None
+
+        except Exception as e:
+            return "", "", f"Error processing image: {str(e)}"
+
     def search(self, key_word):
         key_word = key_word.lower()
 
@@ -376,7 +698,13 @@ class DocReader:
                         section_id=curr_section_id,
                         page_num=curr.get("page_num"),
                     )
+                    if curr.get("bbox") is not None:
+                        item.set("bbox", curr.get("bbox"))
                     item.text = curr.text
+                    if curr.tag == "CSV_Table":
+                        # only the header and the rows with the keyword
+                        item.set("table_id", curr.get("table_id"))
+                        self.preview_table(item, key_word)
 
             elif curr.tag == "Image":
                 keyword_found = False
@@ -398,3 +726,96 @@ class DocReader:
                         sub_item.text = child.text
 
         return result_root
+
+
+class DocReaderRegistry:
+    """
+    A process-wide cache of DocReader instances keyed by document path.
+
+    Readers handed out by the registry are shared between callers and threads, so they
+    must be treated as read-only: get_outline_root and search build new trees and are
+    safe to call concurrently, while elements returned by get_section_content must not
+    be modified. Readers are evicted in least-recently-used order once the estimated
+    memory of the cached readers exceeds max_memory_mb; the most recently loaded reader
+    is always kept.
+    """
+
+    def __init__(self, max_memory_mb=2048, **reader_kwargs):
+        self.max_memory_mb = max_memory_mb
+        self.reader_kwargs = reader_kwargs
+        self.readers = OrderedDict()
+        self.memory_size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+        self.loading_locks = dict()
+
+    def get(self, data_path):
+        key = os.path.abspath(data_path)
+        with self.lock:
+            reader = self.readers.get(key)
+            if reader is not None:
+                self.readers.move_to_end(key)
+                self.hits += 1
+                return reader
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+
+        # only one thread loads a given document, the others wait for it
+        with loading_lock:
+            with self.lock:
+                reader = self.readers.get(key)
+                if reader is not None:
+                    self.readers.move_to_end(key)
+                    self.hits += 1
+                    return reader
+                self.misses += 1
+
+            reader = DocReader(data_path, **self.reader_kwargs)
+
+            with self.lock:
+                self.readers[key] = reader
+                self.memory_size += reader.memory_size
+                self.loading_locks.pop(key, None)
+                self.evict()
+        return reader
+
+    def evict(self):
+        # caller must hold self.lock
+        max_memory_size = self.max_memory_mb * 1024 * 1024
+        while self.memory_size > max_memory_size and len(self.readers) > 1:
+            _, reader = self.readers.popitem(last=False)
+            self.memory_size -= reader.memory_size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.readers.clear()
+            self.memory_size = 0
+
+    def stats(self):
+        with self.lock:
+            num_request = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / num_request if num_request > 0 else 0.0,
+                "num_readers": len(self.readers),
+                "memory_mb": self.memory_size / 1024.0 / 1024.0,
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(max_memory_mb=None):
+    """Return the process-wide DocReaderRegistry, updating its memory budget if given."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DocReaderRegistry()
+        if max_memory_mb is not None:
+            with _registry.lock:
+                _registry.max_memory_mb = max_memory_mb
+                _registry.evict()
+        return _registry
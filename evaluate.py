@@ -0,0 +1,332 @@
+import argparse
+import importlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import review_policy
+
+parser = argparse.ArgumentParser(
+    description="Score run results and compare accuracy with cost and latency across runs"
+)
+parser.add_argument(
+    "result_dirs",
+    type=str,
+    nargs="+",
+    help="Save directories of run_experiment, one per configuration",
+)
+parser.add_argument(
+    "--raw-data-dir",
+    type=str,
+    default="./sample_data/",
+    help="Raw data directory with the sample.json answers",
+)
+parser.add_argument(
+    "--metrics",
+    type=str,
+    default="match,exact,f1,number",
+    help="Comma-separated metrics, built-in names or module:function for a custom metric",
+)
+parser.add_argument(
+    "--group-by",
+    type=str,
+    default=None,
+    help="Comma-separated config keys (e.g. review_policy,outline_depth) to group jobs by "
+    "instead of their result directory",
+)
+parser.add_argument(
+    "--prices",
+    type=str,
+    default=None,
+    help="JSON file mapping model names to USD per million input, cached input and output tokens",
+)
+parser.add_argument(
+    "--num-workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of processes reading and scoring results",
+)
+parser.add_argument(
+    "--output",
+    type=str,
+    default=None,
+    help="Write the per-job scores as JSON lines to this file",
+)
+
+# USD per million tokens, matched by prefix of the model name in the completions
+model_prices = {
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
+    "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+    "gpt-4.1-mini": {"input": 0.4, "cached_input": 0.1, "output": 1.6},
+    "gpt-4.1": {"input": 2.0, "cached_input": 0.5, "output": 8.0},
+}
+
+
+def exact_match(prediction, answer):
+    return float(review_policy.normalize_answer(prediction) == review_policy.normalize_answer(answer))
+
+
+def contains_match(prediction, answer):
+    return float(review_policy.answer_matches(prediction, answer))
+
+
+def token_f1(prediction, answer):
+    prediction_tokens = review_policy.normalize_answer(prediction).split()
+    answer_tokens = review_policy.normalize_answer(answer).split()
+    common = 0
+    remaining = list(answer_tokens)
+    for token in prediction_tokens:
+        if token in remaining:
+            remaining.remove(token)
+            common += 1
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(prediction_tokens), common / len(answer_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def get_numbers(text):
+    return [float(number.replace(",", "")) for number in re.findall(r"-?\d[\d,]*(?:\.\d+)?", str(text))]
+
+
+def number_match(prediction, answer, rel_tol=0.01):
+    # numeric answers within 1%, None (not scored) if the answer is not a number
+    answer_numbers = get_numbers(answer)
+    if len(answer_numbers) != 1:
+        return None
+    target = answer_numbers[0]
+    return float(
+        any(abs(number - target) <= rel_tol * max(abs(target), 1e-9) for number in get_numbers(prediction))
+    )
+
+
+# a metric maps prediction and answer to a score in [0, 1], or None if it does not apply
+metrics = {
+    "match": contains_match,
+    "exact": exact_match,
+    "f1": token_f1,
+    "number": number_match,
+}
+
+
+def get_metric(name):
+    if name in metrics:
+        return metrics[name]
+    if ":" in name:
+        module_name, function_name = name.split(":", 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    raise ValueError(f"Unknown metric {name}, use one of {list(metrics)} or module:function")
+
+
+def get_price(model, prices):
+    for name in sorted(prices, key=len, reverse=True):
+        if model.startswith(name):
+            return prices[name]
+    return None
+
+
+def get_usage(result, prices):
+    """
+    Sum token usage and cost over the completions of all phases of a job, including the
+    runs that were replaced by a run with the escalation model (see model_routing). The
+    actor messages of earlier questions in the same conversation (num_previous_messages) are
+    counted with their own jobs.
+    """
+    usage = {"num_calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+             "cost": 0.0, "cost_by_model": {}, "rounds": {}}
+    for phase in ["actor", "reviewer", "reflection"]:
+        num_round = 0
+        items = (result.get("escalated_messages") or {}).get(phase, [])
+        messages = result.get(phase + "_messages") or []
+        if phase == "actor":
+            messages = messages[result.get("num_previous_messages", 0) :]
+        for item in items + messages:
+            if "model" not in item:  # not from assistant
+                continue
+            message = item["choices"][0]["message"]
+            if message.get("tool_calls"):
+                num_round += 1
+            usage["num_calls"] += 1
+            item_usage = item.get("usage") or {}
+            prompt_tokens = item_usage.get("prompt_tokens", 0)
+            cached_tokens = (item_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+            completion_tokens = item_usage.get("completion_tokens", 0)
+            usage["prompt_tokens"] += prompt_tokens
+            usage["cached_tokens"] += cached_tokens
+            usage["completion_tokens"] += completion_tokens
+
+            price = get_price(item["model"], prices)
+            if price is None:
+                usage["cost"] = None
+                usage["cost_by_model"][item["model"]] = None
+                continue
+            cost = (
+                (prompt_tokens - cached_tokens) * price["input"]
+                + cached_tokens * price["cached_input"]
+                + completion_tokens * price["output"]
+            ) / 1e6
+            if usage["cost"] is not None:
+                usage["cost"] += cost
+            if usage["cost_by_model"].get(item["model"], 0.0) is not None:
+                usage["cost_by_model"][item["model"]] = usage["cost_by_model"].get(item["model"], 0.0) + cost
+        usage["rounds"][phase] = num_round
+    return usage
+
+
+def score_job(job):
+    """Read one result file and return its scores, usage and timing without the messages."""
+    path, group, raw_data_dir, sample_id, metric_names, prices = job
+    with open(path) as f:
+        result = json.load(f)
+    sample_id = result.get("sample_id") or sample_id
+    sample = None
+    if sample_id is not None and os.path.exists(os.path.join(raw_data_dir, sample_id, "sample.json")):
+        with open(os.path.join(raw_data_dir, sample_id, "sample.json")) as f:
+            sample = json.load(f)
+
+    record = {
+        "job": os.path.basename(path)[:-5],
+        "result_dir": os.path.dirname(path),
+        "group": group,
+        "sample_id": sample_id,
+        "config": result.get("config"),
+        "review_decision": (result.get("review") or {}).get("decision"),
+        "changed": result["reviewer_response"] != result["actor_response"],
+        "latency": (result.get("timing") or {}).get("total"),
+        "models": result.get("models"),
+        "escalations": result.get("escalations") or [],
+        "scores": {},
+    }
+    record.update(get_usage(result, prices))
+    if sample is not None and "answer" in sample:
+        for name in metric_names:
+            metric = get_metric(name)
+            record["scores"][name] = dict()
+            for response, key in [("actor", "actor_response"), ("final", "reviewer_response")]:
+                score = metric(result[key], sample["answer"])
+                record["scores"][name][response] = float(score) if score is not None else None
+    return record
+
+
+def iter_jobs(args, metric_names, prices):
+    dataset = sorted(os.listdir(args.raw_data_dir))
+    for result_dir in args.result_dirs:
+        for entry in sorted(os.scandir(result_dir), key=lambda entry: entry.name):
+            match_result = re.fullmatch(r"job_(\d+)\.json", entry.name)
+            if match_result is None:
+                continue
+            # older results have no sample_id, their jobs are numbered by the sorted sample
+            # directories, see run_experiment
+            index = int(match_result.group(1))
+            sample_id = dataset[index] if index < len(dataset) else None
+            group = result_dir if args.group_by is None else None
+            yield entry.path, group, args.raw_data_dir, sample_id, metric_names, prices
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if len(values) > 0 else None
+
+
+def percentile(values, q):
+    values = sorted(value for value in values if value is not None)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summarize(records, metric_names):
+    summary = {
+        "num_jobs": len(records),
+        "cost": mean([record["cost"] for record in records]),
+        "latency_p50": percentile([record["latency"] for record in records], 50),
+        "latency_p95": percentile([record["latency"] for record in records], 95),
+        "prompt_tokens": mean([record["prompt_tokens"] for record in records]),
+        "completion_tokens": mean([record["completion_tokens"] for record in records]),
+        "actor_rounds": mean([record["rounds"]["actor"] for record in records]),
+        "review_skipped": mean([float(record["review_decision"] == "skip") for record in records]),
+        "escalated": mean([float(len(record["escalations"]) > 0) for record in records]),
+    }
+    for name in metric_names:
+        for response in ["actor", "final"]:
+            summary[f"{name}_{response}"] = mean(
+                [record["scores"][name][response] for record in records if name in record["scores"]]
+            )
+    return summary
+
+
+def pareto_front(points):
+    """Return the labels of the points that no other point beats in both cost and accuracy."""
+    front = []
+    for label, cost, accuracy in points:
+        dominated = any(
+            other_cost <= cost and other_accuracy >= accuracy
+            and (other_cost < cost or other_accuracy > accuracy)
+            for _, other_cost, other_accuracy in points
+        )
+        if not dominated:
+            front.append(label)
+    return front
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def main(args):
+    metric_names = args.metrics.split(",")
+    for name in metric_names:
+        get_metric(name)
+    prices = dict(model_prices)
+    if args.prices is not None:
+        with open(args.prices) as f:
+            prices.update(json.load(f))
+
+    # results are read and scored in parallel, only the small records are kept
+    groups = dict()
+    output = open(args.output, "w") if args.output is not None else None
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as executor:
+        for record in executor.map(score_job, iter_jobs(args, metric_names, prices), chunksize=8):
+            if record["group"] is None:
+                config = record["config"] or {}
+                record["group"] = ",".join(
+                    f"{key}={config.get(key)}" for key in args.group_by.split(",")
+                )
+            groups.setdefault(record["group"], []).append(record)
+            if output is not None:
+                output.write(json.dumps(record) + "\n")
+    if output is not None:
+        output.close()
+
+    summaries = {group: summarize(records, metric_names) for group, records in groups.items()}
+    columns = ["num_jobs", "cost", "latency_p50", "latency_p95", "prompt_tokens", "actor_rounds",
+               "review_skipped", "escalated"] + [f"{name}_final" for name in metric_names]
+    print("\t".join(["group"] + columns))
+    for group, summary in summaries.items():
+        print("\t".join([group] + [format_value(summary[column]) for column in columns]))
+
+    # tradeoff of each metric against cost and latency over the configurations
+    for name in metric_names:
+        for resource in ["cost", "latency_p50"]:
+            points = [
+                (group, summary[resource], summary[f"{name}_final"])
+                for group, summary in summaries.items()
+                if summary[resource] is not None and summary[f"{name}_final"] is not None
+            ]
+            if len(points) == 0:
+                continue
+            front = sorted(pareto_front(points), key=lambda group: summaries[group][resource])
+            print(f"Pareto front of {name} vs {resource}:")
+            for group in front:
+                print(f"  {group}: {name}={format_value(summaries[group][name + '_final'])}, "
+                      f"{resource}={format_value(summaries[group][resource])}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,149 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+def parse_shard(value):
+    """Parse "i/n" into (i, n), e.g. "0/4" for the first of four shards."""
+    try:
+        index, num_shards = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ValueError(f"Shard must look like i/n, got {value}")
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise ValueError(f"Shard index must be between 0 and {num_shards - 1}, got {value}")
+    return index, num_shards
+
+
+class LeaseQueue:
+    """
+    Lets several processes, on one or many machines, split jobs through lock files in a
+    shared directory.
+
+    A job is leased by creating <lease_dir>/<job_id>.lock with O_EXCL, which succeeds for
+    exactly one process. A background thread touches the lock files of the held leases every
+    heartbeat_interval seconds. A lock file that was not touched for lease_timeout seconds
+    belongs to a crashed worker: it is renamed away (only one process wins the rename) and
+    the job is leased again. The heartbeat runs in its own thread, so a worker that hangs
+    in a job keeps its lease until the process exits. A worker whose lease was taken over notices it with
+    is_held and should not save its result. Lock files are compared by modification time, so
+    the clocks of the machines must agree to well within lease_timeout.
+    """
+
+    def __init__(self, lease_dir, worker_id=None, lease_timeout=600, heartbeat_interval=60):
+        self.lease_dir = lease_dir
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        os.makedirs(lease_dir, exist_ok=True)
+        # job_id -> token written into the lock file, to recognize our own lease
+        self.held = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def get_path(self, job_id):
+        return os.path.join(self.lease_dir, job_id + ".lock")
+
+    def create_lock(self, job_id):
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(self.get_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker_id, "token": token, "created": time.time()}, f)
+        return token
+
+    def read_lock(self, job_id):
+        try:
+            with open(self.get_path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def is_expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def steal(self, job_id):
+        """Remove the lock file of job_id if it expired, return whether it was removed."""
+        path = self.get_path(job_id)
+        if not self.is_expired(path):
+            return False
+        stolen_path = f"{path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(path, stolen_path)
+        except FileNotFoundError:  # another process was faster
+            return False
+        if not self.is_expired(stolen_path):
+            # the owner renewed the lease between the check and the rename, put it back
+            try:
+                os.link(stolen_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stolen_path)
+            return False
+        with open(stolen_path) as f:
+            owner = f.read()
+        os.remove(stolen_path)
+        print(f"Took over the expired lease of {job_id}: {owner}")
+        return True
+
+    def try_acquire(self, job_id):
+        """Lease job_id unless a live worker holds it, return whether the lease was obtained."""
+        token = self.create_lock(job_id)
+        if token is None and self.steal(job_id):
+            token = self.create_lock(job_id)
+        if token is None:
+            return False
+        with self.lock:
+            self.held[job_id] = token
+        return True
+
+    def is_held(self, job_id):
+        with self.lock:
+            token = self.held.get(job_id)
+        lease = self.read_lock(job_id)
+        return token is not None and lease is not None and lease["token"] == token
+
+    def release(self, job_id):
+        with self.lock:
+            token = self.held.pop(job_id, None)
+        lease = self.read_lock(job_id)
+        if token is not None and lease is not None and lease["token"] == token:
+            try:
+                os.remove(self.get_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def renew(self):
+        with self.lock:
+            held = list(self.held.items())
+        for job_id, token in held:
+            lease = self.read_lock(job_id)
+            if lease is None or lease["token"] != token:
+                print(f"Lost the lease of {job_id}, another worker took it over")
+                with self.lock:
+                    self.held.pop(job_id, None)
+                continue
+            try:
+                os.utime(self.get_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            self.renew()
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            job_ids = list(self.held.keys())
+        for job_id in job_ids:
+            self.release(job_id)
@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+import openai
+from openai import OpenAI
+
+
+class Endpoint:
+    def __init__(self, api_key, base_url=None, weight=1, http_client=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.weight = weight
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        # the pool decides where to retry, so completions are not retried on the same key
+        self.chat_client = self.client.with_options(max_retries=0)
+        self.current_weight = 0
+        self.cooldown_until = 0
+        self.num_rate_limited_in_row = 0
+        self.num_errors_in_row = 0
+        self.num_requests, self.num_rate_limited, self.num_errors = 0, 0, 0
+
+    def name(self):
+        # never expose the full key in logs and metrics
+        return f"{self.base_url or 'default'} (key ...{self.api_key[-4:]})"
+
+    def stats(self, now):
+        return {
+            "endpoint": self.name(),
+            "weight": self.weight,
+            "requests": self.num_requests,
+            "rate_limited": self.num_rate_limited,
+            "errors": self.num_errors,
+            "cooldown": max(0, self.cooldown_until - now),
+        }
+
+
+class ClientPool:
+    """
+    Sends chat completions through several API keys and/or base URLs over one shared HTTP
+    connection pool.
+
+    Endpoints are picked by smooth weighted round-robin over those that are not cooling down.
+    An endpoint that answers with a 429 cools down for its retry-after time (or an exponential
+    backoff of cooldown seconds), and one that fails max_errors times in a row for cooldown
+    seconds; the request is then sent to the next endpoint. If every endpoint is cooling down,
+    the request waits for the first one to come back. The last error is raised once each
+    endpoint was tried, and retries beyond that are left to the caller.
+
+    The pool can be used wherever the agents expect an OpenAI client for chat completions
+    (pool.chat.completions.create); get_client returns a plain client for the other APIs.
+    """
+
+    def __init__(
+        self,
+        api_keys,
+        base_urls=None,
+        weights=None,
+        cooldown=10,
+        max_cooldown=120,
+        max_errors=3,
+    ):
+        api_keys = list(api_keys)
+        base_urls = list(base_urls) if base_urls else [None]
+        num_endpoints = max(len(api_keys), len(base_urls))
+        # a single key or base URL is shared by all endpoints
+        if len(api_keys) == 1:
+            api_keys = api_keys * num_endpoints
+        if len(base_urls) == 1:
+            base_urls = base_urls * num_endpoints
+        weights = list(weights) if weights else [1] * num_endpoints
+        if not len(api_keys) == len(base_urls) == len(weights) == num_endpoints:
+            raise ValueError(
+                "api_keys, base_urls and weights must have the same length or a single item"
+            )
+
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_errors = max_errors
+        # keep-alive connections shared by all endpoints and threads
+        self.http_client = openai.DefaultHttpxClient()
+        self.endpoints = [
+            Endpoint(api_key, base_url, weight, self.http_client)
+            for api_key, base_url, weight in zip(api_keys, base_urls, weights)
+        ]
+        self.lock = threading.Lock()
+        # pool.chat.completions.create(...) mirrors the OpenAI client
+        self.chat = self
+        self.completions = self
+
+    def get_client(self):
+        return self.endpoints[0].client
+
+    def pick(self, excluded):
+        """Return the next endpoint not in excluded, or the time to wait for one."""
+        with self.lock:
+            now = time.time()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in excluded]
+            if len(candidates) == 0:
+                return None, 0
+            ready = [endpoint for endpoint in candidates if endpoint.cooldown_until <= now]
+            if len(ready) == 0:
+                return None, min(endpoint.cooldown_until for endpoint in candidates) - now
+
+            total_weight = sum(endpoint.weight for endpoint in ready)
+            for endpoint in ready:
+                endpoint.current_weight += endpoint.weight
+            endpoint = max(ready, key=lambda endpoint: endpoint.current_weight)
+            endpoint.current_weight -= total_weight
+            endpoint.num_requests += 1
+            return endpoint, 0
+
+    def create(self, **kwargs):
+        excluded, last_error = [], None
+        while True:
+            endpoint, wait_time = self.pick(excluded)
+            if endpoint is None and wait_time <= 0:
+                raise last_error
+            if endpoint is None:
+                time.sleep(wait_time)
+                continue
+
+            try:
+                response = endpoint.chat_client.chat.completions.create(**kwargs)
+            except openai.RateLimitError as e:
+                self.mark_rate_limited(endpoint, e)
+                excluded.append(endpoint)
+                last_error = e
+                continue
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                self.mark_error(endpoint)
+                excluded.append(endpoint)
+                last_error = e
+                continue
+
+            with self.lock:
+                endpoint.num_rate_limited_in_row = 0
+                endpoint.num_errors_in_row = 0
+            return response
+
+    def mark_rate_limited(self, endpoint, e):
+        with self.lock:
+            endpoint.num_rate_limited += 1
+            endpoint.num_rate_limited_in_row += 1
+            cooldown = self.cooldown * 2 ** (endpoint.num_rate_limited_in_row - 1)
+            try:
+                cooldown = float(e.response.headers.get("retry-after"))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            endpoint.cooldown_until = time.time() + min(cooldown, self.max_cooldown)
+        print(f"Rate limited on {endpoint.name()}, cooling down for {min(cooldown, self.max_cooldown):.1f}s")
+
+    def mark_error(self, endpoint):
+        with self.lock:
+            endpoint.num_errors += 1
+            endpoint.num_errors_in_row += 1
+            if endpoint.num_errors_in_row >= self.max_errors:
+                endpoint.cooldown_until = time.time() + self.cooldown
+                endpoint.num_errors_in_row = 0
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return [endpoint.stats(now) for endpoint in self.endpoints]
+
+
+_client_pools = dict()
+_client_pools_lock = threading.Lock()
+
+
+def split_list(value):
+    # comma-separated command line and environment values
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def get_client_pool(api_keys=None, base_urls=None, weights=None):
+    """
+    Return the process-wide pool for the given keys, base URLs and weights.
+
+    Without api_keys, OPENAI_API_KEYS (comma-separated) or OPENAI_API_KEY are used, and
+    OPENAI_BASE_URLS is read for base_urls.
+    """
+    if api_keys is None:
+        api_keys = os.getenv("OPENAI_API_KEYS") or os.getenv("OPENAI_API_KEY")
+    if base_urls is None:
+        base_urls = os.getenv("OPENAI_BASE_URLS")
+    api_keys, base_urls = split_list(api_keys), split_list(base_urls)
+    weights = [float(weight) for weight in split_list(weights) or []]
+    if not api_keys:
+        raise ValueError("No API key given, set OPENAI_API_KEY or pass api_keys")
+
+    key = (tuple(api_keys), tuple(base_urls or []), tuple(weights))
+    with _client_pools_lock:
+        if key not in _client_pools:
+            _client_pools[key] = ClientPool(api_keys, base_urls, weights)
+        return _client_pools[key]
@@ -0,0 +1,487 @@
+import argparse
+import copy
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import doc_agent
+import doc_reader
+import llm_client
+import memory_bank
+import review_policy
+from evaluate import format_value, percentile
+from prompts import (memory_bank_reflection_prompt_template,
+                     reflection_prompt_template, reviewer_prompt)
+from run_experiment import answer_question
+
+parser = argparse.ArgumentParser(
+    description="Load test DocAgent by replaying saved trajectories from a local OpenAI-compatible stub"
+)
+parser.add_argument(
+    "--results-dir",
+    type=str,
+    default="./sample_results/",
+    help="Save directory of run_experiment whose job_*.json trajectories are replayed",
+)
+parser.add_argument(
+    "--preprocessed-data-dir",
+    type=str,
+    default="./preprocess/processed_output/",
+    help="Preprocessed data directory",
+)
+parser.add_argument(
+    "--raw-data-dir",
+    type=str,
+    default="./sample_data/",
+    help="Raw data directory, only used with --mode run_experiment",
+)
+parser.add_argument(
+    "--mode",
+    type=str,
+    default="agent",
+    choices=["agent", "run_experiment"],
+    help="Drive DocAgent from threads of this process (agent) or run_experiment processes, one per shard",
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=8,
+    help="Number of questions answered at the same time (threads, or run_experiment processes)",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=1,
+    help="Replay every trajectory this many times (agent mode)",
+)
+parser.add_argument(
+    "--latency",
+    type=float,
+    default=1.0,
+    help="Mean seconds the stub takes per completion",
+)
+parser.add_argument(
+    "--jitter",
+    type=float,
+    default=0.5,
+    help="Latency varies uniformly by this fraction of --latency around the mean",
+)
+parser.add_argument(
+    "--rate-limit-rate",
+    type=float,
+    default=0.0,
+    help="Fraction of completions answered with a 429 rate limit error",
+)
+parser.add_argument(
+    "--retry-after",
+    type=float,
+    default=1.0,
+    help="Retry-After seconds sent with the injected 429 errors",
+)
+parser.add_argument("--port", type=int, default=0, help="Port of the stub, a free port by default")
+parser.add_argument(
+    "--review-policy",
+    type=str,
+    default="always",
+    choices=list(review_policy.review_policies.keys()),
+    help="Policy deciding whether the reviewer runs after the actor",
+)
+parser.add_argument(
+    "--context-budget",
+    type=int,
+    default=None,
+    help="Token budget per completion, older tool outputs are replaced by stubs beyond it",
+)
+parser.add_argument(
+    "--save-dir",
+    type=str,
+    default=None,
+    help="Save directory of the run_experiment processes, a temporary directory by default",
+)
+parser.add_argument(
+    "--output",
+    type=str,
+    default=None,
+    help="Write the report as JSON to this file",
+)
+
+# prompts starting the reviewer and reflection conversations, which continue the actor's
+phase_prompts = [
+    ("reviewer", reviewer_prompt.strip()),
+    ("reflection", reflection_prompt_template.split("{memory}")[0].strip()),
+    ("reflection", memory_bank_reflection_prompt_template.split("{memory}")[0].strip()),
+]
+
+
+def get_question(messages):
+    # the last question, an actor conversation can hold several (see --questions-per-conversation)
+    question = None
+    for message in messages:
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            match_result = re.search(r"<question>\n(.*?)\n</question>", message["content"], re.DOTALL)
+            if match_result is not None:
+                question = match_result.group(1)
+    return question
+
+
+def get_document_key(messages):
+    # the outline in the first actor prompt identifies the document, also of generic questions
+    # asked about several documents
+    for message in messages:
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            outline = message["content"].split("<question>")[0]
+            return hashlib.sha256(outline.encode("utf-8")).hexdigest()[:16]
+    return None
+
+
+def get_phase(messages):
+    """Return the phase of a completion request and the number of completions of that phase so far."""
+    phase, start = "actor", 0
+    for index, message in enumerate(messages):
+        if message.get("role") != "user" or not isinstance(message.get("content"), str):
+            continue
+        if "<question>" in message["content"]:  # a question, maybe a follow-up in the conversation
+            phase, start = "actor", index
+        for name, prompt in phase_prompts:
+            if message["content"].strip().startswith(prompt):
+                phase, start = name, index
+    num_round = sum(1 for message in messages[start:] if message.get("role") == "assistant")
+    return phase, num_round
+
+
+class ReplayScript:
+    """
+    The recorded completions of saved trajectories, looked up by document (the outline in
+    the first prompt), question, phase and round.
+
+    Requests that go beyond or off the recording, e.g. because the outline or the review
+    policy changed since, get a final answer without tool calls, so every agent loop ends.
+    """
+
+    def __init__(self, results_dir):
+        self.completions = dict()
+        self.answers = dict()
+        self.jobs = []
+        for path in sorted(glob.glob(os.path.join(results_dir, "job_*.json"))):
+            with open(path) as f:
+                result = json.load(f)
+            question = get_question(result.get("actor_messages") or [])
+            if question is None:
+                continue
+            key = (get_document_key(result["actor_messages"]), question)
+            for phase in ["actor", "reviewer", "reflection"]:
+                messages = result.get(phase + "_messages") or []
+                if phase == "actor":  # without the completions of earlier questions in the conversation
+                    messages = messages[result.get("num_previous_messages", 0) :]
+                self.completions[key + (phase,)] = [item for item in messages if "model" in item]
+            self.answers[key] = result.get("reviewer_response") or result.get("actor_response") or ""
+            self.jobs.append({"job": os.path.basename(path)[:-5], "doc_id": result["doc_id"], "question": question})
+
+    def get_fallback(self, key, phase):
+        if phase == "reflection":
+            content = "<updated_guideline></updated_guideline><operations></operations>"
+        else:
+            content = f"<final_result>{self.answers.get(key, '')}</final_result>"
+        return {
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 20, "total_tokens": 20},
+        }
+
+    def get_completion(self, request):
+        """Return the completion for a request and whether it was found in the recording."""
+        messages = request["messages"]
+        key = (get_document_key(messages), get_question(messages))
+        phase, num_round = get_phase(messages)
+        recorded = self.completions.get(key + (phase,)) or []
+        found = num_round < len(recorded)
+        if found:
+            completion = copy.deepcopy(recorded[num_round])
+            if request.get("tool_choice") == "none" and completion["choices"][0]["message"].get("tool_calls"):
+                completion, found = self.get_fallback(key, phase), False
+        else:
+            completion = self.get_fallback(key, phase)
+        if not found:
+            # the size of the request stands in for the usage of the missing completion
+            completion["usage"]["prompt_tokens"] = len(json.dumps(messages)) // 4
+            completion["usage"]["total_tokens"] = completion["usage"]["prompt_tokens"] + 20
+        return completion, found
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints:
+        POST .../chat/completions   the recorded completion, after the configured latency
+        GET  /stats                 number of requests, rate limited and unmatched requests
+    """
+
+    script = None
+    config = None
+    stats = None
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.lock:
+                self.send_json(200, self.stats)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        if random.random() < self.config["rate_limit_rate"]:
+            with self.lock:
+                self.stats["rate_limited"] += 1
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached (injected)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": str(self.config["retry_after"])},
+            )
+            return
+
+        completion, found = self.script.get_completion(request)
+        completion["id"] = f"replay-{next(self.counter)}"
+        completion["model"] = request["model"]
+        completion["created"] = int(time.time())
+        jitter = self.config["jitter"] * random.uniform(-1, 1)
+        time.sleep(max(0.0, self.config["latency"] * (1 + jitter)))
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["unmatched"] += int(not found)
+        self.send_json(200, completion)
+
+
+def run_replay_server(results_dir, port, config, port_queue):
+    ReplayHandler.script = ReplayScript(results_dir)
+    ReplayHandler.config = config
+    ReplayHandler.stats = {"requests": 0, "rate_limited": 0, "unmatched": 0}
+    server = ThreadingHTTPServer(("127.0.0.1", port), ReplayHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class TimedDocAgent(doc_agent.DocAgent):
+    """A DocAgent that adds the CPU time of its tool calls to tool_cpu_times, by tool name."""
+
+    tool_cpu_times = dict()
+    tool_cpu_lock = threading.Lock()
+
+    def run_tool(self, tool_call, tool_memo=None):
+        # thread CPU time leaves out the other agents and the time waiting for the stub
+        start = time.thread_time()
+        try:
+            return super().run_tool(tool_call, tool_memo)
+        finally:
+            cpu_time = time.thread_time() - start
+            with self.tool_cpu_lock:
+                self.tool_cpu_times.setdefault(tool_call.function.name, []).append(cpu_time)
+
+
+def run_agents(args, jobs, base_url):
+    registry = doc_reader.get_registry()
+    client = llm_client.get_client_pool(api_keys="sk-load-test", base_urls=base_url)
+    policy = review_policy.get_review_policy(args.review_policy)
+    memory = memory_bank.TextMemory()
+
+    def run_job(job):
+        start_time = time.time()
+        document = registry.get(os.path.join(args.preprocessed_data_dir, job["doc_id"]))
+        agent = TimedDocAgent(
+            document,
+            client=client,
+            tool_call_wait_time=0,
+            context_budget=args.context_budget,
+        )
+        answer_question(agent, job["question"], memory, policy=policy, task_id=job["job"])
+        return time.time() - start_time
+
+    latencies, num_failed = [], 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                print(f"Job failed: {type(e).__name__}: {e}")
+                num_failed += 1
+    return latencies, num_failed, TimedDocAgent.tool_cpu_times
+
+
+def run_timed_experiment(argv, tool_cpu_path):
+    """Run run_experiment.main with TimedDocAgent and dump its tool CPU times to tool_cpu_path."""
+    import run_experiment
+
+    doc_agent.DocAgent = TimedDocAgent
+    try:
+        run_experiment.main(run_experiment.parser.parse_args(argv))
+    finally:
+        with open(tool_cpu_path, "w") as f:
+            json.dump(TimedDocAgent.tool_cpu_times, f)
+
+
+def run_experiments(args, base_url):
+    save_dir = args.save_dir or tempfile.mkdtemp(prefix="load_test_")
+    tool_cpu_dir = tempfile.mkdtemp(prefix="load_test_tool_cpu_")
+    # run_experiment.main in a process of its own that times the tools like agent mode
+    command = [
+        sys.executable,
+        "-c",
+        "import sys; sys.path.insert(0, %r); import load_test; "
+        "load_test.run_timed_experiment(sys.argv[2:], sys.argv[1])"
+        % os.path.dirname(os.path.abspath(__file__)),
+    ]
+    arguments = [
+        "--api-key", "sk-load-test",
+        "--base-urls", base_url,
+        "--raw-data-dir", args.raw_data_dir,
+        "--preprocessed-data-dir", args.preprocessed_data_dir,
+        "--save-dir", save_dir,
+        "--review-policy", args.review_policy,
+        "--tool-call-wait-time", "0",
+    ]
+    if args.context_budget is not None:
+        arguments += ["--context-budget", str(args.context_budget)]
+    processes = [
+        subprocess.Popen(
+            command
+            + [os.path.join(tool_cpu_dir, f"tool_cpu_{index}.json")]
+            + arguments
+            + ["--shard", f"{index}/{args.concurrency}"],
+            stdout=subprocess.DEVNULL,
+        )
+        for index in range(args.concurrency)
+    ]
+    num_failed = sum(int(process.wait() != 0) for process in processes)
+
+    tool_cpu_times = dict()
+    for path in glob.glob(os.path.join(tool_cpu_dir, "tool_cpu_*.json")):
+        with open(path) as f:
+            for name, values in json.load(f).items():
+                tool_cpu_times.setdefault(name, []).extend(values)
+    shutil.rmtree(tool_cpu_dir)
+
+    latencies = []
+    for path in glob.glob(os.path.join(save_dir, "job_*.json")):
+        with open(path) as f:
+            latencies.append(json.load(f)["timing"]["total"])
+    if args.save_dir is None:
+        shutil.rmtree(save_dir)
+    return latencies, num_failed, tool_cpu_times
+
+
+def main(args):
+    config = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+    }
+    # the stub runs in its own process, so that it does not compete with the agents for the GIL
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_replay_server,
+        args=(args.results_dir, args.port, config, port_queue),
+        daemon=True,
+    )
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}/v1"
+
+    jobs = [
+        job
+        for job in ReplayScript(args.results_dir).jobs
+        if os.path.isdir(os.path.join(args.preprocessed_data_dir, job["doc_id"]))
+    ] * args.repeat
+    if args.mode == "agent":
+        print(f"Replaying {len(jobs)} jobs at concurrency {args.concurrency} against {base_url}")
+    else:
+        print(f"Running {args.concurrency} run_experiment processes over {args.raw_data_dir} against {base_url}")
+
+    start_time, start_cpu = time.time(), time.process_time()
+    if args.mode == "agent":
+        latencies, num_failed, tool_cpu_times = run_agents(args, jobs, base_url)
+        cpu_time = time.process_time() - start_cpu
+    else:
+        latencies, num_failed, tool_cpu_times = run_experiments(args, base_url)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = usage.ru_utime + usage.ru_stime
+    wall_time = time.time() - start_time
+
+    with urllib.request.urlopen(base_url.rsplit("/", 1)[0] + "/stats") as response:
+        server_stats = json.load(response)
+    server.terminate()
+
+    report = {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "jobs": len(latencies),
+        "failed": num_failed,
+        "wall_time": wall_time,
+        "throughput_per_min": 60 * len(latencies) / wall_time,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "llm_requests": server_stats["requests"],
+        "llm_rate_limited": server_stats["rate_limited"],
+        "llm_unmatched": server_stats["unmatched"],
+        # CPU of the agents, outside of the stub (all run_experiment processes in that mode)
+        "client_cpu_time": cpu_time,
+    }
+    all_times = [value for values in tool_cpu_times.values() for value in values]
+    report["tool_calls"] = len(all_times)
+    report["tool_cpu_time"] = sum(all_times)
+    report["tool_cpu_per_call_p50"] = percentile(all_times, 50)
+    report["tool_cpu_per_call_p99"] = percentile(all_times, 99)
+    report["tool_cpu_by_tool"] = {name: sum(values) for name, values in sorted(tool_cpu_times.items())}
+
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{name}={format_value(time_)}" for name, time_ in value.items())
+        print(f"{key}\t{format_value(value)}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,350 @@
+import json
+import math
+import os
+import re
+import threading
+
+from prompts import memory_bank_reflection_prompt_template
+
+stop_words = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "does", "for", "from",
+    "how", "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "were",
+    "what", "when", "which", "who", "with", "according", "document", "report",
+}
+
+
+def tokenize(text):
+    return [word for word in re.findall(r"\w+", text.lower()) if word not in stop_words]
+
+
+def estimate_num_tokens(text):
+    # about 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def get_question_type(question):
+    question = question.strip().lower()
+    if re.match(r"how (many|much)\b", question):
+        return "count"
+    if re.search(r"\b(percentage|percent|ratio|rate|average|total|sum|difference)\b", question):
+        return "numeric"
+    if re.match(r"(is|are|was|were|do|does|did|can|could|has|have|will|would|should)\b", question):
+        return "yes_no"
+    if re.search(r"\b(list|which (ones|of the))\b", question):
+        return "list"
+    return "other"
+
+
+class TextMemory:
+    """
+    The original free-text memory: one guideline string that the reflection loop rewrites
+    and that is pasted whole into every prompt.
+    """
+
+    def __init__(self, text=""):
+        self.text = text
+        self.lock = threading.RLock()
+
+    def get_prompt_memory(self, question, task_id=None):
+        with self.lock:
+            return self.text
+
+    def reflect(self, agent, initial_messages, question, task_id, prompt_memory):
+        # the rewrite replaces the whole text, so concurrent reflections are serialized
+        # to keep one from overwriting what another has just learned
+        with self.lock:
+            memory_new, messages = agent.run_reflection(
+                initial_messages=initial_messages, memory=self.text
+            )
+            self.text = memory_new
+        return messages
+
+    def describe(self, prompt_memory):
+        # the updated guideline is recorded with each job
+        with self.lock:
+            return self.text
+
+
+class MemoryBank:
+    """
+    A store of individual guideline entries selected per question under a token budget.
+
+    Each entry is a dict with the guideline text and its metadata: the task that produced it,
+    the question type it came from, how often it was selected into a prompt (hit_count) and
+    the index of the last task that added or selected it. Near-duplicate guidelines are merged
+    into the existing entry, and entries not used for max_age tasks are dropped, so prompt
+    length stays flat however many tasks are run.
+
+    The bank is versioned: every change is an operation (add, edit, remove, or use for the
+    entries selected for a task) appended to the log of the worker that made it. The state is
+    the replay of all operations sorted by (task, worker_id, seq), so workers processing tasks
+    in parallel can sync by reading each other's logs and always end up with the same bank,
+    and a run is reproducible from its operation log. Conflicts are resolved by that order:
+    the later edit of an entry wins, and operations on entries that were removed (or aged
+    out) before are ignored. An operation recorded after operations of later tasks merged
+    from other workers is applied right away and put in its place by the replay of the
+    next sync, so each sync replays the log once.
+    """
+
+    def __init__(
+        self,
+        token_budget=300,
+        max_entries=200,
+        max_age=500,
+        duplicate_threshold=0.8,
+        worker_id="0",
+        op_log_dir=None,
+    ):
+        self.token_budget = token_budget
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.duplicate_threshold = duplicate_threshold
+        self.worker_id = str(worker_id)
+        self.op_log_dir = op_log_dir
+        self.ops = dict()  # op_id -> operation, from all workers
+        self.next_seq = 0
+        self.selected_by_task = dict()
+        self.lock = threading.RLock()
+        self.reset_state()
+
+        if self.op_log_dir is not None:
+            os.makedirs(self.op_log_dir, exist_ok=True)
+            self.sync()
+            own_seqs = [op["seq"] for op in self.ops.values() if op["worker_id"] == self.worker_id]
+            self.next_seq = max(own_seqs) + 1 if len(own_seqs) > 0 else 0
+
+    def reset_state(self):
+        self.entries = dict()
+        self.task_count = 0
+        self.seen_tasks = set()
+        self.version = 0
+        self.last_op_order = None
+        # an operation was applied out of order, the next sync replays the log
+        self.needs_replay = False
+
+    @staticmethod
+    def get_op_order(op):
+        return (str(op["task"]), op["worker_id"], op["seq"])
+
+    def get_score(self, entry, question_tokens, question_type):
+        entry_tokens = set(tokenize(entry["text"]))
+        overlap = len(question_tokens & entry_tokens)
+        score = overlap / math.sqrt(len(entry_tokens) + 1)
+        if entry["question_type"] == question_type:
+            score += 0.5
+        return score + 0.1 * math.log1p(entry["hit_count"])
+
+    def select(self, question, token_budget=None):
+        """Return the most relevant entries for the question that fit into the token budget."""
+        if token_budget is None:
+            token_budget = self.token_budget
+        question_tokens = set(tokenize(question))
+        question_type = get_question_type(question)
+
+        with self.lock:
+            ranked = sorted(
+                self.entries.values(),
+                key=lambda entry: (
+                    -self.get_score(entry, question_tokens, question_type),
+                    entry["entry_id"],
+                ),
+            )
+            selected, num_tokens = [], 0
+            for entry in ranked:
+                entry_num_tokens = estimate_num_tokens(entry["text"]) + 2
+                if num_tokens + entry_num_tokens > token_budget:
+                    continue
+                selected.append(entry)
+                num_tokens += entry_num_tokens
+            return selected
+
+    @staticmethod
+    def render(entries, with_id=False):
+        # rendered as additional bullets of the guideline list in the actor prompt
+        if with_id:
+            return "".join(
+                f"\n<guideline id=\"{entry['entry_id']}\">{entry['text']}</guideline>"
+                for entry in entries
+            )
+        return "".join(f"\n- {entry['text']}" for entry in entries)
+
+    def get_prompt_memory(self, question, task_id=None):
+        with self.lock:
+            if task_id is None:
+                task_id = "task_%08d" % self.task_count
+            selected = self.select(question)
+            entry_ids = [entry["entry_id"] for entry in selected]
+            self.record({"op": "use", "task": task_id, "entry_ids": entry_ids})
+            self.selected_by_task[task_id] = entry_ids
+            return self.render(selected)
+
+    def record(self, op):
+        """Give the operation an id, log it and apply it to the bank."""
+        with self.lock:
+            op = dict(op, worker_id=self.worker_id, seq=self.next_seq, base_version=self.version)
+            op["op_id"] = f"{self.worker_id}:{self.next_seq}"
+            self.next_seq += 1
+            if self.op_log_dir is not None:
+                with open(self.get_op_log_path(self.worker_id), "a") as f:
+                    f.write(json.dumps(op) + "\n")
+
+            self.ops[op["op_id"]] = op
+            if self.last_op_order is not None and self.get_op_order(op) < self.last_op_order:
+                self.needs_replay = True
+            self.apply(op)
+            return op
+
+    def replay(self):
+        with self.lock:
+            self.reset_state()
+            for op in sorted(self.ops.values(), key=self.get_op_order):
+                self.apply(op)
+
+    def apply(self, op):
+        if self.last_op_order is None or self.get_op_order(op) > self.last_op_order:
+            self.last_op_order = self.get_op_order(op)
+        if op["task"] not in self.seen_tasks:
+            self.seen_tasks.add(op["task"])
+            self.task_count += 1
+            self.age_out()
+        self.version += 1
+
+        if op["op"] == "use":
+            for entry_id in op["entry_ids"]:
+                if entry_id in self.entries:
+                    self.entries[entry_id]["hit_count"] += 1
+                    self.entries[entry_id]["last_task"] = self.task_count
+
+        elif op["op"] == "add":
+            duplicate = self.find_duplicate(op["text"])
+            if duplicate is not None:
+                duplicate["last_task"] = self.task_count
+                return
+            self.entries[op["op_id"]] = {
+                "entry_id": op["op_id"],
+                "text": op["text"],
+                "source_task": op["task"],
+                "question_type": op.get("question_type"),
+                "hit_count": 0,
+                "last_task": self.task_count,
+            }
+            self.age_out()
+
+        elif op["op"] == "edit":
+            if op["entry_id"] in self.entries:
+                self.entries[op["entry_id"]]["text"] = op["text"]
+                self.entries[op["entry_id"]]["last_task"] = self.task_count
+
+        elif op["op"] == "remove":
+            self.entries.pop(op["entry_id"], None)
+
+    def find_duplicate(self, text):
+        tokens = set(tokenize(text))
+        for entry in self.entries.values():
+            entry_tokens = set(tokenize(entry["text"]))
+            union = tokens | entry_tokens
+            if len(union) > 0 and len(tokens & entry_tokens) / len(union) >= self.duplicate_threshold:
+                return entry
+        return None
+
+    def add(self, text, task_id, question_type=None):
+        text = " ".join(text.split())
+        return self.record(
+            {"op": "add", "task": task_id, "text": text, "question_type": question_type}
+        )
+
+    def edit(self, entry_id, text, task_id):
+        text = " ".join(text.split())
+        return self.record({"op": "edit", "task": task_id, "entry_id": entry_id, "text": text})
+
+    def remove(self, entry_id, task_id):
+        return self.record({"op": "remove", "task": task_id, "entry_id": entry_id})
+
+    def age_out(self):
+        for entry_id, entry in list(self.entries.items()):
+            if self.task_count - entry["last_task"] > self.max_age:
+                del self.entries[entry_id]
+        if len(self.entries) > self.max_entries:
+            # drop the least used entries, oldest first
+            ranked = sorted(
+                self.entries.values(),
+                key=lambda entry: (entry["hit_count"], entry["last_task"], entry["entry_id"]),
+            )
+            for entry in ranked[: len(self.entries) - self.max_entries]:
+                del self.entries[entry["entry_id"]]
+
+    @staticmethod
+    def parse_operations(text):
+        operations = []
+        for match_result in re.finditer(
+            r"<add>(.*?)</add>|<edit id=\"?([^\">]+)\"?>(.*?)</edit>|<remove id=\"?([^\">/]+)\"?\s*/?>",
+            text,
+            re.DOTALL,
+        ):
+            add_text, edit_id, edit_text, remove_id = match_result.groups()
+            if add_text is not None and len(add_text.strip()) > 0:
+                operations.append({"op": "add", "text": add_text.strip()})
+            elif edit_id is not None and len(edit_text.strip()) > 0:
+                operations.append({"op": "edit", "entry_id": edit_id.strip(), "text": edit_text.strip()})
+            elif remove_id is not None:
+                operations.append({"op": "remove", "entry_id": remove_id.strip()})
+        return operations
+
+    def reflect(self, agent, initial_messages, question, task_id, prompt_memory):
+        # the guidelines shown to the actor are listed with their ids so that they can be edited
+        with self.lock:
+            entry_ids = self.selected_by_task.pop(task_id, [])
+            selected = [self.entries[i] for i in entry_ids if i in self.entries]
+            memory = self.render(selected, with_id=True)
+        operations, messages = agent.run_reflection(
+            initial_messages=initial_messages,
+            memory=memory,
+            extract_regex=r"<operations>(.*)</operations>",
+            prompt_template=memory_bank_reflection_prompt_template,
+        )
+        for operation in self.parse_operations(operations):
+            if operation["op"] == "add":
+                self.add(operation["text"], task_id, get_question_type(question))
+            elif operation["op"] == "edit":
+                self.edit(operation["entry_id"], operation["text"], task_id)
+            else:
+                self.remove(operation["entry_id"], task_id)
+        return messages
+
+    def describe(self, prompt_memory):
+        # the guidelines selected for the job are recorded with it, the bank is kept in the op log
+        return prompt_memory
+
+    def get_op_log_path(self, worker_id):
+        return os.path.join(self.op_log_dir, f"ops_{worker_id}.jsonl")
+
+    def sync(self):
+        """Merge the operation logs of all workers and rebuild the bank from them if they changed."""
+        if self.op_log_dir is None:
+            return
+        with self.lock:
+            num_ops = len(self.ops)
+            for file_name in sorted(os.listdir(self.op_log_dir)):
+                if not (file_name.startswith("ops_") and file_name.endswith(".jsonl")):
+                    continue
+                with open(os.path.join(self.op_log_dir, file_name)) as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break  # the worker is still writing this operation
+                        op = json.loads(line)
+                        self.ops[op["op_id"]] = op
+            if len(self.ops) > num_ops or self.needs_replay:
+                self.replay()
+
+    def save(self, path):
+        # snapshot of the current entries for inspection only, it is never read back: the
+        # state is rebuilt from the op log
+        with self.lock:
+            state = {
+                "version": self.version,
+                "task_count": self.task_count,
+                "entries": list(self.entries.values()),
+            }
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(path + ".tmp", path)
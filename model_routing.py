@@ -0,0 +1,68 @@
+import review_policy
+
+# signals of a struggling model that trigger an escalation
+escalation_signals = ["max_round", "no_final_result", "disagreement"]
+
+
+class ModelRouter:
+    """
+    Picks the model of each phase (actor, reviewer, reflection) of a question, and the
+    escalation model when the cheaper one struggles.
+
+    The actor is run again with the escalation model if it used up max_round tool rounds
+    ("max_round") or gave no answer in the expected tags ("no_final_result"). The reviewer
+    is run again with the escalation model if its answer differs from the actor's
+    ("disagreement"). A phase that already runs on the escalation model is never escalated.
+    """
+
+    def __init__(
+        self,
+        default_model="gpt-4o",
+        phase_models=None,
+        escalation_model=None,
+        escalate_on=escalation_signals,
+    ):
+        self.default_model = default_model
+        self.phase_models = {phase: model for phase, model in (phase_models or {}).items() if model}
+        self.escalation_model = escalation_model
+        self.escalate_on = list(escalate_on)
+        for signal in self.escalate_on:
+            if signal not in escalation_signals:
+                raise ValueError(f"Unknown escalation signal {signal}, use some of {escalation_signals}")
+
+    def get_model(self, phase, escalated=False):
+        if escalated and self.escalation_model is not None:
+            return self.escalation_model
+        return self.phase_models.get(phase, self.default_model)
+
+    def can_escalate(self, phase):
+        return self.escalation_model is not None and self.get_model(phase) != self.escalation_model
+
+    def get_actor_escalation(self, run_stats):
+        """Return the signal for escalating the actor, given the stats of its run, or None."""
+        if not self.can_escalate("actor"):
+            return None
+        if "max_round" in self.escalate_on and run_stats["hit_max_round"]:
+            return "max_round"
+        if "no_final_result" in self.escalate_on and not run_stats["extracted"]:
+            return "no_final_result"
+        return None
+
+    def get_reviewer_escalation(self, actor_response, reviewer_response):
+        """Return the signal for escalating the reviewer, given both answers, or None."""
+        if not self.can_escalate("reviewer") or "disagreement" not in self.escalate_on:
+            return None
+        if review_policy.normalize_answer(actor_response) != review_policy.normalize_answer(
+            reviewer_response
+        ):
+            return "disagreement"
+        return None
+
+    def describe(self):
+        # saved with the run config of every result
+        config = {
+            phase + "_model": self.get_model(phase) for phase in ["actor", "reviewer", "reflection"]
+        }
+        config["escalation_model"] = self.escalation_model
+        config["escalate_on"] = ",".join(self.escalate_on) if self.escalation_model else None
+        return config
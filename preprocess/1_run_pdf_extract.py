@@ -19,7 +19,6 @@ from adobe.pdfservices.operation.exception.exceptions import (
 from adobe.pdfservices.operation.io.cloud_asset import CloudAsset
 from adobe.pdfservices.operation.io.stream_asset import StreamAsset
 from adobe.pdfservices.operation.pdf_services import PDFServices
-import argparse
 from adobe.pdfservices.operation.pdf_services_media_type import \
     PDFServicesMediaType
 from adobe.pdfservices.operation.pdfjobs.jobs.extract_pdf_job import \
@@ -48,14 +47,6 @@ def parse_arguments():
                         help="Directory for output results")
     return parser.parse_args()
 
-args = parse_arguments()
-
-PDF_SERVICES_CLIENT_ID = args.client_id
-PDF_SERVICES_CLIENT_SECRET = args.client_secret
-RAW_DATA_DIR = args.raw_data_dir
-RESULT_DIR = args.result_dir
-
-
 #
 # This sample illustrates how to extract Text, Table Elements Information from PDF along with renditions of Figure,
 # Table elements.
@@ -63,10 +54,9 @@ RESULT_DIR = args.result_dir
 # Refer to README.md for instructions on how to run the samples & understand output zip file.
 #
 class ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF:
-    def __init__(self, file_path, sid):
+    def __init__(self, file_path, output_file_path, client_id, client_secret, overwrite=False):
         # Creates an output stream and copy stream asset's content to it
-        output_file_path = self.create_output_file_path(sid)
-        if os.path.exists(output_file_path):
+        if os.path.exists(output_file_path) and not overwrite:
             return
 
         try:
@@ -76,8 +66,8 @@ class ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF:
 
             # Initial setup, create credentials instance
             credentials = ServicePrincipalCredentials(
-                client_id=PDF_SERVICES_CLIENT_ID,
-                client_secret=PDF_SERVICES_CLIENT_SECRET,
+                client_id=client_id,
+                client_secret=client_secret,
             )
 
             # Creates a PDF Services instance
@@ -115,28 +105,37 @@ class ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF:
             result_asset: CloudAsset = pdf_services_response.get_result().get_resource()
             stream_asset: StreamAsset = pdf_services.get_content(result_asset)
 
-            with open(output_file_path, "wb") as file:
+            # write to a temporary file first, so an interrupted download is not taken as done
+            with open(output_file_path + ".tmp", "wb") as file:
                 file.write(stream_asset.get_input_stream())
+            os.replace(output_file_path + ".tmp", output_file_path)
 
         except (ServiceApiException, ServiceUsageException, SdkException) as e:
             logging.exception(f"Exception encountered while executing operation: {e}")
-            exit()
+            raise
 
     # Generates a string containing a directory structure and file name for the output file
     @staticmethod
-    def create_output_file_path(sid) -> str:
-        return f"{RESULT_DIR}/{sid}.zip"
+    def create_output_file_path(result_dir, sid) -> str:
+        return f"{result_dir}/{sid}.zip"
 
 
-def main():
-    os.makedirs(RESULT_DIR, exist_ok=True)
+def main(args):
+    os.makedirs(args.result_dir, exist_ok=True)
 
-    for file_path in glob.glob(RAW_DATA_DIR + "/*"):
+    for file_path in glob.glob(args.raw_data_dir + "/*"):
         pdf_path = file_path + "/document.pdf"
         sid = pdf_path.split("/")[-2]
         print(pdf_path)
-        ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF(pdf_path, sid)
+        ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF(
+            pdf_path,
+            ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF.create_output_file_path(
+                args.result_dir, sid
+            ),
+            args.client_id,
+            args.client_secret,
+        )
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_arguments())
@@ -4,12 +4,22 @@ import glob
 import io
 import json
 import os
+import math
 import re
 import shutil
+import struct
+import sys
 import zipfile
+import xml.etree.ElementTree as ET
+from array import array
 
 import openpyxl
-import pandas as pd
+
+import xlsx_reader
+
+# the helpers shared with doc_reader live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from doc_format import COLUMNAR_MAGIC, COLUMNAR_VERSION, make_column, merge_bounds
 
 parser = argparse.ArgumentParser(description="Process extracted data")
 parser.add_argument(
@@ -25,16 +35,13 @@ parser.add_argument(
     help="Directory to save results",
 )
 
-args = parser.parse_args()
 
 
-def get_xlsx_content(file_path):
-    workbook = openpyxl.load_workbook(file_path, read_only=True)
-    worksheet = workbook.active
+def rows_to_csv(rows):
     output = io.StringIO()
 
     csv_writer = csv.writer(output)
-    for row in worksheet.iter_rows(values_only=True):
+    for row in rows:
         csv_writer.writerow(row)
 
     output_str = output.getvalue()
@@ -45,24 +52,49 @@ def get_xlsx_content(file_path):
     return output_str
 
 
-def json2df(root_path):
-
-    def add_data(style, item_id, data):
-        style_list.append(style)
-        id_list.append(item_id)
-        data_list.append(data)
-
-    with open(root_path + "/structuredData.json") as f:
-        data = json.load(f)
+def get_xlsx_content_openpyxl(file_path):
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        return rows_to_csv(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
 
-    style_list, id_list, data_list = [], [], []
 
+def get_xlsx_content(file_path):
+    # the streaming reader gives the same CSV as openpyxl, which is still used for the
+    # workbooks it does not handle (formulas, dates, unexpected structure)
+    try:
+        return rows_to_csv(xlsx_reader.iter_xlsx_rows(file_path))
+    except (xlsx_reader.UnsupportedWorkbook, KeyError, IndexError, ValueError, ET.ParseError):
+        return get_xlsx_content_openpyxl(file_path)
+
+
+def iter_rows(elements, root_path):
+    """Yield the document rows for the elements of structuredData.json, one element at a time."""
+
+    def add_data(style, item_id, data, item=None):
+        rows.append(
+            {
+                "para_text": data,
+                "table_id": item_id,
+                "style": style,
+                # Bounds are [x0, y0, x1, y1] in PDF points, with the origin at the bottom-left of the page
+                "bounds": item.get("Bounds") if item is not None else None,
+                "attributes": item.get("attributes") if item is not None else None,
+            }
+        )
+
+    rows = []
     curr_page = 1
     image_count, table_count = 1, 1
 
     add_data("Page_Start", 1, None)
 
-    for item in data["elements"]:
+    for item in elements:
+        # the last row is held back, as a heading split over several elements is merged into it
+        while len(rows) > 1:
+            yield rows.pop(0)
+
         # clean the item
         if "Text" in item:
             item["Text"] = item["Text"].replace("�", "")
@@ -84,7 +116,7 @@ def json2df(root_path):
                     else:  # image
                         table_data["image_path"] = file_path
 
-                add_data("Table", table_count, table_data)
+                add_data("Table", table_count, table_data, item)
                 table_count += 1
 
         elif "/Figure" in item["Path"]:
@@ -95,37 +127,296 @@ def json2df(root_path):
                         image_data["alt_text"] = item["alternate_text"]
                     else:
                         image_data["alt_text"] = None
-                    add_data("Image", image_count, image_data)
+                    add_data("Image", image_count, image_data, item)
                     image_count += 1
 
             elif "Text" in item:
-                add_data("Caption", None, item["Text"])
+                add_data("Caption", None, item["Text"], item)
 
         elif re.search(r"/H(\d+)", item["Path"]) and "Text" in item:
 
             heading_num = re.findall(r"/H(\d+)", rf"{item["Path"]}")[0]
             heading_name = f"Heading {heading_num}"
-            if style_list[-1] == heading_name:
-                data_list[-1] += " " + item["Text"]
+            if rows[-1]["style"] == heading_name:
+                rows[-1]["para_text"] += " " + item["Text"]
+                rows[-1]["bounds"] = merge_bounds(rows[-1]["bounds"], item.get("Bounds"))
             else:
-                add_data(heading_name, None, item["Text"])
+                add_data(heading_name, None, item["Text"], item)
 
         elif "/P" in item["Path"] and "Text" in item:
-            add_data("Normal", None, item["Text"])
+            add_data("Normal", None, item["Text"], item)
 
         elif "/Footnote" in item["Path"] and "Text" in item:
-            add_data("Footnote", None, item["Text"])
+            add_data("Footnote", None, item["Text"], item)
 
         elif "/LBody" in item["Path"] and "Text" in item:
-            add_data("List Paragraph", None, item["Text"])
+            add_data("List Paragraph", None, item["Text"], item)
 
         elif "/Title" in item["Path"]:
-            add_data("Title", None, item["Text"])
+            add_data("Title", None, item["Text"], item)
+
+    yield from rows
+
+
+def iter_json_object(f, stream_key, chunk_size=1 << 20):
+    """
+    Parse a JSON object from the file incrementally.
+
+    Yields (key, value) for each member of the object, except for the array under stream_key,
+    whose items are yielded one by one as (stream_key, item). Only the text of the current
+    value is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def fill(min_size):
+        # keep at least min_size characters after pos in the buffer, unless the file ends
+        nonlocal buffer, pos, eof
+        if pos > 0:
+            buffer, pos = buffer[pos:], 0
+        while len(buffer) < min_size and not eof:
+            chunk = f.read(max(chunk_size, min_size - len(buffer)))
+            eof = len(chunk) == 0
+            buffer += chunk
+
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\n\r":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise ValueError("Unexpected end of JSON file")
+            fill(1)
+
+    def expect(char):
+        nonlocal pos
+        if next_char() != char:
+            raise ValueError(f"Expected {char!r} at {buffer[pos:pos + 20]!r}")
+        pos += 1
+
+    def decode():
+        # a value is complete once it decodes and is followed by a delimiter, e.g. 1.5 could
+        # otherwise be decoded as 1 if the buffer ends after "1."
+        nonlocal pos
+        next_char()
+        min_size = chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                if (end < len(buffer) and buffer[end] in " \t\n\r,:]}") or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(len(buffer) - pos + min_size)
+            min_size *= 2
+
+    expect("{")
+    if next_char() == "}":
+        return
+    while True:
+        key = decode()
+        expect(":")
+        if key == stream_key and next_char() == "[":
+            expect("[")
+            if next_char() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield key, decode()
+                    if next_char() == "]":
+                        pos += 1
+                        break
+                    expect(",")
+        else:
+            yield key, decode()
+
+        if next_char() == "}":
+            return
+        expect(",")
+
+
+def json2rows(root_path):
+    """Return the rows of the document and its page sizes, see json2columnar for large documents."""
+    # reads the whole file into memory
+    with open(root_path + "/structuredData.json") as f:
+        data = json.load(f)
+    return list(iter_rows(data["elements"], root_path)), get_page_sizes(data)
 
-    df = pd.DataFrame(
-        {"para_text": data_list, "table_id": id_list, "style": style_list}
-    )
-    return df
+
+def json2columnar(root_path, save_path):
+    """Write the rows of the document to save_path as they are parsed, return the page sizes."""
+    pages = []
+
+    def iter_elements(f):
+        for key, value in iter_json_object(f, "elements"):
+            if key == "elements":
+                yield value
+            elif key == "pages":
+                pages.extend(value)
+
+    writer = ColumnarWriter(save_path)
+    with open(root_path + "/structuredData.json") as f:
+        for row in iter_rows(iter_elements(f), root_path):
+            writer.append(row)
+    writer.close()
+    return get_page_sizes({"pages": pages})
+
+
+class ColumnarWriter:
+    """
+    Writes document rows in the columnar format loaded by doc_reader.load_columnar.
+
+    The file starts with COLUMNAR_MAGIC and a uint16 version, followed by chunks of up to
+    chunk_size rows. Each chunk is a uint32 header length, a JSON header listing the style
+    vocabulary and the byte size of each column, and the little-endian column data:
+        style         uint8 index into the style vocabulary of the chunk
+        page          uint32 page number of the row (1-indexed)
+        table_id      int32, -1 for none
+        text_kind     uint8, 0 for no text, 1 for a string, 2 for an asset
+        text_offsets  uint32 offsets of each row's string in the text table (num_rows + 1)
+        text          UTF-8 string table
+        asset_index   int32 index into the asset table, -1 for none
+        assets        JSON list of table and image dicts
+        bounds        float32 x0, y0, x1, y1 per row, NaN for none
+        attributes    JSON dict mapping row index in the chunk to its attributes
+    """
+
+    def __init__(self, path, chunk_size=4096):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.curr_page = 1
+        self.file = open(path + ".tmp", "wb")
+        self.file.write(COLUMNAR_MAGIC + struct.pack("<H", COLUMNAR_VERSION))
+
+    def append(self, row):
+        if row["style"] == "Page_Start":
+            self.curr_page = int(row["table_id"])
+        self.rows.append(dict(row, page=self.curr_page))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+
+        styles = sorted(set(row["style"] for row in self.rows))
+        style_index = {style: index for index, style in enumerate(styles)}
+        style_column, page_column = make_column("B"), make_column("I")
+        table_id_column, text_kind_column = make_column("i"), make_column("B")
+        text_offsets, asset_index_column = make_column("I", [0]), make_column("i")
+        bounds_column = make_column("f")
+        text_table, assets, attributes = bytearray(), [], {}
+
+        for index, row in enumerate(self.rows):
+            style_column.append(style_index[row["style"]])
+            page_column.append(row["page"])
+            table_id = row["table_id"]
+            table_id_column.append(int(table_id) if table_id is not None else -1)
+
+            para_text = row["para_text"]
+            if isinstance(para_text, str):
+                text_kind_column.append(1)
+                text_table += para_text.encode("utf-8")
+                asset_index_column.append(-1)
+            elif para_text is not None:
+                text_kind_column.append(2)
+                asset_index_column.append(len(assets))
+                assets.append(para_text)
+            else:
+                text_kind_column.append(0)
+                asset_index_column.append(-1)
+            text_offsets.append(len(text_table))
+
+            bounds = row.get("bounds")
+            if bounds is not None:
+                bounds_column.extend(float(value) for value in bounds)
+            else:
+                bounds_column.extend([math.nan] * 4)
+            if row.get("attributes") is not None:
+                attributes[str(index)] = row["attributes"]
+
+        columns = [
+            ("style", "B", style_column),
+            ("page", "I", page_column),
+            ("table_id", "i", table_id_column),
+            ("text_kind", "B", text_kind_column),
+            ("text_offsets", "I", text_offsets),
+            ("text", "utf8", bytes(text_table)),
+            ("asset_index", "i", asset_index_column),
+            ("assets", "json", json.dumps(assets).encode("utf-8")),
+            ("bounds", "f", bounds_column),
+            ("attributes", "json", json.dumps(attributes).encode("utf-8")),
+        ]
+        payloads = []
+        for name, column_type, values in columns:
+            if isinstance(values, array):
+                if sys.byteorder == "big":
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                values = values.tobytes()
+            payloads.append((name, column_type, values))
+
+        header = {
+            "num_rows": len(self.rows),
+            "styles": styles,
+            "columns": [[name, column_type, len(data)] for name, column_type, data in payloads],
+        }
+        header = json.dumps(header).encode("utf-8")
+        self.file.write(struct.pack("<I", len(header)) + header)
+        for _, _, data in payloads:
+            self.file.write(data)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+def write_columnar(path, rows):
+    writer = ColumnarWriter(path)
+    for row in rows:
+        writer.append(row)
+    writer.close()
+
+
+def get_page_sizes(data):
+    # page sizes in PDF points, used to map element bounds onto the page images
+    page_sizes = {}
+    for page in data.get("pages", []):
+        page_sizes[str(page["page_number"] + 1)] = [page["width"], page["height"]]
+    return page_sizes
+
+
+def process_document(zip_path, root_path, save_path):
+    # remove the results of an earlier version of the document before unzipping
+    for path in [root_path, save_path + "/figures", save_path + "/tables"]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    # Unzip a file
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        zip_ref.extractall(root_path)
+
+    os.makedirs(save_path, exist_ok=True)
+    page_sizes = json2columnar(root_path + "/", save_path + "/data.col")
+    with open(save_path + "/page_sizes.json", "w") as f:
+        json.dump(page_sizes, f)
+
+    # if PDF contains images or tables, copy the images and tables
+    if os.path.exists(root_path + "/figures"):
+        shutil.copytree(
+            root_path + "/figures", save_path + "/figures", dirs_exist_ok=True
+        )
+    if os.path.exists(root_path + "/tables"):
+        shutil.copytree(
+            root_path + "/tables", save_path + "/tables", dirs_exist_ok=True
+        )
 
 
 def main(args):
@@ -134,27 +425,11 @@ def main(args):
     for zip_path in glob.glob(args.extract_data_dir + "/*.zip"):
         sid = zip_path.split("/")[-1][:-4]
         print(sid)
-        root_path = f"{args.extract_data_dir}/{sid}/"
-        # Unzip a file
-        with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(root_path)
-
-        df = json2df(root_path + "/")
-
-        save_path = f"{args.save_dir}/{sid}/"
-        os.makedirs(save_path, exist_ok=True)
-        df.to_pickle(save_path + "/data.pkl")
-
-        # if PDF contains images or tables, copy the images and tables
-        if os.path.exists(root_path + "/figures"):
-            shutil.copytree(
-                root_path + "/figures", save_path + "/figures", dirs_exist_ok=True
-            )
-        if os.path.exists(root_path + "/tables"):
-            shutil.copytree(
-                root_path + "/tables", save_path + "/tables", dirs_exist_ok=True
-            )
+        process_document(
+            zip_path, f"{args.extract_data_dir}/{sid}/", f"{args.save_dir}/{sid}/"
+        )
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main(args)
@@ -1,6 +1,7 @@
 import argparse
 import glob
 import os
+import shutil
 
 import fitz
 
@@ -22,7 +23,18 @@ parser.add_argument(
     help="Resolution for page images",
 )
 
-args = parser.parse_args()
+
+def make_page_images(pdf_path, save_path, resolution=144):
+    # pages of an earlier version of the document are removed
+    if os.path.exists(f"{save_path}/page_images"):
+        shutil.rmtree(f"{save_path}/page_images")
+    os.makedirs(f"{save_path}/page_images", exist_ok=True)
+
+    with fitz.open(pdf_path) as pdf:
+        for index, page in enumerate(pdf):
+            image = page.get_pixmap(dpi=resolution)
+            index_string = "%04d" % index
+            image.save(f"{save_path}/page_images/page_{index_string}.png")
 
 
 def main(args):
@@ -30,18 +42,11 @@ def main(args):
 
         basename = file_name.split("/")[-1]
         print("Processing", basename)
-        os.makedirs(f"{args.save_dir}/{basename}", exist_ok=True)
-        os.makedirs(f"{args.save_dir}/{basename}/page_images", exist_ok=True)
-        pdf_path = file_name + "/document.pdf"
-
-        with fitz.open(pdf_path) as pdf:
-            for index, page in enumerate(pdf):
-                image = page.get_pixmap(dpi=args.resolution)
-                index_string = "%04d" % index
-                image.save(
-                    f"{args.save_dir}/{basename}/page_images/page_{index_string}.png"
-                )
+        make_page_images(
+            file_name + "/document.pdf", f"{args.save_dir}/{basename}", args.resolution
+        )
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main(args)
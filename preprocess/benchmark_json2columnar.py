@@ -0,0 +1,123 @@
+import argparse
+import filecmp
+import importlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(
+    description="Compare peak memory of loading structuredData.json at once and streaming it"
+)
+parser.add_argument(
+    "--size-mb",
+    type=int,
+    default=300,
+    help="Approximate size of the synthetic structuredData.json",
+)
+parser.add_argument(
+    "--work-dir",
+    type=str,
+    default=None,
+    help="Directory for the synthetic extraction and outputs, a temporary directory by default",
+)
+parser.add_argument("--mode", type=str, default=None, help=argparse.SUPPRESS)
+
+words = "the economic survey of households shows that income growth and financial outlook improved across most groups".split()
+
+
+def make_structured_data(path, size_mb, seed=0):
+    """Write a synthetic Adobe extraction with headings, paragraphs, lists and figures."""
+    rng = random.Random(seed)
+    size, page, index = 0, 0, 0
+    with open(path, "w") as f:
+        f.write('{"version": {"json_export": "200"}, "elements": [')
+        while size < size_mb * 1024 * 1024:
+            if index % 40 == 0:
+                page += 1
+            kind = rng.random()
+            if kind < 0.05:
+                path_name = f"//Document/H{rng.randint(1, 3)}"
+            elif kind < 0.1:
+                path_name = "//Document/L/LI/LBody"
+            else:
+                path_name = "//Document/P"
+            item = {
+                "Bounds": [72.0, 700.0 - index % 40 * 15, 540.0, 712.0 - index % 40 * 15],
+                "Page": page - 1,
+                "Path": f"{path_name}[{index}]",
+                "Text": " ".join(rng.choice(words) for _ in range(rng.randint(20, 120))) + " ",
+                "attributes": {"LineHeight": 12.0},
+            }
+            if kind > 0.995:
+                item = {
+                    "Bounds": item["Bounds"],
+                    "Page": page - 1,
+                    "Path": f"//Document/Figure[{index}]",
+                    "filePaths": [f"figures/fileoutpart{index}.png"],
+                }
+            text = ("," if index > 0 else "") + json.dumps(item)
+            f.write(text)
+            size += len(text)
+            index += 1
+        pages = [
+            {"page_number": number, "width": 612.0, "height": 792.0} for number in range(page)
+        ]
+        f.write('], "pages": ' + json.dumps(pages) + "}")
+    return index
+
+
+def run_mode(mode, work_dir):
+    stage_module = importlib.import_module("2_process_extracted_data")
+    root_path = os.path.join(work_dir, "extract") + "/"
+    save_path = os.path.join(work_dir, f"data_{mode}.col")
+    start_time = time.time()
+    if mode == "load":
+        rows, page_sizes = stage_module.json2rows(root_path)
+        stage_module.write_columnar(save_path, rows)
+    else:
+        page_sizes = stage_module.json2columnar(root_path, save_path)
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"seconds": time.time() - start_time, "peak_rss_mb": peak_rss_mb,
+                      "num_pages": len(page_sizes)}))
+
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="json2columnar_benchmark_")
+    if args.mode is not None:
+        run_mode(args.mode, work_dir)
+        return
+
+    os.makedirs(os.path.join(work_dir, "extract"), exist_ok=True)
+    data_path = os.path.join(work_dir, "extract", "structuredData.json")
+    num_elements = make_structured_data(data_path, args.size_mb)
+    print(f"{data_path}: {os.path.getsize(data_path) / 1024 / 1024:.0f} MB, {num_elements} elements")
+
+    # each mode runs in a fresh process, so that its peak RSS is measured on its own
+    for mode in ["load", "stream"]:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--work-dir", work_dir],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:>6}: {result['seconds']:.1f}s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    same = filecmp.cmp(
+        os.path.join(work_dir, "data_load.col"),
+        os.path.join(work_dir, "data_stream.col"),
+        shallow=False,
+    )
+    print("Outputs identical:", same)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
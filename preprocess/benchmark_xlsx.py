@@ -0,0 +1,143 @@
+import argparse
+import datetime
+import glob
+import importlib
+import os
+import random
+import tempfile
+import time
+
+import openpyxl
+
+import xlsx_reader
+
+parser = argparse.ArgumentParser(
+    description="Compare the streaming xlsx reader with openpyxl on table workbooks"
+)
+parser.add_argument(
+    "--extract-data-dir",
+    type=str,
+    default="./extract_output/",
+    help="Extracted data directory, whose tables/*.xlsx are also compared",
+)
+parser.add_argument(
+    "--num-generated",
+    type=int,
+    default=50,
+    help="Number of synthetic workbooks",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="Conversions per table and reader, the fastest one is reported",
+)
+parser.add_argument(
+    "--work-dir",
+    type=str,
+    default=None,
+    help="Directory for the synthetic workbooks, a temporary directory by default",
+)
+
+words = "Total income survey share of adults % 2016 median U.S. households, _x000D_ \"quoted\"\nsecond line".split(" ")
+
+
+def random_value(rng, allow_dates):
+    kind = rng.random()
+    if kind < 0.15:
+        return None
+    if kind < 0.55:
+        return " ".join(rng.choice(words) for _ in range(rng.randint(1, 6)))
+    if kind < 0.7:
+        return rng.randint(-10**6, 10**6)
+    if kind < 0.85:
+        return round(rng.uniform(-1000, 1000), rng.randint(0, 6))
+    if kind < 0.9:
+        return rng.random() < 0.5
+    if kind < 0.95:
+        return rng.choice([1e-7, 1.5e20, 0.1, 3.0])
+    if allow_dates:
+        return datetime.date(2016, 1, 1) + datetime.timedelta(days=rng.randint(0, 1000))
+    return "n/a"
+
+
+def make_workbook(path, seed):
+    """Write a table-like workbook, with gaps, blank rows and a few unusual values."""
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    num_rows, num_cols = rng.randint(1, 400), rng.randint(1, 15)
+    # a few workbooks have dates or formulas, which are read by openpyxl
+    allow_dates = seed % 10 == 7
+    for row in range(1, num_rows + 1):
+        if rng.random() < 0.05:
+            continue
+        for col in range(1, num_cols + 1):
+            value = random_value(rng, allow_dates)
+            if value is not None:
+                worksheet.cell(row=row, column=col, value=value)
+    if seed % 10 == 9:
+        worksheet.cell(row=num_rows + 1, column=1, value="=SUM(A1:A3)")
+    if seed % 5 == 3:
+        # an extra sheet, with the second one active
+        other = workbook.create_sheet("Notes")
+        other.append(["note", seed])
+        workbook.active = 1
+    workbook.save(path)
+
+
+def time_conversion(function, path, repeat):
+    best, output = None, None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = function(path)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return output, best
+
+
+def main(args):
+    stage_module = importlib.import_module("2_process_extracted_data")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="xlsx_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    paths = []
+    for seed in range(args.num_generated):
+        path = os.path.join(work_dir, f"generated_{seed:03d}.xlsx")
+        make_workbook(path, seed)
+        paths.append(path)
+    paths += sorted(glob.glob(os.path.join(args.extract_data_dir, "*", "tables", "*.xlsx")))
+
+    total_old, total_new, num_fallback, mismatched = 0, 0, 0, []
+    print(f"{'table':<60} {'bytes':>8} {'openpyxl':>10} {'stream':>10} {'speedup':>8}")
+    for path in paths:
+        expected, old_time = time_conversion(stage_module.get_xlsx_content_openpyxl, path, args.repeat)
+        output, new_time = time_conversion(stage_module.get_xlsx_content, path, args.repeat)
+        try:
+            list(xlsx_reader.iter_xlsx_rows(path))
+            reader = "stream"
+        except xlsx_reader.UnsupportedWorkbook:
+            reader = "fallback"
+            num_fallback += 1
+        if output != expected:
+            mismatched.append(path)
+        total_old += old_time
+        total_new += new_time
+        name = os.path.relpath(path, work_dir) if path.startswith(work_dir) else path
+        print(
+            f"{name[-60:]:<60} {len(expected.encode('utf-8')):>8} {old_time * 1000:>8.2f}ms "
+            f"{new_time * 1000:>8.2f}ms {old_time / new_time:>7.1f}x {reader}"
+        )
+
+    print(
+        f"{len(paths)} tables, {num_fallback} read by openpyxl, "
+        f"total {total_old:.2f}s with openpyxl, {total_new:.2f}s streaming "
+        f"({total_old / max(total_new, 1e-9):.1f}x)"
+    )
+    print("Outputs identical:", len(mismatched) == 0)
+    for path in mismatched:
+        print("Mismatch:", path)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+parser = argparse.ArgumentParser(
+    description="Run the preprocessing stages for the documents whose inputs changed"
+)
+parser.add_argument("--client-id", default=os.environ.get("PDF_SERVICES_CLIENT_ID"),
+                    help="PDF Services Client ID, PDF_SERVICES_CLIENT_ID by default")
+parser.add_argument("--client-secret", default=os.environ.get("PDF_SERVICES_CLIENT_SECRET"),
+                    help="PDF Services Client Secret, PDF_SERVICES_CLIENT_SECRET by default")
+parser.add_argument(
+    "--raw-data-dir",
+    type=str,
+    default="../sample_data/",
+    help="Directory containing raw PDF files",
+)
+parser.add_argument(
+    "--extract-data-dir",
+    type=str,
+    default="./extract_output/",
+    help="Extracted data directory",
+)
+parser.add_argument(
+    "--save-dir",
+    type=str,
+    default="./processed_output/",
+    help="Directory to save results",
+)
+parser.add_argument(
+    "--resolution",
+    type=int,
+    default=144,
+    help="Resolution for page images",
+)
+parser.add_argument(
+    "--stages",
+    type=str,
+    default="extract,process,page_images",
+    help="Comma-separated stages to run, e.g. process,page_images if the extraction zips exist",
+)
+parser.add_argument(
+    "--num-workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of documents processed in parallel",
+)
+parser.add_argument(
+    "--manifest",
+    type=str,
+    default=None,
+    help="Path of the manifest, manifest.json in the save directory by default",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Run all stages for all documents, regardless of the manifest",
+)
+
+stage_names = ["extract", "process", "page_images"]
+stage_scripts = {
+    "extract": "1_run_pdf_extract.py",
+    "process": "2_process_extracted_data.py",
+    "page_images": "3_make_page_images.py",
+}
+# modules imported by a stage script, whose changes also run the stage again
+stage_helpers = {"process": ["xlsx_reader.py", "../doc_format.py"]}
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def fingerprint_file(path, previous=None):
+    """
+    Return size, modification time and sha256 of the file.
+
+    The sha256 of the previous fingerprint is reused if size and modification time did not
+    change, so unchanged files are not read again.
+    """
+    stat = os.stat(path)
+    if (
+        previous is not None
+        and previous["size"] == stat.st_size
+        and previous["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": hash_file(path)}
+
+
+def same_stat(path, fingerprint):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (
+        fingerprint is not None
+        and fingerprint["size"] == stat.st_size
+        and fingerprint["mtime_ns"] == stat.st_mtime_ns
+    )
+
+
+def hash_json(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_stage_configs(args):
+    """Hash the code and parameters of each stage, a change runs the stage for all documents."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    configs = {}
+    for stage in stage_names:
+        code = hash_file(os.path.join(script_dir, stage_scripts[stage]))
+        params = {"page_images": {"resolution": args.resolution}}.get(stage, {})
+        config = {"code": code, "params": params}
+        if stage in stage_helpers:
+            config["helpers"] = [
+                hash_file(os.path.join(script_dir, helper)) for helper in stage_helpers[stage]
+            ]
+        configs[stage] = hash_json(config)
+    return configs
+
+
+def get_paths(args, sid):
+    return {
+        "pdf": os.path.join(args.raw_data_dir, sid, "document.pdf"),
+        "zip": os.path.join(args.extract_data_dir, sid + ".zip"),
+        "extract_dir": os.path.join(args.extract_data_dir, sid),
+        "save_dir": os.path.join(args.save_dir, sid),
+        "data": os.path.join(args.save_dir, sid, "data.col"),
+        "page_images": os.path.join(args.save_dir, sid, "page_images"),
+    }
+
+
+def is_up_to_date(entry, paths, stages, configs):
+    # only stat calls, so that checking a large unchanged corpus is fast
+    if entry is None or not same_stat(paths["pdf"], entry.get("pdf")):
+        return False
+    for stage in stages:
+        record = entry["stages"].get(stage)
+        if record is None or record["config"] != configs[stage]:
+            return False
+    if "extract" in stages or "process" in stages:
+        if not same_stat(paths["zip"], entry.get("zip")):
+            return False
+    if "process" in stages and not os.path.exists(paths["data"]):
+        return False
+    if "page_images" in stages and not os.path.isdir(paths["page_images"]):
+        return False
+    return True
+
+
+def run_document(sid, paths, stages, configs, entry, client_id, client_secret, resolution, force):
+    """Run the stages of one document whose inputs changed, return its new manifest entry."""
+    entry = entry or {"stages": {}}
+    entry = {"pdf": entry.get("pdf"), "zip": entry.get("zip"), "stages": dict(entry["stages"])}
+    ran_stages = []
+
+    def needs_run(stage, key, output_path):
+        record = entry["stages"].get(stage)
+        return force or record is None or record["key"] != key or not os.path.exists(output_path)
+
+    entry["pdf"] = fingerprint_file(paths["pdf"], entry["pdf"])
+
+    if "extract" in stages:
+        key = hash_json([entry["pdf"]["sha256"], configs["extract"]])
+        if needs_run("extract", key, paths["zip"]):
+            stage_module = importlib.import_module("1_run_pdf_extract")
+            stage_module.ExtractTextTableInfoWithFiguresTablesRenditionsFromPDF(
+                paths["pdf"], paths["zip"], client_id, client_secret, overwrite=True
+            )
+            ran_stages.append("extract")
+        entry["zip"] = fingerprint_file(paths["zip"], entry["zip"])
+        entry["stages"]["extract"] = {"key": key, "config": configs["extract"]}
+
+    if "process" in stages:
+        entry["zip"] = fingerprint_file(paths["zip"], entry["zip"])
+        key = hash_json([entry["zip"]["sha256"], configs["process"]])
+        if needs_run("process", key, paths["data"]):
+            stage_module = importlib.import_module("2_process_extracted_data")
+            stage_module.process_document(
+                paths["zip"], paths["extract_dir"], paths["save_dir"]
+            )
+            ran_stages.append("process")
+        entry["stages"]["process"] = {"key": key, "config": configs["process"]}
+
+    if "page_images" in stages:
+        key = hash_json([entry["pdf"]["sha256"], configs["page_images"]])
+        if needs_run("page_images", key, paths["page_images"]):
+            stage_module = importlib.import_module("3_make_page_images")
+            stage_module.make_page_images(paths["pdf"], paths["save_dir"], resolution)
+            ran_stages.append("page_images")
+        entry["stages"]["page_images"] = {"key": key, "config": configs["page_images"]}
+
+    return sid, entry, ran_stages
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {"documents": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def main(args):
+    start_time = time.time()
+    stages = [stage for stage in stage_names if stage in args.stages.split(",")]
+    if "extract" in stages and not (args.client_id and args.client_secret):
+        parser.error(
+            "The extract stage needs PDF Services credentials, set PDF_SERVICES_CLIENT_ID and "
+            "PDF_SERVICES_CLIENT_SECRET or pass --client-id and --client-secret"
+        )
+    os.makedirs(args.extract_data_dir, exist_ok=True)
+    os.makedirs(args.save_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.save_dir, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    configs = get_stage_configs(args)
+
+    sids = sorted(
+        entry.name
+        for entry in os.scandir(args.raw_data_dir)
+        if entry.is_dir() and os.path.exists(os.path.join(entry.path, "document.pdf"))
+    )
+    # documents removed from the raw data directory are dropped from the manifest
+    documents = {sid: manifest["documents"][sid] for sid in sids if sid in manifest["documents"]}
+    manifest["documents"] = documents
+
+    pending = []
+    for sid in sids:
+        paths = get_paths(args, sid)
+        if args.force or not is_up_to_date(documents.get(sid), paths, stages, configs):
+            pending.append((sid, paths))
+    print(f"{len(sids)} documents, {len(sids) - len(pending)} up to date, {len(pending)} to check")
+
+    num_ran, failed = 0, []
+    last_save_time = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as executor:
+        futures = {
+            executor.submit(
+                run_document,
+                sid,
+                paths,
+                stages,
+                configs,
+                documents.get(sid),
+                args.client_id,
+                args.client_secret,
+                args.resolution,
+                args.force,
+            ): sid
+            for sid, paths in pending
+        }
+        for future in as_completed(futures):
+            sid = futures[future]
+            try:
+                _, entry, ran_stages = future.result()
+            except Exception:
+                # the document keeps its old manifest entry and is tried again next time
+                print(traceback.format_exc())
+                print("Failed", sid)
+                failed.append(sid)
+                continue
+            documents[sid] = entry
+            if len(ran_stages) > 0:
+                num_ran += 1
+                print(sid, "ran", ",".join(ran_stages))
+            if time.time() - last_save_time > 10:
+                save_manifest(manifest_path, manifest)
+                last_save_time = time.time()
+
+    save_manifest(manifest_path, manifest)
+    print(
+        f"Processed {num_ran} documents, {len(failed)} failed, in {time.time() - start_time:.1f}s"
+    )
+    if len(failed) > 0:
+        print("Failed documents:", failed)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,63 @@
+import importlib
+import io
+import json
+
+import pytest
+
+stage_module = importlib.import_module("2_process_extracted_data")
+
+document = {
+    "version": {"json_export": "200", "page_segments": [1.5, -2, 3e-5, 10]},
+    "elements": [
+        {"Path": "//Document/H1", "Text": "Economy ", "Page": 0, "Bounds": [72.0, 700.25, 540, 712]},
+        {"Path": "//Document/P", "Text": "Quote \"a\" \\ café – \U0001f600\n", "Page": 0},
+        {"Path": "//Document/Figure", "filePaths": ["figures/fileoutpart0.png"], "Page": 1},
+        [],
+        {},
+        None,
+        0.125,
+    ],
+    "pages": [{"page_number": 0, "width": 612.0, "height": 792.0}],
+    "extended_metadata": {"has_embedded_fonts": True, "pdf_version": "1.6"},
+}
+
+
+def parse(text, stream_key="elements", chunk_size=1 << 20):
+    result = dict()
+    for key, value in stage_module.iter_json_object(io.StringIO(text), stream_key, chunk_size):
+        if key == stream_key:
+            result.setdefault(key, []).append(value)
+        else:
+            result[key] = value
+    return result
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_same_as_json_load(chunk_size, indent):
+    text = json.dumps(document, indent=indent, ensure_ascii=indent is None)
+    assert parse(text, chunk_size=chunk_size) == json.loads(text)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5])
+def test_number_at_the_end_of_a_chunk(chunk_size):
+    text = '{"elements": [1.5, 2e10, -0.25], "count": 12345}'
+    assert parse(text, chunk_size=chunk_size) == json.loads(text)
+
+
+def test_empty_values():
+    assert parse("{}") == {}
+    assert parse(' { "elements" : [ ] , "pages": [] } ') == {"pages": []}
+
+
+def test_key_without_array_is_not_streamed():
+    assert parse('{"elements": {"a": 1}}') == {"elements": [{"a": 1}]}
+    assert list(stage_module.iter_json_object(io.StringIO('{"elements": 3}'), "elements")) == [
+        ("elements", 3)
+    ]
+
+
+@pytest.mark.parametrize("text", ['{"elements": [1, 2', '{"elements": [1, 2] "pages": 3}', "[1]"])
+def test_invalid_json(text):
+    with pytest.raises(ValueError):
+        parse(text, chunk_size=2)
@@ -0,0 +1,63 @@
+import datetime
+import importlib
+
+import openpyxl
+import pytest
+
+import xlsx_reader
+
+stage_module = importlib.import_module("2_process_extracted_data")
+
+
+def read_openpyxl(path):
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return list(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def save_workbook(path, rows, active=0):
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    for row_num, row in rows.items():
+        for col_num, value in enumerate(row, 1):
+            if value is not None:
+                worksheet.cell(row=row_num, column=col_num, value=value)
+    other = workbook.create_sheet("Notes")
+    other.append(["note", 1])
+    workbook.active = active
+    workbook.save(path)
+    return str(path)
+
+
+def test_same_rows_as_openpyxl(tmp_path):
+    rows = {
+        1: ["Group", "2015", None, "Share"],
+        2: ["born in US", 55, 1.25, "45%"],
+        # rows 3 and 4 are missing
+        5: [None, -3, 1e-7, True],
+        6: ["café – \"quoted\", with comma", 12345678901, None, None],
+        8: [None, None, None, "last"],
+    }
+    path = save_workbook(tmp_path / "table.xlsx", rows)
+    assert list(xlsx_reader.iter_xlsx_rows(path)) == read_openpyxl(path)
+    assert stage_module.get_xlsx_content(path) == stage_module.get_xlsx_content_openpyxl(path)
+
+
+def test_active_sheet(tmp_path):
+    path = save_workbook(tmp_path / "table.xlsx", {1: ["first sheet"]}, active=1)
+    assert list(xlsx_reader.iter_xlsx_rows(path)) == read_openpyxl(path) == [("note", 1)]
+
+
+def test_empty_sheet(tmp_path):
+    path = save_workbook(tmp_path / "table.xlsx", {})
+    assert list(xlsx_reader.iter_xlsx_rows(path)) == read_openpyxl(path)
+
+
+@pytest.mark.parametrize("value", ["=SUM(B2:B3)", datetime.date(2016, 6, 8)])
+def test_formulas_and_dates_fall_back_to_openpyxl(tmp_path, value):
+    path = save_workbook(tmp_path / "table.xlsx", {1: ["Group", 1], 2: ["total", value]})
+    with pytest.raises(xlsx_reader.UnsupportedWorkbook):
+        list(xlsx_reader.iter_xlsx_rows(path))
+    assert stage_module.get_xlsx_content(path) == stage_module.get_xlsx_content_openpyxl(path)
@@ -0,0 +1,215 @@
+import posixpath
+import xml.etree.ElementTree as ET
+import zipfile
+
+# the reader speeds up the conversion but does not remove the openpyxl dependency: these
+# helpers come from it, and workbooks with formulas or dates are still read with it
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import coordinate_to_tuple, range_boundaries
+
+SHEET_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+ROW_TAG = "{%s}row" % SHEET_MAIN_NS
+CELL_TAG = "{%s}c" % SHEET_MAIN_NS
+VALUE_TAG = "{%s}v" % SHEET_MAIN_NS
+FORMULA_TAG = "{%s}f" % SHEET_MAIN_NS
+INLINE_STRING_TAG = "{%s}is" % SHEET_MAIN_NS
+TEXT_TAG = "{%s}t" % SHEET_MAIN_NS
+RUN_TAG = "{%s}r" % SHEET_MAIN_NS
+STRING_ITEM_TAG = "{%s}si" % SHEET_MAIN_NS
+DIMENSION_TAG = "{%s}dimension" % SHEET_MAIN_NS
+DATA_TAG = "{%s}sheetData" % SHEET_MAIN_NS
+
+
+class UnsupportedWorkbook(Exception):
+    """The workbook uses a feature the reader does not handle, read it with openpyxl instead."""
+
+
+def get_text_content(element):
+    # text of a string item without formatting or phonetic runs, like openpyxl's Text.content
+    snippets = []
+    plain = element.find(TEXT_TAG)
+    if plain is not None and plain.text is not None:
+        snippets.append(plain.text)
+    for run in element.findall(RUN_TAG):
+        text = run.find(TEXT_TAG)
+        if text is not None and text.text is not None:
+            snippets.append(text.text)
+    return "".join(snippets)
+
+
+def cast_number(value):
+    if "." in value or "E" in value or "e" in value:
+        return float(value)
+    return int(value)
+
+
+def get_rels(archive, path):
+    rels_path = posixpath.join(posixpath.dirname(path), "_rels", posixpath.basename(path) + ".rels")
+    rels = {}
+    for rel in ET.fromstring(archive.read(rels_path)).iter("{%s}Relationship" % PKG_REL_NS):
+        target = rel.get("Target")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        rels[rel.get("Id")] = (rel.get("Type").rsplit("/", 1)[-1], target)
+    return rels
+
+
+def get_date_style_ids(archive, styles_path):
+    # cell styles with a date or time number format, whose numbers openpyxl turns into dates
+    if styles_path is None:
+        return set()
+    root = ET.fromstring(archive.read(styles_path))
+    formats = dict(BUILTIN_FORMATS)
+    for num_fmt in root.iter("{%s}numFmt" % SHEET_MAIN_NS):
+        formats[int(num_fmt.get("numFmtId"))] = num_fmt.get("formatCode")
+    date_style_ids = set()
+    cell_xfs = root.find("{%s}cellXfs" % SHEET_MAIN_NS)
+    for style_id, xf in enumerate(cell_xfs if cell_xfs is not None else []):
+        number_format = formats.get(int(xf.get("numFmtId", 0)))
+        if number_format is not None and is_date_format(number_format):
+            date_style_ids.add(style_id)
+    return date_style_ids
+
+
+def read_shared_strings(archive, path):
+    strings = []
+    if path is None:
+        return strings
+    with archive.open(path) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == STRING_ITEM_TAG:
+                strings.append(get_text_content(element).replace("x005F_", ""))
+                element.clear()
+    return strings
+
+
+def parse_cell(element, row_num, col_num, shared_strings, date_style_ids):
+    data_type = element.get("t", "n")
+    coordinate = element.get("r")
+    if coordinate:
+        row_num, col_num = coordinate_to_tuple(coordinate)
+
+    if element.find(FORMULA_TAG) is not None:
+        raise UnsupportedWorkbook("formula")
+
+    if data_type == "inlineStr":
+        value = None
+        child = element.find(INLINE_STRING_TAG)
+        if child is not None:
+            value = get_text_content(child)
+        return col_num, value
+
+    value = element.findtext(VALUE_TAG, None) or None
+    if value is None:
+        return col_num, None
+    if data_type == "n":
+        if int(element.get("s", 0) or 0) in date_style_ids:
+            raise UnsupportedWorkbook("date")
+        return col_num, cast_number(value)
+    if data_type == "s":
+        return col_num, shared_strings[int(value)]
+    if data_type == "b":
+        return col_num, bool(int(value))
+    if data_type == "d":
+        raise UnsupportedWorkbook("date")
+    # "str" and error values are kept as text
+    return col_num, value
+
+
+def iter_xlsx_rows(file_path):
+    """
+    Yield the rows of the active sheet as tuples of values, reading the sheet XML as a stream.
+
+    This follows openpyxl's read-only iter_rows(values_only=True): rows are padded to the
+    sheet dimension, missing rows are returned empty, shared strings lose their formatting,
+    and numbers are cast to int or float. Sheets with formulas or dates raise
+    UnsupportedWorkbook, as do workbooks whose structure is not recognized.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        root_rels = get_rels(archive, "")
+        workbook_path = [path for rel_type, path in root_rels.values() if rel_type == "officeDocument"][0]
+        workbook_rels = get_rels(archive, workbook_path)
+        workbook = ET.fromstring(archive.read(workbook_path))
+
+        sheets = workbook.find("{%s}sheets" % SHEET_MAIN_NS)
+        if sheets is None:
+            raise UnsupportedWorkbook("no sheets")
+        sheet_paths = []
+        for sheet in sheets:
+            rel_type, path = workbook_rels[sheet.get("{%s}id" % REL_NS)]
+            if rel_type != "worksheet":
+                raise UnsupportedWorkbook(rel_type)
+            sheet_paths.append(path)
+        active = 0
+        for view in workbook.iter("{%s}workbookView" % SHEET_MAIN_NS):
+            if view.get("activeTab") is not None:
+                active = int(view.get("activeTab"))
+                break
+
+        parts = {rel_type: path for rel_type, path in workbook_rels.values()}
+        shared_strings = read_shared_strings(archive, parts.get("sharedStrings"))
+        date_style_ids = get_date_style_ids(archive, parts.get("styles"))
+
+        with archive.open(sheet_paths[active]) as f:
+            yield from iter_sheet_rows(f, shared_strings, date_style_ids)
+
+
+def iter_sheet_rows(f, shared_strings, date_style_ids):
+    max_col = max_row = None
+    dimension_done = False
+    counter, idx, row_counter = 1, 1, 0
+    for _, element in ET.iterparse(f):
+        tag = element.tag
+        if tag == DIMENSION_TAG and not dimension_done:
+            _, _, max_col, max_row = range_boundaries(element.get("ref"))
+            dimension_done = True
+        elif tag == DATA_TAG:
+            # a dimension after the sheet data is ignored by openpyxl
+            dimension_done = True
+        elif tag == ROW_TAG:
+            dimension_done = True
+            if element.get("r") is not None:
+                row_counter = int(float(element.get("r")))
+            else:
+                row_counter += 1
+            col_counter, cells = 0, []
+            for cell in element:
+                col_num, value = parse_cell(
+                    cell, row_counter, col_counter + 1, shared_strings, date_style_ids
+                )
+                col_counter = col_num
+                cells.append((col_num, value))
+            element.clear()
+
+            idx = row_counter
+            if max_row is not None and idx > max_row:
+                break
+            # some rows are missing
+            empty_row = (None,) * max_col if max_col is not None else ()
+            while counter < idx:
+                counter += 1
+                yield empty_row
+            if counter <= idx:
+                counter += 1
+                yield get_row(cells, max_col)
+
+    if max_row is not None and max_row < idx:
+        empty_row = (None,) * max_col if max_col is not None else ()
+        for _ in range(counter, max_row + 1):
+            yield empty_row
+
+
+def get_row(cells, max_col):
+    if len(cells) == 0 and not max_col:
+        return ()
+    max_col = max_col or cells[-1][0]
+    row = [None] * max_col
+    for col_num, value in cells:
+        if 1 <= col_num <= max_col:
+            row[col_num - 1] = value
+    return tuple(row)
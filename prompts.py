@@ -25,6 +25,19 @@ Important guidelines:
 {memory}"""
 
 
+follow_up_question_template = """Can you answer another question based on the content of the same document?
+<question>
+{question}
+</question>
+
+Follow the same steps as for the previous question. The tool results above can be reused, call the tools again for content that is not shown above. Return the final concise answer to this question within the <final_result></final_result> tags, leave the explanation outside of the <final_result> tags.
+{memory}"""
+
+
+collapsed_outline_note = """
+- To keep the outline short, sections with collapsed="true" only show their heading, the number of subsections, paragraphs, tables and images they contain, and their page span. Use the expand_outline tool to see their outline."""
+
+
 reviewer_prompt = """
 Now, please validate the answer using the tools to retrieve the source of information that can be used to answer the question. Only use necessary tools. Return the final concise answer within the <final_result></final_result> tags, leave the explanation outside of the <final_result> tags. 
 """
@@ -33,6 +46,10 @@ reflection_prompt_template = """Please update the reflection listed within the <
 
 <guideline>{memory}</guideline>"""
 
+memory_bank_reflection_prompt_template = """Please update the guidelines listed within the <guidelines></guidelines> tags below so that they help you perform better next time. Express the update as operations: <add>new guideline</add> adds a guideline, <edit id="ID">revised guideline</edit> revises the guideline with that id and <remove id="ID"/> removes a guideline that is wrong or redundant. Use at most two operations, keep each guideline to one concise and clear sentence that also applies to other documents and questions, and provide the operations within the <operations></operations> tags. Write <operations></operations> if no update is needed.
+
+<guidelines>{memory}</guidelines>"""
+
 
 search_tool_description = {
         "type": "function",
@@ -123,5 +140,97 @@ get_table_image_tool_description = {
             }
         }
     }
+get_region_image_tool_description = {
+        "type": "function",
+        "function": {
+            "name": "get_region_image",
+            "description": "Get a cropped image of one region of a page, such as a paragraph, table or chart, using the bbox attribute of the element. Use this tool instead of get_page_images when only one element needs visual confirmation",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "page_num": {
+                        "type": "integer",
+                        "description": "The page number of the element, 1-indexed"
+                    },
+                    "bbox": {
+                        "type": "string",
+                        "description": "The bbox attribute of the element, in the format x0,y0,x1,y1"
+                    }
+                },
+                "required": ["page_num", "bbox"]
+            }
+        }
+    }
+
+expand_outline_tool_description = {
+        "type": "function",
+        "function": {
+            "name": "expand_outline",
+            "description": "Show the outline of a section whose content is collapsed in the document outline, including its subsections down to the given depth",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "section_id": {
+                        "type": "string",
+                        "description": "The id of the section to expand"
+                    },
+                    "depth": {
+                        "type": "integer",
+                        "description": "The number of subsection levels to show, 1 by default"
+                    }
+                },
+                "required": ["section_id"]
+            }
+        }
+    }
+
+query_table_tool_description = {
+        "type": "function",
+        "function": {
+            "name": "query_table",
+            "description": "Get selected rows and columns of a table as CSV. Long tables are truncated in the outline, sections and search results, use this tool to look up the rows that are not shown",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "table_id": {
+                        "type": "string",
+                        "description": "The ID of the table to query"
+                    },
+                    "columns": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The names of the columns to return, all columns by default"
+                    },
+                    "row_filter": {
+                        "type": "string",
+                        "description": "Conditions on the rows, like \"Group contains born and 2015 >= 50\" with the operators =, !=, >, >=, <, <= and contains, or a text that one of the cells of the row contains. All rows by default"
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "The maximum number of rows to return, 20 by default"
+                    }
+                },
+                "required": ["table_id"]
+            }
+        }
+    }
+
+corpus_search_tool_description = {
+        "type": "function",
+        "function": {
+            "name": "corpus_search",
+            "description": "Find the documents of the collection that contain the query words, with the headings and pages of their best matching sections. Only the current document can be read with the other tools, the other documents are listed for reference",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The words to search for"
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    }
 
-available_tools = [search_tool_description, get_section_content_tool_description, get_page_images_tool_description, get_image_tool_description, get_table_image_tool_description]
\ No newline at end of file
+available_tools = [search_tool_description, get_section_content_tool_description, get_page_images_tool_description, get_image_tool_description, get_table_image_tool_description, get_region_image_tool_description, expand_outline_tool_description, query_table_tool_description]
\ No newline at end of file
@@ -0,0 +1,141 @@
+import json
+import re
+
+confidence_prompt = """
+- Before the final answer, rate your confidence in it as high, medium or low within the <confidence></confidence> tags."""
+
+
+def get_trajectory_features(messages, final_response):
+    """Summarize an actor trajectory (messages as returned by DocAgent.run_agent)."""
+    num_round, used_images, last_content = 0, False, ""
+    for item in messages:
+        if "model" in item:  # from assistant
+            message = item["choices"][0]["message"]
+            if message.get("tool_calls"):
+                num_round += 1
+            last_content = message.get("content") or ""
+        elif item["role"] == "user" and isinstance(item["content"], list):
+            if any(content["type"] == "image_url" for content in item["content"]):
+                used_images = True
+
+    match_result = re.search(
+        r"<confidence>\s*(high|medium|low)\s*</confidence>", last_content, re.IGNORECASE
+    )
+    confidence = match_result.group(1).lower() if match_result is not None else None
+
+    return {
+        "num_round": num_round,
+        "used_images": used_images,
+        "answer_type": get_answer_type(final_response),
+        "has_final_result": "<final_result>" in last_content,
+        "confidence": confidence,
+    }
+
+
+def get_answer_type(answer):
+    answer = answer.strip().lower().rstrip(".")
+    if answer in ["yes", "no"]:
+        return "yes_no"
+    if re.fullmatch(r"[-+$€£]?\d[\d,]*(\.\d+)?\s*(%|percent)?", answer):
+        return "number"
+    if len(answer.split()) <= 5:
+        return "short"
+    return "long"
+
+
+def normalize_answer(answer):
+    answer = str(answer).lower()
+    answer = re.sub(r"[^\w%.]+", " ", answer)
+    return " ".join(answer.replace(" .", " ").split()).strip(".")
+
+
+def answer_matches(prediction, answer):
+    # the answer's words appear in a row in the prediction, so "1" does not match "10"
+    prediction, answer = normalize_answer(prediction).split(), normalize_answer(answer).split()
+    return len(answer) > 0 and any(
+        prediction[start : start + len(answer)] == answer for start in range(len(prediction) - len(answer) + 1)
+    )
+
+
+class ReviewPolicy:
+    """
+    Decides from the actor trajectory whether the reviewer runs.
+
+    decide returns "skip" (keep the actor answer), "single" (one round of tool calls
+    before the reviewer has to answer) or "full" (the regular reviewer loop).
+    """
+
+    # extra instruction appended to the actor prompt, e.g. to ask for a confidence tag
+    actor_instructions = ""
+
+    def decide(self, features):
+        raise NotImplementedError
+
+
+class AlwaysReviewPolicy(ReviewPolicy):
+    def decide(self, features):
+        return "full"
+
+
+class HeuristicReviewPolicy(ReviewPolicy):
+    """
+    Skips review for confident, short answers found with few tool rounds, runs the full
+    review for unsure or unextracted answers and a single-round review otherwise.
+    """
+
+    actor_instructions = confidence_prompt
+
+    def __init__(self, max_skip_rounds=2, skip_answer_types=("yes_no", "number", "short")):
+        self.max_skip_rounds = max_skip_rounds
+        self.skip_answer_types = skip_answer_types
+
+    def decide(self, features):
+        if not features["has_final_result"] or features["num_round"] == 0:
+            return "full"
+        if features["confidence"] in [None, "low"]:
+            return "full"
+        if (
+            features["confidence"] == "high"
+            and features["num_round"] <= self.max_skip_rounds
+            and features["answer_type"] in self.skip_answer_types
+        ):
+            return "skip"
+        return "single"
+
+
+review_policies = {"always": AlwaysReviewPolicy, "heuristic": HeuristicReviewPolicy}
+
+
+def get_review_policy(name):
+    return review_policies[name]()
+
+
+def summarize_review_log(log_path):
+    """
+    Skip rates per decision and, where ground truth was logged, accuracy deltas. Skipped
+    reviews keep the actor answer, so they only get the actor accuracy.
+    """
+    summary = dict()
+    with open(log_path) as f:
+        for line in f:
+            item = json.loads(line)
+            stats = summary.setdefault(
+                item["decision"],
+                {"count": 0, "changed": 0, "scored": 0, "actor_correct": 0, "reviewer_correct": 0},
+            )
+            stats["count"] += 1
+            stats["changed"] += int(item["changed"])
+            if item.get("actor_correct") is not None:
+                stats["scored"] += 1
+                stats["actor_correct"] += int(item["actor_correct"])
+                stats["reviewer_correct"] += int(item["reviewer_correct"])
+
+    num_total = sum(stats["count"] for stats in summary.values())
+    for decision, stats in summary.items():
+        stats["rate"] = stats["count"] / num_total
+        if stats["scored"] > 0:
+            stats["actor_accuracy"] = stats["actor_correct"] / stats["scored"]
+            if decision != "skip":
+                stats["reviewer_accuracy"] = stats["reviewer_correct"] / stats["scored"]
+                stats["accuracy_delta"] = stats["reviewer_accuracy"] - stats["actor_accuracy"]
+    return summary
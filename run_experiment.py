@@ -1,16 +1,41 @@
 import argparse
 import json
 import os
+import time
+import traceback
+import zlib
+from collections import OrderedDict
 
+import batch
+import corpus_index
 import doc_agent
 import doc_reader
+import lease
+import llm_client
+import memory_bank
+import model_routing
+import review_policy
+from context_window import ContextWindowManager
+from evaluate import get_usage, model_prices
 
 parser = argparse.ArgumentParser(description="Run experiment")
 parser.add_argument(
     "--api-key",
     type=str,
     default=os.getenv("OPENAI_API_KEY", "sk-proj-XXXXXXXXXXXXXXXXXXXXXX"),
-    help="API key (or set OPENAI_API_KEY env var)",
+    help="API key, or comma-separated keys to balance the load over (or set OPENAI_API_KEY env var)",
+)
+parser.add_argument(
+    "--base-urls",
+    type=str,
+    default=os.getenv("OPENAI_BASE_URLS"),
+    help="Comma-separated base URLs of OpenAI-compatible endpoints (or set OPENAI_BASE_URLS env var)",
+)
+parser.add_argument(
+    "--endpoint-weights",
+    type=str,
+    default=None,
+    help="Comma-separated weights of the keys or base URLs for round-robin load balancing",
 )
 parser.add_argument(
     "--save-dir",
@@ -30,66 +55,577 @@ parser.add_argument(
     default="./sample_data/",
     help="Raw data directory",
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--reader-cache-mb",
+    type=int,
+    default=2048,
+    help="Memory budget in MB for loaded documents shared across samples",
+)
+parser.add_argument(
+    "--batch-backend",
+    type=str,
+    default="none",
+    choices=["none", "openai", "local"],
+    help="Send the first actor request of every sample through a batch API",
+)
+parser.add_argument(
+    "--batch-dir",
+    type=str,
+    default="./batch_output/",
+    help="Directory for batch input/output files",
+)
+parser.add_argument(
+    "--batch-poll-interval",
+    type=int,
+    default=60,
+    help="Seconds between checks whether the batch is finished",
+)
+parser.add_argument(
+    "--memory-mode",
+    type=str,
+    default="text",
+    choices=["text", "bank"],
+    help="Keep one free-text guideline (text) or a bank of guidelines selected per question (bank)",
+)
+parser.add_argument(
+    "--memory-token-budget",
+    type=int,
+    default=300,
+    help="Token budget of the guidelines selected from the memory bank for a prompt",
+)
+parser.add_argument(
+    "--worker-id",
+    type=str,
+    default="0",
+    help="ID of this worker when several workers share the memory bank",
+)
+parser.add_argument(
+    "--memory-sync-every",
+    type=int,
+    default=1,
+    help="Merge the memory bank operations of other workers every N samples",
+)
+parser.add_argument(
+    "--outline-depth",
+    type=int,
+    default=None,
+    help="Show only this many section levels in the initial outline, deeper sections are expanded with a tool",
+)
+parser.add_argument(
+    "--context-budget",
+    type=int,
+    default=None,
+    help="Token budget per completion, older tool outputs are replaced by stubs beyond it",
+)
+parser.add_argument(
+    "--max-retries",
+    type=int,
+    default=5,
+    help="Retries of rate limit, timeout, connection and server errors per LLM call",
+)
+parser.add_argument(
+    "--tool-call-wait-time",
+    type=float,
+    default=10,
+    help="Seconds to wait between tool rounds to reduce rate limit errors",
+)
+parser.add_argument(
+    "--corpus-index-dir",
+    type=str,
+    default=None,
+    help="Index built with corpus_index.py, gives the agents the corpus_search tool",
+)
+parser.add_argument(
+    "--shard",
+    type=str,
+    default="0/1",
+    help="Run only the samples of shard i out of n (i/n), by sample index modulo n",
+)
+parser.add_argument(
+    "--lease-timeout",
+    type=int,
+    default=600,
+    help="Seconds without heartbeat after which the job of a crashed worker is taken over",
+)
+parser.add_argument(
+    "--review-policy",
+    type=str,
+    default="always",
+    choices=list(review_policy.review_policies.keys()),
+    help="Policy deciding whether the reviewer runs after the actor",
+)
+parser.add_argument("--model-id", type=str, default="gpt-4o", help="Model of all phases without their own model")
+parser.add_argument("--actor-model", type=str, default=None, help="Model of the actor, --model-id by default")
+parser.add_argument("--reviewer-model", type=str, default=None, help="Model of the reviewer, --model-id by default")
+parser.add_argument(
+    "--reflection-model", type=str, default=None, help="Model of the reflection, --model-id by default"
+)
+parser.add_argument(
+    "--escalation-model",
+    type=str,
+    default=None,
+    help="Stronger model that answers again when the actor or reviewer model struggles, none by default",
+)
+parser.add_argument(
+    "--escalate-on",
+    type=str,
+    default=",".join(model_routing.escalation_signals),
+    help="Comma-separated signals for escalation: max_round (the actor used up its tool rounds), "
+    "no_final_result (the actor gave no final result) and disagreement (the reviewer changed the answer)",
+)
+parser.add_argument(
+    "--group-by-doc",
+    action="store_true",
+    help="Answer the samples of a document one after another, sharing its outline and tool replies "
+    "(shards are then split by document)",
+)
+parser.add_argument(
+    "--questions-per-conversation",
+    type=int,
+    default=1,
+    help="With --group-by-doc, ask up to this many questions about a document in one actor conversation",
+)
+parser.add_argument(
+    "--conversation-token-limit",
+    type=int,
+    default=32000,
+    help="Start a new actor conversation once the previous one is estimated to exceed this many tokens",
+)
+
+
+def answer_question(
+    agent,
+    question,
+    memory,
+    enable_reflection=True,
+    first_response=None,
+    policy=None,
+    task_id=None,
+    prompt_memory=None,
+    previous_messages=None,
+):
+    """Run actor, reviewer and (if the answers differ) reflection for one question.
+
+    memory is a memory_bank.TextMemory or memory_bank.MemoryBank and is updated in place
+    by the reflection loop. first_response optionally holds the already obtained first
+    actor completion together with the prompt_memory it was requested with, and policy
+    decides whether and how long the reviewer runs (always the full review by default).
+    previous_messages optionally holds the actor messages of an earlier question about the
+    same document, whose conversation the actor continues; the saved actor messages then
+    start with them, and num_previous_messages counts them. Returns the result dict to be saved.
+    """
+    if policy is None:
+        policy = review_policy.AlwaysReviewPolicy()
+    result = {}
+    # model of each phase, the signals that made a phase run again on the escalation model and
+    # the messages of the runs replaced by it
+    router = agent.model_router
+    models, escalations, escalated_messages = {}, [], {}
+    # wall time of each phase in seconds, joined with the scores by evaluate.py
+    timing = {}
+    start_time = time.time()
+    if prompt_memory is None:
+        prompt_memory = memory.get_prompt_memory(question, task_id)
+    # the actor messages of earlier questions in the conversation, saved with their own jobs
+    num_previous = len(previous_messages) if previous_messages is not None else 0
+
+    # run actor loop
+    agent.report_progress({"event": "phase_start", "phase": "actor"})
+    final_response, messages = agent.run_actor(
+        question=question,
+        memory=prompt_memory,
+        first_response=first_response,
+        instructions=policy.actor_instructions,
+        previous_messages=previous_messages,
+    )
+    models["actor"] = agent.run_stats["actor"]["model"]
+    reason = router.get_actor_escalation(agent.run_stats["actor"]) if router is not None else None
+    if reason is not None:
+        agent.report_progress(
+            {"event": "escalate", "phase": "actor", "reason": reason, "model": router.escalation_model}
+        )
+        escalations.append({"phase": "actor", "reason": reason, "model": models["actor"]})
+        escalated_messages["actor"] = messages[num_previous:]
+        final_response, messages = agent.run_actor(
+            question=question,
+            memory=prompt_memory,
+            instructions=policy.actor_instructions,
+            previous_messages=previous_messages,
+            escalated=True,
+        )
+        models["actor"] = agent.run_stats["actor_escalated"]["model"]
+
+    result["actor_response"] = final_response
+    result["actor_messages"] = messages
+    result["num_previous_messages"] = num_previous
+    timing["actor"] = time.time() - start_time
+    agent.report_progress(
+        {"event": "phase_end", "phase": "actor", "response": final_response}
+    )
+
+    # only the rounds of this question, not those of earlier questions in the conversation
+    features = review_policy.get_trajectory_features(messages[num_previous:], final_response)
+    decision = policy.decide(features)
+    result["review"] = {"decision": decision, "features": features}
+
+    if decision == "skip":
+        result["reviewer_response"] = final_response
+        result["reviewer_messages"] = []
+    else:
+        # run reviewer loop, a single-round review has to answer after one round of tools
+        agent.report_progress({"event": "phase_start", "phase": "reviewer"})
+        final_response_reviewer, messages_reviewer = agent.run_reviewer(
+            initial_messages=result["actor_messages"],
+            max_round=0 if decision == "single" else 10,
+        )
+        models["reviewer"] = agent.run_stats["reviewer"]["model"]
+        reason = (
+            router.get_reviewer_escalation(final_response, final_response_reviewer)
+            if router is not None
+            else None
+        )
+        if reason is not None:
+            agent.report_progress(
+                {"event": "escalate", "phase": "reviewer", "reason": reason, "model": router.escalation_model}
+            )
+            escalations.append({"phase": "reviewer", "reason": reason, "model": models["reviewer"]})
+            escalated_messages["reviewer"] = messages_reviewer[len(result["actor_messages"]) :]
+            final_response_reviewer, messages_reviewer = agent.run_reviewer(
+                initial_messages=result["actor_messages"],
+                max_round=0 if decision == "single" else 10,
+                escalated=True,
+            )
+            models["reviewer"] = agent.run_stats["reviewer_escalated"]["model"]
+
+        result["reviewer_response"] = final_response_reviewer
+        result["reviewer_messages"] = messages_reviewer[len(result["actor_messages"]) :]
+        timing["reviewer"] = time.time() - start_time - timing["actor"]
+        agent.report_progress(
+            {"event": "phase_end", "phase": "reviewer", "response": final_response_reviewer}
+        )
+    final_response_reviewer = result["reviewer_response"]
+
+    if enable_reflection and final_response_reviewer != final_response:
+        # update memory with reflection loop
+        agent.report_progress({"event": "phase_start", "phase": "reflection"})
+        reflection_start_time = time.time()
+        initial_messages = result["actor_messages"] + result["reviewer_messages"]
+        reflection_messages = memory.reflect(
+            agent, initial_messages, question, task_id, prompt_memory
+        )
+
+        result["reflection_messages"] = reflection_messages[len(initial_messages) :]
+        models["reflection"] = agent.run_stats["reflection"]["model"]
+        timing["reflection"] = time.time() - reflection_start_time
+        agent.report_progress({"event": "phase_end", "phase": "reflection"})
+
+    result["memory"] = memory.describe(prompt_memory)
+    timing["total"] = time.time() - start_time
+    result["timing"] = timing
+    result["models"] = models
+    result["escalations"] = escalations
+    if len(escalated_messages) > 0:
+        result["escalated_messages"] = escalated_messages
+    # evaluate.py recomputes the cost with its --prices
+    usage = get_usage(result, model_prices)
+    result["usage"] = {
+        key: usage[key] for key in ["num_calls", "prompt_tokens", "completion_tokens", "cost", "cost_by_model"]
+    }
+    return result
+
+
+def get_batch_backend(args, client):
+    if args.batch_backend == "openai":
+        return batch.OpenAIBatchBackend(client.get_client())
+    elif args.batch_backend == "local":
+        return batch.LocalBatchBackend(os.path.join(args.batch_dir, "local"), client)
+    raise ValueError(f"Unknown batch backend {args.batch_backend}")
+
+
+def get_run_config(args):
+    # settings that change cost or quality, saved with every result to compare runs
+    return {
+        "model_id": args.model_id,
+        "review_policy": args.review_policy,
+        "outline_depth": args.outline_depth,
+        "context_budget": args.context_budget,
+        "memory_mode": args.memory_mode,
+        "memory_token_budget": args.memory_token_budget if args.memory_mode == "bank" else None,
+        "batch_backend": args.batch_backend,
+        "corpus_search": args.corpus_index_dir is not None,
+        "questions_per_conversation": args.questions_per_conversation if args.group_by_doc else 1,
+        **get_model_router(args).describe(),
+    }
+
+
+def get_model_router(args):
+    return model_routing.ModelRouter(
+        default_model=args.model_id,
+        phase_models={
+            "actor": args.actor_model,
+            "reviewer": args.reviewer_model,
+            "reflection": args.reflection_model,
+        },
+        escalation_model=args.escalation_model,
+        escalate_on=[signal.strip() for signal in args.escalate_on.split(",") if signal.strip()],
+    )
+
+
+def can_continue_conversation(conversation, doc_id, args):
+    """Whether the next question about doc_id can be asked in the last actor conversation."""
+    if not args.group_by_doc or args.questions_per_conversation <= 1 or conversation is None:
+        return False
+    conversation_doc_id, messages, num_questions = conversation
+    if conversation_doc_id != doc_id or num_questions >= args.questions_per_conversation:
+        return False
+    # an answer without final result or a long conversation would mislead or crowd out the next one
+    last_message = doc_agent.get_api_messages(messages[-1:])[0]
+    if "<final_result>" not in (last_message.get("content") or ""):
+        return False
+    context_window = ContextWindowManager()
+    num_tokens = sum(
+        context_window.estimate_num_tokens(message)
+        for message in doc_agent.get_api_messages(messages)
+    )
+    return num_tokens <= args.conversation_token_limit
+
+
+def iter_leased_jobs(queue, pending, poll_interval):
+    """
+    Yield the pending jobs leased by this worker, the caller releases each lease when done.
+
+    Jobs leased by other workers are checked again until they have a result, so that the
+    jobs of a crashed worker are taken over once its leases expire.
+    """
+    while len(pending) > 0:
+        waiting = []
+        for index, sample, save_path in pending:
+            if os.path.exists(save_path):
+                continue
+            if not queue.try_acquire("job_%05d" % index):
+                waiting.append((index, sample, save_path))
+                continue
+            if os.path.exists(save_path):  # finished by another worker since the check
+                queue.release("job_%05d" % index)
+                continue
+            yield index, sample, save_path
+        pending = waiting
+        if len(pending) > 0:
+            print(f"Waiting for {len(pending)} jobs leased by other workers")
+            time.sleep(poll_interval)
 
 
 def main(args):
     os.makedirs(args.save_dir, exist_ok=True)
+    run_config = get_run_config(args)
+    shard_index, num_shards = lease.parse_shard(args.shard)
+    # several processes or machines sharing the save directory lease jobs from each other
+    queue = lease.LeaseQueue(
+        os.path.join(args.save_dir, "leases"),
+        lease_timeout=args.lease_timeout,
+        heartbeat_interval=args.lease_timeout / 10,
+    )
 
     dataset = sorted(os.listdir(args.raw_data_dir))
+    registry = doc_reader.get_registry(max_memory_mb=args.reader_cache_mb)
+    client = llm_client.get_client_pool(
+        api_keys=args.api_key, base_urls=args.base_urls, weights=args.endpoint_weights
+    )
+    policy = review_policy.get_review_policy(args.review_policy)
+    router = get_model_router(args)
+    corpus = None
+    if args.corpus_index_dir is not None:
+        corpus = corpus_index.get_corpus_index(args.corpus_index_dir)
+    review_log_path = os.path.join(args.save_dir, "review_log.jsonl")
+    # state of interrupted agent loops, resumed when the script is run again
+    checkpoint_dir = os.path.join(args.save_dir, "checkpoints")
+    os.makedirs(checkpoint_dir, exist_ok=True)
 
-    # initialize empty memory
-    memory = ""
+    # initialize empty memory, a memory bank is rebuilt from the operation logs of all workers
+    memory_bank_path = os.path.join(args.save_dir, "memory_bank.json")
+    if args.memory_mode == "bank":
+        memory = memory_bank.MemoryBank(
+            token_budget=args.memory_token_budget,
+            worker_id=args.worker_id,
+            op_log_dir=os.path.join(args.save_dir, "memory_ops"),
+        )
+    else:
+        memory = memory_bank.TextMemory()
 
+    pending = []
     for index in range(len(dataset)):
-
+        if not args.group_by_doc and index % num_shards != shard_index:
+            continue
         sample = json.load(
             open(os.path.join(args.raw_data_dir, dataset[index], "sample.json"))
         )
-        doc_id = sample["doc_id"][:-4]
-
-        save_path = os.path.join(args.save_dir, "job_" + str("%05d" % index) + ".json")
-        if os.path.exists(save_path):
+        # the samples of a document stay in one shard, so that they share its cache
+        if args.group_by_doc and zlib.crc32(sample["doc_id"].encode("utf-8")) % num_shards != shard_index:
             continue
-        result = {"doc_id": doc_id}
-        print("Processing", index)
+        save_path = os.path.join(args.save_dir, "job_" + str("%05d" % index) + ".json")
+        if not os.path.exists(save_path):
+            pending.append((index, sample, save_path))
+    if args.group_by_doc:
+        pending.sort(key=lambda job: (job[1]["doc_id"], job[0]))
 
-        # load document and initialize agent
-        document = doc_reader.DocReader(
-            data_path=os.path.join(args.preprocessed_data_dir, doc_id)
-        )
-        agent = doc_agent.DocAgent(document, model_id="gpt-4o", api_key=args.api_key)
+    first_responses, prompt_memories = dict(), dict()
+    if args.batch_backend != "none":
+        # the first actor turns do not depend on each other, so they are sent as one batch.
+        # They are built with the initial memory, as reflection has not run yet.
+        requests = []
+        for index, sample, _ in pending:
+            document = registry.get(
+                os.path.join(args.preprocessed_data_dir, sample["doc_id"][:-4])
+            )
+            agent = doc_agent.DocAgent(
+                document,
+                model_id=run_config["model_id"],
+                model_router=router,
+                client=client,
+                context_budget=args.context_budget,
+                outline_depth=args.outline_depth,
+                corpus_index=corpus,
+            )
+            task_id = "job_%05d" % index
+            prompt_memories[task_id] = memory.get_prompt_memory(sample["question"], task_id)
+            request = agent.get_actor_request(
+                sample["question"],
+                prompt_memories[task_id],
+                instructions=policy.actor_instructions,
+            )
+            requests.append((task_id, request))
+        # each shard sends its own batch, and only one worker of a shard submits it while the
+        # others wait for it and then reuse its responses
+        batch_dir = args.batch_dir
+        if num_shards > 1:
+            batch_dir = os.path.join(args.batch_dir, "shard_%d_of_%d" % (shard_index, num_shards))
+        batch_lease = "batch_%d_of_%d" % (shard_index, num_shards)
+        while not queue.try_acquire(batch_lease):
+            print("Waiting for the batch of another worker of this shard")
+            time.sleep(args.lease_timeout / 10)
+        try:
+            first_responses = batch.run_batch(
+                get_batch_backend(args, client),
+                requests,
+                batch_dir,
+                poll_interval=args.batch_poll_interval,
+            )
+        finally:
+            queue.release(batch_lease)
 
-        # run actor loop
-        final_response, messages = agent.run_actor(
-            question=sample["question"], memory=memory
-        )
+    failed = []
+    # outline and tool replies of the last few documents, and the last actor conversation as
+    # (doc_id, actor messages, number of questions asked in it)
+    document_caches, conversation = OrderedDict(), None
+    jobs = iter_leased_jobs(queue, pending, poll_interval=args.lease_timeout / 10)
+    for num_processed, (index, sample, save_path) in enumerate(jobs):
+        if args.memory_mode == "bank" and num_processed % args.memory_sync_every == 0:
+            memory.sync()
 
-        result["actor_response"] = final_response
-        result["actor_messages"] = messages
+        doc_id = sample["doc_id"][:-4]
+        result = {"doc_id": doc_id, "sample_id": dataset[index], "config": run_config}
+        print("Processing", index)
 
-        # run reviewer loop
-        final_response_reviewer, messages_reviewer = agent.run_reviewer(
-            initial_messages=result["actor_messages"]
+        # load document (reused across samples of the same document) and initialize agent
+        document = registry.get(os.path.join(args.preprocessed_data_dir, doc_id))
+        document_cache = None
+        if args.group_by_doc:
+            if doc_id not in document_caches:
+                document_caches[doc_id] = doc_agent.DocumentCache()
+                if len(document_caches) > 4:
+                    document_caches.popitem(last=False)
+            document_cache = document_caches[doc_id]
+            document_caches.move_to_end(doc_id)
+        previous_messages = None
+        if "job_%05d" % index not in first_responses and can_continue_conversation(
+            conversation, doc_id, args
+        ):
+            previous_messages = conversation[1]
+        agent = doc_agent.DocAgent(
+            document,
+            model_id=run_config["model_id"],
+            model_router=router,
+            client=client,
+            context_budget=args.context_budget,
+            outline_depth=args.outline_depth,
+            max_retries=args.max_retries,
+            tool_call_wait_time=args.tool_call_wait_time,
+            checkpoint_path=os.path.join(checkpoint_dir, "job_%05d.jsonl" % index),
+            corpus_index=corpus,
+            document_cache=document_cache,
         )
 
-        result["reviewer_response"] = final_response_reviewer
-        result["reviewer_messages"] = messages_reviewer[len(result["actor_messages"]) :]
-
-        if final_response_reviewer != final_response:
-            # update memory with reflection loop
-            initial_messages = result["actor_messages"] + result["reviewer_messages"]
-            memory, reflection_messages = agent.run_reflection(
-                initial_messages=initial_messages, memory=memory
+        try:
+            sample_result = answer_question(
+                agent,
+                sample["question"],
+                memory,
+                first_response=first_responses.get("job_%05d" % index),
+                policy=policy,
+                task_id="job_%05d" % index,
+                prompt_memory=prompt_memories.get("job_%05d" % index),
+                previous_messages=previous_messages,
             )
+        except Exception:
+            # no result is saved, the next run resumes the job from its checkpoint
+            print(traceback.format_exc())
+            print("Failed", index)
+            failed.append(index)
+            conversation = None
+            queue.release("job_%05d" % index)
+            continue
+        result.update(sample_result)
+        if not queue.is_held("job_%05d" % index) and os.path.exists(save_path):
+            # the lease expired and another worker finished the job first, nothing of
+            # this run is logged or continued
+            print("Discard result of", index, "the job was taken over by another worker")
+            conversation = None
+            continue
+        num_questions = conversation[2] + 1 if previous_messages is not None else 1
+        conversation = (doc_id, result["actor_messages"], num_questions)
+        if args.memory_mode == "bank":
+            memory.save(memory_bank_path)
 
-            result["reflection_messages"] = reflection_messages[len(initial_messages) :]
-
-        result["memory"] = memory
+        # log review decisions to tune the cost/quality tradeoff of the policy
+        review_log = {
+            "job": "job_%05d" % index,
+            "decision": result["review"]["decision"],
+            "changed": result["reviewer_response"] != result["actor_response"],
+            "actor_correct": None,
+            "reviewer_correct": None,
+        }
+        review_log.update(result["review"]["features"])
+        if "answer" in sample:
+            review_log["actor_correct"] = review_policy.answer_matches(
+                result["actor_response"], sample["answer"]
+            )
+            review_log["reviewer_correct"] = review_policy.answer_matches(
+                result["reviewer_response"], sample["answer"]
+            )
+        with open(review_log_path, "a") as f:
+            f.write(json.dumps(review_log) + "\n")
 
-        with open(save_path, "w") as f:
+        # the temporary file is unique per worker, other workers may save the same job
+        tmp_path = f"{save_path}.{queue.worker_id.replace(':', '_')}.tmp"
+        with open(tmp_path, "w") as f:
             json.dump(result, f, indent=4)
+        os.replace(tmp_path, save_path)
+        agent.clear_checkpoint()
+        queue.release("job_%05d" % index)
+
+    queue.close()
+    print("Document cache:", registry.stats())
+    for doc_id, document_cache in document_caches.items():
+        print("Tool reply cache of", doc_id, document_cache.stats())
+    for endpoint_stats in client.stats():
+        print("LLM endpoint:", endpoint_stats)
+    if len(failed) > 0:
+        print(f"{len(failed)} samples failed, run again to resume them:", failed)
+    if os.path.exists(review_log_path):
+        for decision, stats in review_policy.summarize_review_log(review_log_path).items():
+            print("Review", decision, stats)
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main(args)
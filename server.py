@@ -0,0 +1,468 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import corpus_index
+import doc_agent
+import doc_reader
+import llm_client
+import memory_bank
+import review_policy
+from run_experiment import answer_question
+
+parser = argparse.ArgumentParser(description="Serve DocAgent over a local HTTP API")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+parser.add_argument("--port", type=int, default=8080, help="Port to bind")
+parser.add_argument(
+    "--api-key",
+    type=str,
+    default=os.getenv("OPENAI_API_KEY", "sk-proj-XXXXXXXXXXXXXXXXXXXXXX"),
+    help="API key, or comma-separated keys to balance the load over (or set OPENAI_API_KEY env var)",
+)
+parser.add_argument(
+    "--base-urls",
+    type=str,
+    default=os.getenv("OPENAI_BASE_URLS"),
+    help="Comma-separated base URLs of OpenAI-compatible endpoints (or set OPENAI_BASE_URLS env var)",
+)
+parser.add_argument(
+    "--endpoint-weights",
+    type=str,
+    default=None,
+    help="Comma-separated weights of the keys or base URLs for round-robin load balancing",
+)
+parser.add_argument(
+    "--preprocessed-data-dir",
+    type=str,
+    default="./preprocess/processed_output/",
+    help="Preprocessed data directory",
+)
+parser.add_argument("--model-id", type=str, default="gpt-4o", help="Model to use")
+parser.add_argument(
+    "--max-concurrency",
+    type=int,
+    default=4,
+    help="Number of questions answered at the same time",
+)
+parser.add_argument(
+    "--max-queue-size",
+    type=int,
+    default=64,
+    help="Number of waiting questions before new requests are rejected",
+)
+parser.add_argument(
+    "--reader-cache-mb",
+    type=int,
+    default=2048,
+    help="Memory budget in MB for documents kept in memory",
+)
+parser.add_argument(
+    "--tool-call-wait-time",
+    type=float,
+    default=0,
+    help="Seconds to wait between tool rounds",
+)
+parser.add_argument(
+    "--outline-depth",
+    type=int,
+    default=None,
+    help="Show only this many section levels in the initial outline, deeper sections are expanded with a tool",
+)
+parser.add_argument(
+    "--context-budget",
+    type=int,
+    default=None,
+    help="Token budget per completion, older tool outputs are replaced by stubs beyond it",
+)
+parser.add_argument(
+    "--review-policy",
+    type=str,
+    default="always",
+    choices=list(review_policy.review_policies.keys()),
+    help="Policy deciding whether the reviewer runs after the actor",
+)
+parser.add_argument(
+    "--memory-mode",
+    type=str,
+    default="text",
+    choices=["text", "bank"],
+    help="Keep one free-text guideline (text) or a bank of guidelines selected per question (bank)",
+)
+parser.add_argument(
+    "--corpus-index-dir",
+    type=str,
+    default=None,
+    help="Index built with corpus_index.py, gives the agents the corpus_search tool",
+)
+parser.add_argument(
+    "--disable-reflection",
+    action="store_true",
+    help="Do not update the shared memory with the reflection loop",
+)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, doc_id, question):
+        self.job_id = job_id
+        self.doc_id = doc_id
+        self.question = question
+        self.status = "queued"
+        self.events = []
+        self.result = None
+        self.error = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.condition = threading.Condition()
+
+    def add_event(self, event):
+        with self.condition:
+            event = dict(event, time=time.time())
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def set_status(self, status):
+        # under the same lock as the event, so a stream that sees the job done has its last event
+        with self.condition:
+            self.status = status
+            self.add_event({"event": "status", "status": status})
+
+    def is_done(self):
+        return self.status in ["completed", "failed"]
+
+    def to_dict(self, include_result=True):
+        item = {
+            "job_id": self.job_id,
+            "doc_id": self.doc_id,
+            "question": self.question,
+            "status": self.status,
+            "error": self.error,
+        }
+        if include_result and self.result is not None:
+            item["actor_response"] = self.result["actor_response"]
+            item["reviewer_response"] = self.result["reviewer_response"]
+        return item
+
+
+class DocAgentService:
+    """
+    Keeps documents and the LLM client warm and answers questions in a bounded worker pool.
+
+    Waiting jobs beyond max_queue_size are rejected with QueueFullError. Finished jobs are
+    kept for polling until max_finished_jobs is exceeded.
+    """
+
+    def __init__(
+        self,
+        preprocessed_data_dir,
+        api_key=None,
+        base_urls=None,
+        endpoint_weights=None,
+        model_id="gpt-4o",
+        max_concurrency=4,
+        max_queue_size=64,
+        reader_cache_mb=2048,
+        tool_call_wait_time=0,
+        enable_reflection=True,
+        max_finished_jobs=1000,
+        policy=None,
+        memory=None,
+        context_budget=None,
+        outline_depth=None,
+        corpus_index_dir=None,
+    ):
+        self.preprocessed_data_dir = preprocessed_data_dir
+        self.model_id = model_id
+        self.max_queue_size = max_queue_size
+        self.tool_call_wait_time = tool_call_wait_time
+        self.enable_reflection = enable_reflection
+        self.max_finished_jobs = max_finished_jobs
+        self.policy = policy
+        self.context_budget = context_budget
+        self.outline_depth = outline_depth
+        self.corpus_index = None
+        if corpus_index_dir is not None:
+            self.corpus_index = corpus_index.get_corpus_index(corpus_index_dir)
+
+        self.registry = doc_reader.get_registry(max_memory_mb=reader_cache_mb)
+        self.client = llm_client.get_client_pool(
+            api_keys=api_key, base_urls=base_urls, weights=endpoint_weights
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # shared by all jobs and updated in place by their reflection loops
+        self.memory = memory if memory is not None else memory_bank.TextMemory()
+
+        self.jobs = dict()
+        self.finished_job_ids = []
+        self.job_counter = itertools.count()
+        self.lock = threading.Lock()
+        self.num_queued, self.num_running = 0, 0
+        self.num_completed, self.num_failed, self.num_rejected = 0, 0, 0
+        self.latencies = []
+
+    def submit(self, doc_id, question):
+        # a doc_id names a directory directly under preprocessed_data_dir, not a path
+        if (
+            not isinstance(doc_id, str)
+            or doc_id in ["", ".", ".."]
+            or doc_id != os.path.basename(doc_id)
+            or "/" in doc_id
+            or (os.path.altsep is not None and os.path.altsep in doc_id)
+        ):
+            raise ValueError(f"Invalid doc_id {doc_id}")
+        if not os.path.isdir(os.path.join(self.preprocessed_data_dir, doc_id)):
+            raise KeyError(doc_id)
+
+        with self.lock:
+            if self.num_queued >= self.max_queue_size:
+                self.num_rejected += 1
+                raise QueueFullError(
+                    f"The queue is full ({self.max_queue_size} waiting questions)"
+                )
+            job = Job("%08d" % next(self.job_counter), doc_id, question)
+            self.jobs[job.job_id] = job
+            self.num_queued += 1
+
+        job.set_status("queued")
+        self.executor.submit(self.run_job, job)
+        return job
+
+    def run_job(self, job):
+        with self.lock:
+            self.num_queued -= 1
+            self.num_running += 1
+        job.start_time = time.time()
+        job.set_status("running")
+
+        try:
+            document = self.registry.get(
+                os.path.join(self.preprocessed_data_dir, job.doc_id)
+            )
+            agent = doc_agent.DocAgent(
+                document,
+                model_id=self.model_id,
+                client=self.client,
+                tool_call_wait_time=self.tool_call_wait_time,
+                progress_callback=job.add_event,
+                context_budget=self.context_budget,
+                outline_depth=self.outline_depth,
+                corpus_index=self.corpus_index,
+            )
+            result = answer_question(
+                agent,
+                job.question,
+                self.memory,
+                enable_reflection=self.enable_reflection,
+                policy=self.policy,
+                task_id=job.job_id,
+            )
+
+            job.result = result
+            status = "completed"
+        except Exception as e:
+            print(traceback.format_exc())
+            job.error = str(e)
+            status = "failed"
+
+        job.end_time = time.time()
+        with self.lock:
+            self.num_running -= 1
+            if status == "completed":
+                self.num_completed += 1
+            else:
+                self.num_failed += 1
+            self.latencies.append(job.end_time - job.submit_time)
+            self.latencies = self.latencies[-1000:]
+            self.finished_job_ids.append(job.job_id)
+            while len(self.finished_job_ids) > self.max_finished_jobs:
+                self.jobs.pop(self.finished_job_ids.pop(0), None)
+        job.set_status(status)
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            metrics = {
+                "queued": self.num_queued,
+                "running": self.num_running,
+                "completed": self.num_completed,
+                "failed": self.num_failed,
+                "rejected": self.num_rejected,
+            }
+        if len(latencies) > 0:
+            metrics["latency_mean"] = sum(latencies) / len(latencies)
+            metrics["latency_p50"] = latencies[int(0.5 * (len(latencies) - 1))]
+            metrics["latency_p95"] = latencies[int(0.95 * (len(latencies) - 1))]
+        metrics["document_cache"] = self.registry.stats()
+        metrics["llm_endpoints"] = self.client.stats()
+        return metrics
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints:
+        POST /questions                 {"doc_id": ..., "question": ...} -> {"job_id": ...}
+        GET  /questions/<job_id>        job status and, once finished, the answers
+        GET  /questions/<job_id>/events progress as server-sent events until the job finishes
+        GET  /corpus_search?query=...&max_docs=10  documents and sections matching the query
+        GET  /health
+        GET  /metrics
+    """
+
+    service = None
+
+    def send_json(self, status_code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+
+        if parts == ["health"]:
+            self.send_json(200, {"status": "ok"})
+
+        elif parts == ["metrics"]:
+            self.send_json(200, self.service.metrics())
+
+        elif parts == ["corpus_search"]:
+            params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            if self.service.corpus_index is None:
+                self.send_json(404, {"error": "No corpus index, start the server with --corpus-index-dir"})
+            elif "query" not in params:
+                self.send_json(400, {"error": "query is required"})
+            else:
+                try:
+                    max_docs = int(params.get("max_docs", ["10"])[0])
+                except ValueError:
+                    self.send_json(400, {"error": "max_docs must be an integer"})
+                    return
+                results = self.service.corpus_index.search(params["query"][0], max_docs=max_docs)
+                self.send_json(200, {"results": results})
+
+        elif len(parts) in [2, 3] and parts[0] == "questions":
+            job = self.service.get_job(parts[1])
+            if job is None:
+                self.send_json(404, {"error": f"Unknown job_id {parts[1]}"})
+            elif len(parts) == 2:
+                self.send_json(200, job.to_dict())
+            elif parts[2] == "events":
+                self.stream_events(job)
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/questions":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            doc_id, question = request["doc_id"], request["question"]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": "Expected a JSON body with doc_id and question"})
+            return
+
+        try:
+            job = self.service.submit(doc_id, question)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except KeyError:
+            self.send_json(404, {"error": f"Unknown doc_id {doc_id}"})
+            return
+        except QueueFullError as e:
+            self.send_json(429, {"error": str(e)})
+            return
+
+        self.send_json(202, job.to_dict())
+
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        index = 0
+        while True:
+            with job.condition:
+                while index >= len(job.events) and not job.is_done():
+                    job.condition.wait(timeout=15)
+                events = job.events[index:]
+                done = job.is_done()
+            index += len(events)
+
+            try:
+                for event in events:
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                if done:
+                    self.wfile.write(
+                        f"event: result\ndata: {json.dumps(job.to_dict())}\n\n".encode(
+                            "utf-8"
+                        )
+                    )
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if done:
+                return
+
+
+def main(args):
+    service = DocAgentService(
+        args.preprocessed_data_dir,
+        api_key=args.api_key,
+        base_urls=args.base_urls,
+        endpoint_weights=args.endpoint_weights,
+        model_id=args.model_id,
+        max_concurrency=args.max_concurrency,
+        max_queue_size=args.max_queue_size,
+        reader_cache_mb=args.reader_cache_mb,
+        tool_call_wait_time=args.tool_call_wait_time,
+        enable_reflection=not args.disable_reflection,
+        policy=review_policy.get_review_policy(args.review_policy),
+        memory=memory_bank.MemoryBank() if args.memory_mode == "bank" else None,
+        context_budget=args.context_budget,
+        outline_depth=args.outline_depth,
+        corpus_index_dir=args.corpus_index_dir,
+    )
+    RequestHandler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print(f"Serving DocAgent on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,229 @@
+import csv
+import io
+import re
+
+filter_pattern = re.compile(r"^\s*(.+?)\s*(>=|<=|!=|=|>|<|\bcontains\b)\s*(.+?)\s*$", re.IGNORECASE)
+
+
+class TableQueryError(ValueError):
+    pass
+
+
+def parse_number(text):
+    """Return the number in a cell like "1,234", "$5.2", "45%" or "(12)", or None."""
+    text = text.strip().replace(",", "").replace("$", "").replace("€", "").replace("£", "")
+    text = text.rstrip("%").strip()
+    negative = text.startswith("(") and text.endswith(")")
+    if negative:
+        text = text[1:-1]
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return -number if negative else number
+
+
+def is_header_row(row):
+    # header rows have text, but no numbers, e.g. "Group,2008,2015" has years as names
+    cells = [cell for cell in row if cell.strip()]
+    if len(cells) == 0:
+        return False
+    numbers = [cell for cell in cells[1:] if parse_number(cell) is not None]
+    return len(numbers) == 0 or all(re.fullmatch(r"(19|20)\d\d", cell.strip()) for cell in numbers)
+
+
+def detect_header_rows(rows, max_header_rows=3):
+    """Return the number of leading header rows, which have text but no values."""
+    num_header_rows = 0
+    while (
+        num_header_rows < min(max_header_rows, len(rows) - 1)
+        and is_header_row(rows[num_header_rows])
+    ):
+        num_header_rows += 1
+    if num_header_rows == min(max_header_rows, len(rows) - 1) and len(rows) > 1:
+        # no numeric rows follow, e.g. a table of text, only the first row is its header
+        if all(is_header_row(row) for row in rows[num_header_rows:]):
+            num_header_rows = 1
+    return num_header_rows
+
+
+class Table:
+    """
+    A table parsed from the CSV text of a CSV_Table, stored column by column.
+
+    Leading rows without values are the header; names of multi-row headers are joined per
+    column, with the cells of spanning headers filled in from the left. Columns without a
+    name are called column_1, column_2, ...
+    """
+
+    def __init__(self, table_id, csv_text):
+        self.table_id = table_id
+        rows = [row for row in csv.reader(io.StringIO(csv_text)) if any(cell.strip() for cell in row)]
+        num_columns = max([len(row) for row in rows] + [0])
+        rows = [row + [""] * (num_columns - len(row)) for row in rows]
+
+        self.num_header_rows = detect_header_rows(rows)
+        self.header_rows = rows[: self.num_header_rows]
+        names = []
+        for column in range(num_columns):
+            parts = []
+            for row in self.header_rows:
+                # a spanning header cell is only written in its first column
+                cell, left = row[column].strip(), column
+                while cell == "" and left > 0 and row is not self.header_rows[-1]:
+                    left -= 1
+                    cell = row[left].strip()
+                if cell and cell not in parts:
+                    parts.append(cell)
+            names.append(" ".join(parts) or f"column_{column + 1}")
+        # duplicate names get a suffix, so that every column can be selected
+        seen = dict()
+        for column, name in enumerate(names):
+            if name in seen:
+                seen[name] += 1
+                names[column] = f"{name}_{seen[name]}"
+            else:
+                seen[name] = 1
+        self.columns = names
+        data_rows = rows[self.num_header_rows :]
+        self.num_rows = len(data_rows)
+        self.values = [tuple(row[column] for row in data_rows) for column in range(num_columns)]
+
+    def get_row(self, index):
+        return [values[index] for values in self.values]
+
+    def to_csv(self, row_indices, columns=None, with_row_numbers=False):
+        columns = list(range(len(self.columns))) if columns is None else columns
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        header = [self.columns[column] for column in columns]
+        writer.writerow((["row"] if with_row_numbers else []) + header)
+        for index in row_indices:
+            row = [self.values[column][index] for column in columns]
+            writer.writerow(([str(index + 1)] if with_row_numbers else []) + row)
+        return output.getvalue()
+
+    def preview(self, max_rows, keyword=None):
+        """
+        Return the CSV text of the header and the first max_rows rows, preferring the rows
+        containing keyword if given, with a note on the rows left out. Returns None for tables
+        with at most max_rows rows, which are shown in full.
+        """
+        if self.num_rows <= max_rows:
+            return None
+        indices = list(range(self.num_rows))
+        matching = ""
+        if keyword is not None:
+            keyword = keyword.lower()
+            keyword_indices = [
+                index for index in indices if any(keyword in cell.lower() for cell in self.get_row(index))
+            ]
+            if len(keyword_indices) > 0:  # otherwise the keyword is in the header
+                indices = keyword_indices
+                matching = f" of the {len(indices)} rows containing {keyword}"
+        text = self.to_csv(indices[:max_rows], with_row_numbers=True)
+        text += (
+            f"...{min(len(indices), max_rows)}{matching} of the {self.num_rows} rows are shown, "
+            f"use query_table with table_id {self.table_id} to get other rows.\n"
+        )
+        return text
+
+    def find_columns(self, name):
+        """Return the indices of the column with this name, or of the columns whose names contain it."""
+        name = str(name).strip().lower()
+        lowered = [column.lower() for column in self.columns]
+        if name in lowered:
+            return [lowered.index(name)]
+        return [index for index, column in enumerate(lowered) if name in column]
+
+    def parse_condition(self, text):
+        """Parse "column op value" into (column, op, value, exact), or return None."""
+        match_result = filter_pattern.match(text)
+        if match_result is None:
+            return None
+        name, op, value = match_result.groups()
+        matches = self.find_columns(name)
+        if len(matches) != 1:
+            return None
+        exact = self.columns[matches[0]].lower() == name.strip().lower()
+        return matches[0], op.lower(), value.strip().strip("\"'"), exact
+
+    def parse_row_filter(self, row_filter):
+        """
+        Parse conditions like "Group contains born and 2015 > 50" into (column, op, value)
+        tuples. Only an "and" followed by a condition on a column of the table separates two
+        conditions, so that names and values like "Research and development" stay whole; of
+        several ways to split, the one with the most conditions and then the most exactly
+        named columns wins. A filter without operator matches the rows with a cell containing it.
+        """
+        row_filter = row_filter.strip()
+        # pieces at even and the " and " between them at odd positions
+        tokens = re.split(r"(\s+and\s+)", row_filter, flags=re.IGNORECASE)
+        num_pieces = len(tokens) // 2 + 1
+        best = {num_pieces: (0, 0, [])}
+        for start in range(num_pieces - 1, -1, -1):
+            best[start] = None
+            for end in range(start + 1, num_pieces + 1):
+                condition = self.parse_condition("".join(tokens[2 * start : 2 * end - 1]))
+                if condition is None or best[end] is None:
+                    continue
+                num_conditions, num_exact, conditions = best[end]
+                candidate = (num_conditions + 1, num_exact + condition[3], [condition[:3]] + conditions)
+                if best[start] is None or candidate[:2] > best[start][:2]:
+                    best[start] = candidate
+        if best[0] is not None:
+            return best[0][2]
+        if filter_pattern.match(row_filter) is None:
+            return [(None, "contains", row_filter)]
+        raise TableQueryError(
+            f"The row filter {row_filter} could not be parsed, use conditions like \"column >= value\" "
+            f"joined by \"and\" on the columns {self.columns} of table {self.table_id}"
+        )
+
+    def matches(self, index, conditions):
+        for column, op, value in conditions:
+            if column is None:
+                if not any(value.lower() in cell.lower() for cell in self.get_row(index)):
+                    return False
+                continue
+            cell = self.values[column][index]
+            if op == "contains":
+                if value.lower() not in cell.lower():
+                    return False
+                continue
+            cell_number, value_number = parse_number(cell), parse_number(value)
+            if cell_number is not None and value_number is not None:
+                left, right = cell_number, value_number
+            elif op in ["=", "!="]:
+                left, right = cell.strip().lower(), value.lower()
+            else:
+                return False
+            if not {
+                "=": left == right,
+                "!=": left != right,
+                ">": left > right,
+                ">=": left >= right,
+                "<": left < right,
+                "<=": left <= right,
+            }[op]:
+                return False
+        return True
+
+    def query(self, columns=None, row_filter=None, limit=20):
+        """Return the CSV text of the matching rows and selected columns, and the number of matches."""
+        selected = None
+        if columns:
+            selected = []
+            for column in columns:
+                matches = self.find_columns(column)
+                if len(matches) == 0:
+                    raise TableQueryError(
+                        f"The column {column} is not in table {self.table_id}, its columns are {self.columns}"
+                    )
+                selected += [index for index in matches if index not in selected]
+            if 0 not in selected:
+                # the first column usually names the row
+                selected = [0] + selected
+        conditions = self.parse_row_filter(row_filter) if row_filter else []
+        indices = [index for index in range(self.num_rows) if self.matches(index, conditions)]
+        return self.to_csv(indices[:limit], selected, with_row_numbers=True), len(indices)
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+import pytest
+
+from lease import LeaseQueue, parse_shard
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make_queue(worker_id, lease_timeout=60):
+        # no heartbeat during the test, leases are renewed by hand
+        queue = LeaseQueue(
+            str(tmp_path), worker_id=worker_id, lease_timeout=lease_timeout, heartbeat_interval=3600
+        )
+        queues.append(queue)
+        return queue
+
+    yield make_queue
+    for queue in queues:
+        queue.close()
+
+
+def expire(queue, job_id):
+    old = time.time() - 2 * queue.lease_timeout
+    os.utime(queue.get_path(job_id), (old, old))
+
+
+def test_parse_shard():
+    assert parse_shard("1/4") == (1, 4)
+    with pytest.raises(ValueError):
+        parse_shard("4/4")
+
+
+def test_lease_is_exclusive(make_queue):
+    queue_1, queue_2 = make_queue("w1"), make_queue("w2")
+    assert queue_1.try_acquire("job_00000")
+    assert not queue_2.try_acquire("job_00000")
+    assert queue_1.is_held("job_00000")
+    queue_1.release("job_00000")
+    assert queue_2.try_acquire("job_00000")
+
+
+def test_expired_lease_is_taken_over(make_queue):
+    queue_1, queue_2 = make_queue("w1"), make_queue("w2")
+    assert queue_1.try_acquire("job_00000")
+    expire(queue_1, "job_00000")
+    assert queue_2.try_acquire("job_00000")
+    assert not queue_1.is_held("job_00000")
+    assert queue_2.is_held("job_00000")
+
+    # the previous owner neither removes nor renews the new lease
+    queue_1.release("job_00000")
+    queue_1.renew()
+    assert queue_2.is_held("job_00000")
+    assert "job_00000" not in queue_1.held
+
+
+def test_renewed_lease_is_kept(make_queue):
+    queue_1, queue_2 = make_queue("w1"), make_queue("w2")
+    assert queue_1.try_acquire("job_00000")
+    expire(queue_1, "job_00000")
+    queue_1.renew()
+    assert not queue_2.try_acquire("job_00000")
+    assert queue_1.is_held("job_00000")
+
+
+def test_one_worker_takes_over(make_queue):
+    owner = make_queue("owner")
+    assert owner.try_acquire("job_00000")
+    expire(owner, "job_00000")
+
+    queues = [make_queue(f"w{index}") for index in range(8)]
+    results = [None] * len(queues)
+    barrier = threading.Barrier(len(queues))
+
+    def acquire(index):
+        barrier.wait()
+        results[index] = queues[index].try_acquire("job_00000")
+
+    threads = [threading.Thread(target=acquire, args=(index,)) for index in range(len(queues))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(results) == 1
+    assert [name for name in os.listdir(owner.lease_dir)] == ["job_00000.lock"]
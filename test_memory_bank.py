@@ -0,0 +1,65 @@
+import memory_bank
+
+
+def get_state(bank):
+    return bank.task_count, sorted(
+        (entry["entry_id"], entry["text"], entry["hit_count"]) for entry in bank.entries.values()
+    )
+
+
+def test_duplicates_are_merged():
+    bank = memory_bank.MemoryBank()
+    bank.add("Check the chart legend before reading values", "task_1")
+    bank.add("check chart legend before reading the values", "task_2")
+    assert [entry["text"] for entry in bank.entries.values()] == [
+        "Check the chart legend before reading values"
+    ]
+
+
+def test_workers_merge_to_the_same_bank(tmp_path):
+    bank_a = memory_bank.MemoryBank(worker_id="a", op_log_dir=str(tmp_path))
+    bank_b = memory_bank.MemoryBank(worker_id="b", op_log_dir=str(tmp_path))
+    bank_a.add("Check the chart legend before reading values", "task_2")
+    bank_b.add("Convert percentages into counts with the sample size", "task_1")
+    bank_a.sync()
+    bank_b.sync()
+
+    # the edit of the later task wins, whichever worker syncs first
+    bank_b.edit("a:0", "Read the legend of every chart", "task_4")
+    bank_a.edit("a:0", "Read the axis labels of every chart", "task_3")
+    # an edit of an entry removed by an earlier task is ignored
+    bank_a.remove("b:0", "task_5")
+    bank_b.edit("b:0", "Use the sample size of each group", "task_6")
+    bank_b.sync()
+    bank_a.sync()
+
+    fresh = memory_bank.MemoryBank(worker_id="c", op_log_dir=str(tmp_path))
+    assert get_state(bank_a) == get_state(bank_b) == get_state(fresh)
+    assert [entry["text"] for entry in fresh.entries.values()] == ["Read the legend of every chart"]
+
+
+def test_out_of_order_operation_is_replayed_once(tmp_path):
+    bank_a = memory_bank.MemoryBank(worker_id="a", op_log_dir=str(tmp_path))
+    bank_b = memory_bank.MemoryBank(worker_id="b", op_log_dir=str(tmp_path))
+    bank_b.add("Compare the totals of both years", "task_5")
+    bank_a.sync()
+
+    # task_1 sorts before the merged task_5, the bank replays the log on the next sync
+    bank_a.add("Look up the footnotes of tables", "task_1")
+    assert bank_a.needs_replay
+    bank_a.sync()
+    assert not bank_a.needs_replay
+
+    fresh = memory_bank.MemoryBank(worker_id="c", op_log_dir=str(tmp_path))
+    assert get_state(bank_a) == get_state(fresh)
+    assert len(fresh.entries) == 2
+
+
+def test_partial_operation_is_left_for_the_next_sync(tmp_path):
+    bank_a = memory_bank.MemoryBank(worker_id="a", op_log_dir=str(tmp_path))
+    bank_a.add("Check the chart legend before reading values", "task_1")
+    with open(bank_a.get_op_log_path("b"), "w") as f:
+        f.write('{"op": "add", "task": "task_2"')
+
+    bank_c = memory_bank.MemoryBank(worker_id="c", op_log_dir=str(tmp_path))
+    assert get_state(bank_c) == get_state(bank_a)
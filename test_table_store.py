@@ -0,0 +1,56 @@
+import pytest
+
+from table_store import Table, TableQueryError
+
+csv_text = """Group,2015,Research and development
+born in US,55,a
+born abroad,40,b
+born and raised abroad,62,c
+All adults,50,d
+"""
+
+
+@pytest.fixture
+def table():
+    return Table("table_1", csv_text)
+
+
+def test_columns(table):
+    assert table.columns == ["Group", "2015", "Research and development"]
+    assert table.num_rows == 4
+
+
+def test_conditions_are_split_on_and(table):
+    assert table.parse_row_filter("Group contains born and 2015 > 50") == [
+        (0, "contains", "born"),
+        (1, ">", "50"),
+    ]
+
+
+def test_and_inside_a_column_name(table):
+    assert table.parse_row_filter("Research and development = a") == [(2, "=", "a")]
+    assert table.parse_row_filter("Group contains a and development = b") == [
+        (0, "contains", "a"),
+        (2, "=", "b"),
+    ]
+
+
+def test_and_inside_a_value(table):
+    assert table.parse_row_filter("Group contains born and raised") == [
+        (0, "contains", "born and raised")
+    ]
+
+
+def test_filter_without_operator(table):
+    assert table.parse_row_filter("abroad") == [(None, "contains", "abroad")]
+
+
+def test_unknown_column(table):
+    with pytest.raises(TableQueryError):
+        table.parse_row_filter("Income > 5")
+
+
+def test_query(table):
+    text, num_matches = table.query(["2015"], "Group contains born and 2015 > 50")
+    assert num_matches == 2
+    assert text == "row,Group,2015\n1,born in US,55\n3,born and raised abroad,62\n"